@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of IPOProcessor.process_ipo_alerts against local fake upstreams
+Each run uses a fresh subprocess and state directory, so memory and timings are isolated;
+results are written to benchmarks/results/ and compared with the previous run
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+sys.path.insert(0, BENCH_DIR)
+
+from fake_upstream import FakeUpstream, FEED_PATH, BREVO_PATH, WEBHOOK_PATH
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_child(args):
+    """Run one benchmark inside this process; prints a RESULT line for the parent"""
+    workdir = tempfile.mkdtemp(prefix="ipo-bench-")
+    os.chdir(workdir)  # ipo_bot.log and every state file stay out of the repo
+    email_list = os.path.join(workdir, "email_update.txt")
+    with open(email_list, "w", encoding="utf-8") as f:
+        f.write("# Benchmark subscribers\n")
+        for i in range(args.subscribers):
+            f.write(f"investor{i:06d}@example.com\n")
+
+    os.environ.update({
+        "BREVO_API_KEY": "benchmark", "FROM_NAME": "IPO Bench", "FROM_EMAIL": "bench@example.com",
+        "ONGOING_URL": args.upstream + FEED_PATH, "BREVO_API_URL": args.upstream + BREVO_PATH,
+        "EMAIL_LIST_FILE": email_list,
+        "IPO_SNAPSHOT_FILE": os.path.join(workdir, "ipo_snapshot.json"),
+        "IPO_INDEX_FILE": os.path.join(workdir, "ipo_index.json"),
+        "LEDGER_DB_FILE": os.path.join(workdir, "delivery_ledger.db"),
+        "SUBSCRIBER_DB_FILE": os.path.join(workdir, "subscribers.db"),
+        "SPOOL_DB_FILE": os.path.join(workdir, "outbound_spool.db"),
+        "REMINDER_DB_FILE": os.path.join(workdir, "reminders.db"),
+        "IPO_HISTORY_FILE": os.path.join(workdir, "ipo_history.csv"),
+        "RENDER_CACHE_DIR": os.path.join(workdir, "render_cache"),
+        "PERSONALIZATION_SECRET_FILE": os.path.join(workdir, "personalization_secret"),
+        "UPCOMING_SNAPSHOT_FILE": os.path.join(workdir, "ipo_upcoming_snapshot.json"),
+        "RESULTS_SNAPSHOT_FILE": os.path.join(workdir, "ipo_results_snapshot.json"),
+        "METRICS_PORT": "0", "METRICS_DUMP_FILE": "",
+        "EMAIL_TRANSPORT_MODE": args.mode,
+        "EMAIL_CONCURRENCY": str(args.concurrency), "SPOOL_WORKERS": str(args.concurrency),
+        "EMAIL_RATE_PER_SECOND": str(args.rate),
+        "SPOOL_BACKOFF_BASE_SECONDS": "0.5", "SPOOL_BACKOFF_MAX_SECONDS": "5",
+        "PERSONALIZATION_ENABLED": "true" if args.personalized else "false",
+        "DISCORD_TOKEN": "",
+        "DISCORD_WEBHOOK_URLS": ",".join(f"{args.upstream}{WEBHOOK_PATH}{i}/token" for i in range(args.webhooks)),
+    })
+    sys.path.insert(0, os.path.join(BASE_DIR, "src"))
+
+    import asyncio
+    import logging
+    import resource
+
+    from config import logger
+    from function.ipo_processor import IPOProcessor
+    from function.http_transport import transport
+
+    # Per-recipient INFO lines would dominate the profile at 100k subscribers
+    logger.setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    async def main():
+        processor = IPOProcessor()
+        processor.spool.start()
+        started_at = time.time()
+        start = time.perf_counter()
+        await processor.process_ipo_alerts()
+        detection = time.perf_counter() - start
+        await processor.spool.drain()
+        total = time.perf_counter() - start
+        await processor.spool.stop()
+
+        stats = (await transport.aget(args.upstream + "/__stats")).json()
+        await transport.aclose()
+        lags = sorted(received_at - started_at for received_at, _ in stats["deliveries"])
+        delivered = len(lags)
+        return {
+            "mode": args.mode,
+            "subscribers": args.subscribers,
+            "delivered": delivered,
+            "dead_letters": processor.spool.stats().get("dead", 0),
+            "requests": stats["requests"],
+            "detection_s": round(detection, 3),
+            "total_s": round(total, 3),
+            "throughput_per_s": round(delivered / total, 1) if total else 0.0,
+            "latency_p50_s": round(percentile(lags, 0.50), 3),
+            "latency_p99_s": round(percentile(lags, 0.99), 3),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+    print("RESULT " + json.dumps(asyncio.run(main())), flush=True)
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def latest_results():
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    files = sorted(f for f in os.listdir(RESULTS_DIR) if f.startswith("pipeline-") and f.endswith(".json"))
+    if not files:
+        return None
+    with open(os.path.join(RESULTS_DIR, files[-1]), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def print_table(runs, previous):
+    previous_runs = {(r["mode"], r["subscribers"]): r for r in (previous or {}).get("runs", [])}
+    print(f"\n{'mode':<7} {'subs':>8} {'sent':>8} {'detect':>8} {'total':>8} {'msg/s':>10} "
+          f"{'p50':>7} {'p99':>7} {'rss MB':>7}  vs previous")
+    for r in runs:
+        before = previous_runs.get((r["mode"], r["subscribers"]))
+        delta = ""
+        if before and before.get("throughput_per_s"):
+            change = (r["throughput_per_s"] - before["throughput_per_s"]) / before["throughput_per_s"]
+            delta = f"{change:+.1%} throughput ({before['version']})"
+        print(f"{r['mode']:<7} {r['subscribers']:>8,} {r['delivered']:>8,} {r['detection_s']:>7.2f}s "
+              f"{r['total_s']:>7.2f}s {r['throughput_per_s']:>10,.0f} {r['latency_p50_s']:>6.2f}s "
+              f"{r['latency_p99_s']:>6.2f}s {r['peak_rss_mb']:>7.1f}  {delta}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated subscriber counts")
+    parser.add_argument("--modes", default="single,batch", help="email transport modes to run")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=1_000_000, help="Brevo requests per second")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake upstream latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of sends answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of sends answered with 429")
+    parser.add_argument("--ipos", type=int, default=1, help="IPOs opening in the fake feed")
+    parser.add_argument("--webhooks", type=int, default=3, help="fake Discord webhooks to fan out to")
+    parser.add_argument("--personalized", action="store_true")
+    parser.add_argument("--no-save", action="store_true", help="do not write a results file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--upstream", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    parser.add_argument("--subscribers", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args)
+
+    upstream = FakeUpstream(latency=args.latency, error_rate=args.error_rate,
+                            rate_limit_rate=args.rate_limit_rate, retry_after=0.2, ipo_count=args.ipos).start()
+    runs = []
+    try:
+        for mode in args.modes.split(","):
+            for size in (int(s) for s in args.sizes.split(",")):
+                upstream.reset()
+                print(f"Running {mode} mode with {size:,} subscribers...", flush=True)
+                child = subprocess.run([
+                    sys.executable, os.path.abspath(__file__), "--child", "--upstream", upstream.url,
+                    "--mode", mode, "--subscribers", str(size), "--concurrency", str(args.concurrency),
+                    "--rate", str(args.rate), "--webhooks", str(args.webhooks),
+                ] + (["--personalized"] if args.personalized else []), capture_output=True, text=True)
+                result = next((line[7:] for line in child.stdout.splitlines() if line.startswith("RESULT ")), None)
+                if child.returncode or result is None:
+                    print(child.stdout[-2000:], child.stderr[-4000:], sep="\n")
+                    sys.exit(f"Benchmark run failed ({mode}, {size})")
+                runs.append(dict(json.loads(result), version=git_version()))
+    finally:
+        upstream.stop()
+
+    previous = latest_results()
+    print_table(runs, previous)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(RESULTS_DIR, f"pipeline-{stamp}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "version": git_version(),
+                "timestamp": stamp,
+                "python": sys.version.split()[0],
+                "settings": {k: v for k, v in vars(args).items() if k not in ("child", "upstream", "mode", "subscribers")},
+                "runs": runs,
+            }, f, indent=2)
+        print(f"\nResults written to {os.path.relpath(path, BASE_DIR)}")
+
+
+if __name__ == "__main__":
+    main()
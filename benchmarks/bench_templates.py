@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Benchmark per-recipient personalization of the IPO alert email
+Compares the compiled skeleton engine with re-rendering the f-string template
+"""
+
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(BASE_DIR, "src"))
+# Keep the benchmark from generating a secret file in src/
+os.environ.setdefault("PERSONALIZATION_SECRET", "benchmark")
+
+from function.email_templates import (
+    create_ipo_alert_email, get_personalized_alert_skeleton, personalization_values
+)
+from function.email_service import PersonalizedContent
+from function.skeleton_template import compile_text
+
+SAMPLE_IPO = {
+    "finid": "SAMPLE",
+    "company_name": "Sample Hydropower Limited",
+    "Sector": "Hydro Power",
+    "offer_price": 100,
+    "open_date": "2025-09-01 00:00:00",
+    "close_date": "2025-09-05 00:00:00",
+    "shares_offered": 1500000,
+    "issue_manager": "Sample Capital Ltd",
+}
+METRICS = (4, 60.0, "10", "Conservative approach recommended due to high demand.")
+
+
+def consume(renders):
+    """Drain renders without keeping them, like a sender streaming bodies out"""
+    total = 0
+    for body in renders:
+        total += len(body)
+    return total
+
+
+def timed(label, count, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<45} {count:>8,} in {elapsed:7.3f}s  ({count / elapsed:>12,.0f}/s)")
+    return elapsed
+
+
+def main(count=100_000):
+    emails = [f"investor{i}@example.com" for i in range(count)]
+
+    timed("f-string re-render (baseline)", count // 100,
+          lambda: consume(create_ipo_alert_email(SAMPLE_IPO, *METRICS) for _ in range(count // 100)))
+
+    skeleton = get_personalized_alert_skeleton(SAMPLE_IPO, *METRICS)
+    template = compile_text(skeleton)
+    values = [personalization_values(email, SAMPLE_IPO["finid"]) for email in emails]
+
+    timed("compiled skeleton render (values ready)", count,
+          lambda: consume(template.render(v) for v in values))
+    timed("compiled skeleton render + personalization", count,
+          lambda: consume(template.render(personalization_values(email, SAMPLE_IPO["finid"])) for email in emails))
+
+    content = PersonalizedContent(
+        "IPO Alert", skeleton, lambda email: personalization_values(email, SAMPLE_IPO["finid"]),
+        personalization_values("investor@localhost", SAMPLE_IPO["finid"], name="Investor")
+    )
+    timed("Brevo JSON request bodies (single mode)", count,
+          lambda: consume(content.single_body(email) for email in emails))
+    timed("Brevo JSON request bodies (batch of 500)", count,
+          lambda: consume(content.batch_body(emails[i:i + 500]) for i in range(0, count, 500)))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
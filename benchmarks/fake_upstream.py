@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for the IPO feeds and the Brevo /v3/smtp/email endpoint
+Latency, 5xx error rate and 429 rate are configurable; every accepted recipient is timestamped
+"""
+
+import json
+import time
+import random
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytz
+
+FEED_PATH = "/ipo/ongoing"
+UPCOMING_PATH = "/ipo/upcoming"
+BREVO_PATH = "/v3/smtp/email"
+WEBHOOK_PATH = "/api/webhooks/"
+
+
+def sample_feed(count=3, days_ahead=0, prefix="BENCH"):
+    """IPOs that open `days_ahead` days from today in Nepal time; with 0 the processor alerts on all of them"""
+    today = datetime.datetime.now(pytz.timezone("Asia/Kathmandu")).date()
+    opens = (today + datetime.timedelta(days=days_ahead)).isoformat()
+    close = (today + datetime.timedelta(days=days_ahead + 4)).isoformat()
+    return [{
+        "finid": f"{prefix}{i}",
+        "company_name": f"Benchmark Hydropower {i} Limited",
+        "Sector": "Hydro Power",
+        "offer_price": 100,
+        "open_date": f"{opens} 00:00:00",
+        "close_date": f"{close} 00:00:00",
+        "shares_offered": 1500000 + i,
+        "issue_manager": "Benchmark Capital Ltd",
+    } for i in range(count)]
+
+
+class FakeUpstream:
+    """Threaded HTTP server imitating the IPO API, Brevo and Discord webhooks"""
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, rate_limit_rate=0.0,
+                 retry_after=0.5, ipo_count=3):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.feed = json.dumps({"response": sample_feed(ipo_count)}).encode("utf-8")
+        self.upcoming = json.dumps({"response": sample_feed(ipo_count, days_ahead=2, prefix="SOON")}).encode("utf-8")
+        self.lock = threading.Lock()
+        self.reset()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset(self):
+        with self.lock:
+            self.requests = {"feed": 0, "brevo": 0, "webhook": 0, "errors": 0, "rate_limited": 0}
+            self.deliveries = []  # (received_at, recipient)
+            self.webhook_deliveries = []
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "deliveries": list(self.deliveries),
+                "webhook_deliveries": list(self.webhook_deliveries),
+            }
+
+    def _fault(self):
+        """Pick the injected response for a send request, or None to accept it"""
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            return 429
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+    def _handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # headers and body are separate writes
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body=b"{}", headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.startswith("/__stats"):
+                    return self._reply(200, json.dumps(upstream.stats()).encode("utf-8"))
+                if self.path.startswith((FEED_PATH, UPCOMING_PATH)):
+                    with upstream.lock:
+                        upstream.requests["feed"] += 1
+                    if upstream.latency:
+                        time.sleep(upstream.latency)
+                    return self._reply(200, upstream.feed if self.path.startswith(FEED_PATH) else upstream.upcoming)
+                self._reply(404)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.startswith("/__reset"):
+                    upstream.reset()
+                    return self._reply(204, b"")
+                kind = "brevo" if self.path.startswith(BREVO_PATH) else "webhook" if self.path.startswith(WEBHOOK_PATH) else None
+                if kind is None:
+                    return self._reply(404)
+
+                if upstream.latency:
+                    time.sleep(upstream.latency)
+                fault = upstream._fault()
+                with upstream.lock:
+                    upstream.requests[kind] += 1
+                    if fault == 429:
+                        upstream.requests["rate_limited"] += 1
+                    elif fault:
+                        upstream.requests["errors"] += 1
+                if fault == 429:
+                    return self._reply(429, b'{"message":"Too many requests"}',
+                                       {"Retry-After": str(upstream.retry_after)})
+                if fault:
+                    return self._reply(500, b'{"message":"Internal error"}')
+
+                received_at = time.time()
+                payload = json.loads(body)
+                if kind == "webhook":
+                    with upstream.lock:
+                        upstream.webhook_deliveries.append((received_at, self.path))
+                    return self._reply(204, b"")
+
+                versions = payload.get("messageVersions") or [payload]
+                with upstream.lock:
+                    upstream.deliveries.extend((received_at, v["to"][0]["email"]) for v in versions)
+                self._reply(201, b'{"messageId":"<bench@localhost>"}')
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(port=args.port, latency=args.latency, error_rate=args.error_rate,
+                            rate_limit_rate=args.rate_limit_rate).start()
+    print(f"IPO feed:   {upstream.url}{FEED_PATH}")
+    print(f"Upcoming:   {upstream.url}{UPCOMING_PATH}")
+    print(f"Brevo API:  {upstream.url}{BREVO_PATH}")
+    try:
+        upstream.thread.join()
+    except KeyboardInterrupt:
+        upstream.stop()
@@ -2,18 +2,22 @@ import os
 import pytz
 from dotenv import load_dotenv
 import logging
+from log_config import setup_logging
 
 # Load environment variables
 load_dotenv()
 
 # ===== LOGGING SETUP =====
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('ipo_bot.log'),
-        logging.StreamHandler()
-    ]
+LOG_FILE = os.getenv("LOG_FILE", "ipo_bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # "text" or "json" (one object per line)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))  # Size-based rotation threshold
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")  # e.g. "midnight" for time-based rotation instead
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))  # Rotated files are kept gzip-compressed
+LOG_SUCCESS_SAMPLE_EVERY = int(os.getenv("LOG_SUCCESS_SAMPLE_EVERY", 100))  # Log 1 in N per-recipient successes
+setup_logging(
+    LOG_FILE, level=LOG_LEVEL, fmt=LOG_FORMAT, max_bytes=LOG_MAX_BYTES,
+    backup_count=LOG_BACKUP_COUNT, rotate_when=LOG_ROTATE_WHEN or None
 )
 logger = logging.getLogger(__name__)
 
@@ -23,17 +27,115 @@ FROM_NAME = os.getenv("FROM_NAME")
 FROM_EMAIL = os.getenv("FROM_EMAIL")
 ADMIN_EMAIL = os.getenv("TO_EMAIL")
 ONGOING_URL = os.getenv("ONGOING_URL")
+ONGOING_MIRROR_URLS = [u.strip() for u in os.getenv("ONGOING_MIRROR_URLS", "").split(",") if u.strip()]  # Same schema, in priority order
+IPO_CACHE_TTL_SECONDS = int(os.getenv("IPO_CACHE_TTL_SECONDS", 60))
+UPCOMING_URLS = [u.strip() for u in os.getenv("UPCOMING_URLS", "").split(",") if u.strip()]  # Optional, mirrors after the first
+UPCOMING_CACHE_TTL_SECONDS = int(os.getenv("UPCOMING_CACHE_TTL_SECONDS", 1800))
+RESULTS_URLS = [u.strip() for u in os.getenv("RESULTS_URLS", "").split(",") if u.strip()]  # Optional closed/allotment feed
+RESULTS_CACHE_TTL_SECONDS = int(os.getenv("RESULTS_CACHE_TTL_SECONDS", 3600))
+PREPARE_AHEAD_DAYS = int(os.getenv("PREPARE_AHEAD_DAYS", 2))  # Render alerts for IPOs opening within this many days
+
+# ===== FEED SOURCE CONFIGURATION =====
+FEED_TIMEOUT_SECONDS = float(os.getenv("FEED_TIMEOUT_SECONDS", 10))  # Per-request timeout for each source
+FEED_HEDGE_DELAY_SECONDS = float(os.getenv("FEED_HEDGE_DELAY_SECONDS", 1.5))  # Ask the next source if no answer by then
+FEED_MERGE_GRACE_SECONDS = float(os.getenv("FEED_MERGE_GRACE_SECONDS", 0.25))  # Wait this long after the winner for others to merge
+FEED_BREAKER_THRESHOLD = int(os.getenv("FEED_BREAKER_THRESHOLD", 3))  # Consecutive failures before a source is skipped
+FEED_BREAKER_COOLDOWN_SECONDS = float(os.getenv("FEED_BREAKER_COOLDOWN_SECONDS", 300))
 
 # ===== BOT CONFIGURATION =====
-TOTAL_APPS = int(os.getenv("TOTAL_APPS", 2500000))
-CHECK_INTERVAL_HOURS = int(os.getenv("CHECK_INTERVAL_HOURS", 5))
+TOTAL_APPS = int(os.getenv("TOTAL_APPS", 2500000))  # Expected applications until enough IPO history is recorded
+ALLOTMENT_LOT_SIZE = int(os.getenv("ALLOTMENT_LOT_SIZE", 1))  # Shares each successful applicant receives
+CHECK_INTERVAL_HOURS = int(os.getenv("CHECK_INTERVAL_HOURS", 5))  # Off-hours / holiday polling interval
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # <-- directory of config.py
-EMAIL_LIST_FILE = os.path.join(BASE_DIR, "email_update.txt")
+EMAIL_LIST_FILE = os.getenv("EMAIL_LIST_FILE", os.path.join(BASE_DIR, "email_update.txt"))
+EMAIL_WATCH_DEBOUNCE_SECONDS = float(os.getenv("EMAIL_WATCH_DEBOUNCE_SECONDS", 1.0))
+IPO_SNAPSHOT_FILE = os.getenv("IPO_SNAPSHOT_FILE", os.path.join(BASE_DIR, "ipo_snapshot.json"))
+UPCOMING_SNAPSHOT_FILE = os.getenv("UPCOMING_SNAPSHOT_FILE", os.path.join(BASE_DIR, "ipo_upcoming_snapshot.json"))
+RESULTS_SNAPSHOT_FILE = os.getenv("RESULTS_SNAPSHOT_FILE", os.path.join(BASE_DIR, "ipo_results_snapshot.json"))
+IPO_HISTORY_FILE = os.getenv("IPO_HISTORY_FILE", os.path.join(BASE_DIR, "ipo_history.csv"))
+IPO_INDEX_FILE = os.getenv("IPO_INDEX_FILE", os.path.join(BASE_DIR, "ipo_index.json"))
+LEDGER_DB_FILE = os.getenv("LEDGER_DB_FILE", os.path.join(BASE_DIR, "delivery_ledger.db"))
+SUBSCRIBER_DB_FILE = os.getenv("SUBSCRIBER_DB_FILE", os.path.join(BASE_DIR, "subscribers.db"))
+STARTUP_CHECK_MODE = os.getenv("STARTUP_CHECK_MODE", "full").lower()  # "full" emails the admin, "light" sends nothing
+STARTUP_CHECK_TIMEOUT_SECONDS = float(os.getenv("STARTUP_CHECK_TIMEOUT_SECONDS", 15))  # Deadline for all pre-flight checks
+
+# ===== SCHEDULER CONFIGURATION =====
+MARKET_OPEN_TIME = os.getenv("MARKET_OPEN_TIME", "10:00")  # NPT, when IPO applications open
+MARKET_CLOSE_TIME = os.getenv("MARKET_CLOSE_TIME", "17:00")  # NPT, when IPO applications close
+TRADING_DAYS = {int(d) for d in os.getenv("TRADING_DAYS", "6,0,1,2,3").split(",") if d.strip()}  # Mon=0 ... Sun=6
+DENSE_POLL_MINUTES = float(os.getenv("DENSE_POLL_MINUTES", 5))
+DENSE_WINDOW_BEFORE_MINUTES = int(os.getenv("DENSE_WINDOW_BEFORE_MINUTES", 30))
+DENSE_WINDOW_AFTER_MINUTES = int(os.getenv("DENSE_WINDOW_AFTER_MINUTES", 120))
+TRADING_POLL_MINUTES = float(os.getenv("TRADING_POLL_MINUTES", 30))
+HOLIDAY_CALENDAR_FILE = os.getenv("HOLIDAY_CALENDAR_FILE", os.path.join(BASE_DIR, "holidays.txt"))
+
+# ===== PERSONALIZATION CONFIGURATION =====
+PERSONALIZATION_ENABLED = os.getenv("PERSONALIZATION_ENABLED", "false").lower() == "true"
+UNSUBSCRIBE_URL = os.getenv("UNSUBSCRIBE_URL", f"mailto:{FROM_EMAIL}?subject=Unsubscribe%20{{token}}")  # {email}, {token}
+TRACKING_URL = os.getenv("TRACKING_URL", "")  # e.g. https://example.com/open?t={token}&ipo={finid}, pixel omitted when unset
+PERSONALIZATION_SECRET = os.getenv("PERSONALIZATION_SECRET", "")  # Generated and kept in PERSONALIZATION_SECRET_FILE when unset
+PERSONALIZATION_SECRET_FILE = os.getenv("PERSONALIZATION_SECRET_FILE", os.path.join(BASE_DIR, ".personalization_secret"))
+
+# ===== DIGEST CONFIGURATION =====
+DIGEST_DEFAULT_DELIVERY = os.getenv("DIGEST_DEFAULT_DELIVERY", "instant").lower()  # "instant" or "digest" for subscribers without delivery=
+DIGEST_INCLUDE_CLOSING = os.getenv("DIGEST_INCLUDE_CLOSING", "false").lower() == "true"  # Also list IPOs closing tomorrow
+DISCORD_DIGEST = os.getenv("DISCORD_DIGEST", "false").lower() == "true"  # One Discord digest message per cycle instead of an embed per IPO
+
+# ===== REMINDER CONFIGURATION =====
+REMINDER_DB_FILE = os.getenv("REMINDER_DB_FILE", os.path.join(BASE_DIR, "reminders.db"))
+REMINDER_KINDS = [k.strip().lower() for k in os.getenv("REMINDER_KINDS", "pre_open,day_before_close,closing_day").split(",") if k.strip()]
+REMINDER_PRE_OPEN_TIME = os.getenv("REMINDER_PRE_OPEN_TIME", "18:00")  # NPT, the evening before an IPO opens
+REMINDER_MORNING_TIME = os.getenv("REMINDER_MORNING_TIME", "09:00")  # NPT, for the day-before-close and closing-day reminders
+REMINDER_GRACE_HOURS = float(os.getenv("REMINDER_GRACE_HOURS", 6))  # Reminders missed while down still go out this late
+REMINDER_RETRY_SECONDS = float(os.getenv("REMINDER_RETRY_SECONDS", 300))
+
+# ===== RENDER CACHE CONFIGURATION =====
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", 256))
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR")  # Optional on-disk tier, disabled when unset
+
+# ===== HTTP TRANSPORT CONFIGURATION =====
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 30))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 20))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+
+# ===== EMAIL DELIVERY CONFIGURATION =====
+BREVO_API_URL = os.getenv("BREVO_API_URL", "https://api.brevo.com/v3/smtp/email")
+# Read-only endpoint used to verify the API key at startup (the send endpoint only takes POST)
+BREVO_ACCOUNT_URL = os.getenv("BREVO_ACCOUNT_URL", BREVO_API_URL.rsplit("/smtp/", 1)[0] + "/account")
+EMAIL_CONCURRENCY = int(os.getenv("EMAIL_CONCURRENCY", 10))
+EMAIL_RATE_PER_SECOND = float(os.getenv("EMAIL_RATE_PER_SECOND", 10))
+EMAIL_MAX_RETRIES = int(os.getenv("EMAIL_MAX_RETRIES", 3))
+EMAIL_TRANSPORT_MODE = os.getenv("EMAIL_TRANSPORT_MODE", "single").lower()  # "single" or "batch"
+EMAIL_BATCH_SIZE = min(int(os.getenv("EMAIL_BATCH_SIZE", 500)), 1000)  # Brevo allows 1000 messageVersions per call
+
+# ===== OUTBOUND SPOOL CONFIGURATION =====
+SPOOL_DB_FILE = os.getenv("SPOOL_DB_FILE", os.path.join(BASE_DIR, "outbound_spool.db"))
+SPOOL_WORKERS = int(os.getenv("SPOOL_WORKERS", EMAIL_CONCURRENCY))
+SPOOL_CLAIM_SIZE = int(os.getenv("SPOOL_CLAIM_SIZE", 50))  # Jobs a worker takes at once in single mode
+SPOOL_MAX_ATTEMPTS = int(os.getenv("SPOOL_MAX_ATTEMPTS", 6))  # Delivery rounds before a job is dead-lettered
+SPOOL_BACKOFF_BASE_SECONDS = float(os.getenv("SPOOL_BACKOFF_BASE_SECONDS", 30))
+SPOOL_BACKOFF_MAX_SECONDS = float(os.getenv("SPOOL_BACKOFF_MAX_SECONDS", 1800))
+SPOOL_ACCOUNT_PAUSE_SECONDS = float(os.getenv("SPOOL_ACCOUNT_PAUSE_SECONDS", 900))  # Hold sending after Brevo refuses the key/account
+
+# ===== METRICS CONFIGURATION =====
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))  # Prometheus text endpoint, 0 disables it
+METRICS_DUMP_FILE = os.getenv("METRICS_DUMP_FILE", os.path.join(BASE_DIR, "metrics.prom"))  # Written at shutdown
 
 # ===== DISCORD CONFIGURATION =====
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
-DISCORD_GUILD_ID = 1411629709220909078
-DISCORD_CHANNEL_ID = 1412333785776656464
+DISCORD_GUILD_ID = int(os.getenv("DISCORD_GUILD_ID", 1411629709220909078))
+DISCORD_CHANNEL_ID = int(os.getenv("DISCORD_CHANNEL_ID", 1412333785776656464))  # Also receives system notifications
+DISCORD_ALERT_CHANNEL_IDS = [  # Bot channels that receive IPO alerts, across any number of servers
+    int(c) for c in os.getenv("DISCORD_ALERT_CHANNEL_IDS", str(DISCORD_CHANNEL_ID)).split(",") if c.strip()
+]
+DISCORD_WEBHOOK_URLS = [u.strip() for u in os.getenv("DISCORD_WEBHOOK_URLS", "").split(",") if u.strip()]
+DISCORD_CHANNEL_RATE = float(os.getenv("DISCORD_CHANNEL_RATE", 1))  # Messages per second per channel
+DISCORD_CHANNEL_BURST = int(os.getenv("DISCORD_CHANNEL_BURST", 5))  # Discord allows about 5 messages per 5s per channel
+DISCORD_MAX_RETRIES = int(os.getenv("DISCORD_MAX_RETRIES", 3))
+DISCORD_READY_TIMEOUT_SECONDS = float(os.getenv("DISCORD_READY_TIMEOUT_SECONDS", 30))  # Channel sends wait this long for login
 
 # ===== TIMEZONE =====
 NEPAL_TZ = pytz.timezone('Asia/Kathmandu')
@@ -0,0 +1,175 @@
+import os
+import csv
+import math
+import threading
+from datetime import date
+from functools import lru_cache
+from collections import namedtuple
+from config import IPO_HISTORY_FILE, ALLOTMENT_LOT_SIZE, TOTAL_APPS, logger
+
+HISTORY_FIELDS = ["finid", "sector", "shares_offered", "applicants", "open_date"]
+# Listings a sector needs before its own offset counts fully (fewer are shrunk toward the overall fit)
+SECTOR_SHRINKAGE = 5
+MIN_HISTORY = 3
+
+# applicants is the expected number of applications; basis says where it came from
+Estimate = namedtuple("Estimate", ["applicants", "probability", "basis"])
+
+
+@lru_cache(maxsize=1024)
+def parse_date(value):
+    """Date part of a feed timestamp ("YYYY-MM-DD HH:MM:SS"), parsed once per distinct string"""
+    return date.fromisoformat(value.split(" ")[0])
+
+
+def _sector(ipo):
+    return str(ipo.get("Sector") or ipo.get("sector") or "").strip().lower()
+
+
+def _positive(value):
+    try:
+        value = float(str(value).replace(",", ""))
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+class AllotmentEstimator:
+    """Expected applications, and so allotment probability, learned from past IPOs
+
+    log(applicants) is fitted by least squares against log(shares_offered) over all
+    history, plus a per-sector offset that is shrunk toward zero for sectors with few
+    listings. Without enough history it falls back to TOTAL_APPS applicants.
+    Estimates are memoized by (sector, shares_offered) until the model is refitted.
+    """
+    def __init__(self, history_file=IPO_HISTORY_FILE, lot_size=ALLOTMENT_LOT_SIZE, default_applicants=TOTAL_APPS):
+        self.history_file = history_file
+        self.lot_size = max(1, lot_size)
+        self.default_applicants = default_applicants
+        self.history = {}  # finid -> (sector, shares_offered, applicants)
+        self.model = None  # (intercept, slope, {sector: offset})
+        self.memo = {}
+        self.lock = threading.Lock()
+        self._load()
+        self.fit()
+
+    def _load(self):
+        if not self.history_file or not os.path.exists(self.history_file):
+            return
+        try:
+            with open(self.history_file, 'r', encoding='utf-8', newline='') as f:
+                for row in csv.DictReader(f):
+                    shares, applicants = _positive(row.get("shares_offered")), _positive(row.get("applicants"))
+                    if row.get("finid") and shares and applicants:
+                        self.history[row["finid"]] = (_sector(row), shares, applicants)
+            logger.info(f"Loaded {len(self.history)} past IPOs from {self.history_file}")
+        except Exception as e:
+            logger.warning(f"Could not load IPO history {self.history_file}: {e}")
+
+    def fit(self):
+        """Refit the model on the current history and drop memoized estimates"""
+        with self.lock:
+            self.memo.clear()
+            rows = list(self.history.values())
+            if len(rows) < MIN_HISTORY:
+                self.model = None
+                return
+            xs = [math.log(shares) for _, shares, _ in rows]
+            ys = [math.log(applicants) for _, _, applicants in rows]
+            mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+            var_x = sum((x - mean_x) ** 2 for x in xs)
+            slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x if var_x else 0.0
+            intercept = mean_y - slope * mean_x
+
+            residuals = {}
+            for (sector, _, _), x, y in zip(rows, xs, ys):
+                residuals.setdefault(sector, []).append(y - (intercept + slope * x))
+            offsets = {sector: sum(r) / (len(r) + SECTOR_SHRINKAGE) for sector, r in residuals.items()}
+            self.model = (intercept, slope, offsets)
+        logger.info(f"Allotment model fitted on {len(rows)} past IPOs across {len(offsets)} sectors")
+
+    def learn(self, ipos):
+        """Add listings that report their applicant count (e.g. from the results feed) and refit"""
+        added = []
+        with self.lock:
+            for ipo in ipos:
+                finid = ipo.get("finid")
+                shares, applicants = _positive(ipo.get("shares_offered")), _positive(ipo.get("applicants"))
+                if finid is None or not shares or not applicants or str(finid) in self.history:
+                    continue
+                self.history[str(finid)] = (_sector(ipo), shares, applicants)
+                added.append({"finid": finid, "sector": ipo.get("Sector", ""), "shares_offered": int(shares),
+                              "applicants": int(applicants), "open_date": (ipo.get("open_date") or "").split(" ")[0]})
+        if not added:
+            return 0
+        self._append(added)
+        self.fit()
+        return len(added)
+
+    def _append(self, rows):
+        if not self.history_file:
+            return
+        try:
+            is_new = not os.path.exists(self.history_file)
+            with open(self.history_file, 'a', encoding='utf-8', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=HISTORY_FIELDS)
+                if is_new:
+                    writer.writeheader()
+                writer.writerows(rows)
+        except Exception as e:
+            logger.warning(f"Could not append to IPO history {self.history_file}: {e}")
+
+    def estimate_many(self, ipos):
+        """Estimates for a whole cycle's IPOs, computing only the ones not memoized yet"""
+        keys = [(_sector(ipo), _positive(ipo.get("shares_offered")) or 0.0) for ipo in ipos]
+        with self.lock:
+            missing = [key for key in dict.fromkeys(keys) if key not in self.memo]
+            if missing:
+                model = self.model
+                if model is None:
+                    basis = "configured estimate"
+                    applicants = [float(self.default_applicants)] * len(missing)
+                else:
+                    intercept, slope, offsets = model
+                    basis = f"fitted on {len(self.history)} past IPOs"
+                    applicants = [
+                        math.exp(intercept + slope * math.log(shares) + offsets.get(sector, 0.0)) if shares else 1.0
+                        for sector, shares in missing
+                    ]
+                for (sector, shares), expected in zip(missing, applicants):
+                    winners = shares / self.lot_size
+                    probability = min(100.0, winners / expected * 100) if shares else 0.0
+                    self.memo[(sector, shares)] = Estimate(int(round(expected)), probability, basis)
+            return [self.memo[key] for key in keys]
+
+    def estimate(self, ipo):
+        return self.estimate_many([ipo])[0]
+
+
+def _suggestion(prob):
+    if prob < 90:
+        return "10", "Conservative approach recommended due to high demand."
+    return "more than 10", "Higher allocation possible due to favorable probability."
+
+
+def calculate_metrics_many(ipos, as_of):
+    """(rem_days, prob, sug_qty, suggestion) for each IPO, as of a date string or one date per IPO"""
+    dates = [as_of] * len(ipos) if isinstance(as_of, str) else as_of
+    results = []
+    for ipo, estimate, as_of_date in zip(ipos, estimator.estimate_many(ipos), dates):
+        try:
+            if not ipo.get("close_date"):
+                results.append((0, 0, "10", "Unable to calculate metrics - missing close date"))
+                continue
+            rem_days = (parse_date(ipo["close_date"]) - parse_date(as_of_date)).days
+        except (ValueError, TypeError, AttributeError) as e:
+            # One malformed record must not take down the cycle's other metrics
+            logger.error(f"Date parsing error for {ipo.get('company_name', 'Unknown')} ({ipo.get('finid')}): {e}")
+            results.append((0, 0, "10", "Unable to calculate metrics - date error"))
+            continue
+        results.append((rem_days, estimate.probability, *_suggestion(estimate.probability)))
+    return results
+
+
+# Create a global estimator shared by the processor and the templates
+estimator = AllotmentEstimator()
@@ -1,37 +1,424 @@
+import os
+import json
+import time
+import asyncio
+import threading
 import httpx
-from config import ONGOING_URL, logger
+from config import (
+    ONGOING_URL, ONGOING_MIRROR_URLS, IPO_CACHE_TTL_SECONDS, IPO_SNAPSHOT_FILE, UPCOMING_URLS,
+    UPCOMING_CACHE_TTL_SECONDS, UPCOMING_SNAPSHOT_FILE, RESULTS_URLS, RESULTS_CACHE_TTL_SECONDS,
+    RESULTS_SNAPSHOT_FILE, FEED_TIMEOUT_SECONDS,
+    FEED_HEDGE_DELAY_SECONDS, FEED_MERGE_GRACE_SECONDS, FEED_BREAKER_THRESHOLD, FEED_BREAKER_COOLDOWN_SECONDS,
+    logger
+)
+from .http_transport import transport
+from .metrics import metrics
 
+FETCH_SECONDS = metrics.histogram("ipo_fetch_seconds", "IPO feed request latency", ["source", "status"])
+FEED_HEDGES = metrics.counter("ipo_feed_hedges_total", "Feed requests sent to a further source because earlier ones were slow or failed")
+FEED_ONGOING = "ongoing"
+FEED_UPCOMING = "upcoming"
+FEED_RESULTS = "results"
 
-def fetch_ipo_data():
-    """Fetch IPO data from API"""
-    try:
-        with httpx.Client(timeout=30) as client:
-            resp = client.get(ONGOING_URL)
-            resp.raise_for_status()
-            data = resp.json()
-            logger.info(f"Successfully fetched IPO data - {len(data.get('response', []))} IPOs found")
-            return data.get("response", [])
-    except httpx.TimeoutException:
-        logger.error("Timeout while fetching IPO data")
-        return []
-    except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP error while fetching IPO data: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Unexpected error while fetching IPO data: {e}")
+# Alternative field names seen across providers, mapped onto the names the templates use
+FIELD_ALIASES = {
+    "finid": ("finId", "fin_id"),
+    "company_name": ("companyName", "company"),
+    "Sector": ("sector", "sector_name", "sectorName"),
+    "offer_price": ("offerPrice", "price_per_unit"),
+    "open_date": ("openDate", "opening_date"),
+    "close_date": ("closeDate", "closing_date"),
+    "shares_offered": ("sharesOffered", "units_offered"),
+    "issue_manager": ("issueManager",),
+    "applicants": ("totalApplicants", "total_applicants", "applications"),
+}
+NUMERIC_FIELDS = ("offer_price", "shares_offered", "applicants")
+
+BREAKER_OPENS = metrics.counter("ipo_feed_breaker_opens_total", "Times a feed source's circuit breaker opened", ["source"])
+
+
+class CircuitBreaker:
+    """Stops calling a failing upstream for a cool-down, then lets a single trial request through"""
+    def __init__(self, name, threshold=FEED_BREAKER_THRESHOLD, cooldown=FEED_BREAKER_COOLDOWN_SECONDS):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Whether a request may be sent now; in the half-open state only one trial is let through"""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_in_flight or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def release(self):
+        """Give back a trial that ended without an outcome (e.g. cancelled after losing a race)"""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f"Feed source {self.name} recovered, circuit closed")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            was_trial = self.trial_in_flight
+            self.trial_in_flight = False
+            if was_trial or (self.opened_at is None and self.failures >= self.threshold):
+                self.opened_at = time.monotonic()
+                BREAKER_OPENS.inc(source=self.name)
+                logger.warning(f"Feed source {self.name} failed {self.failures} time(s), "
+                               f"skipping it for {self.cooldown:.0f}s")
+
+
+class FeedSource:
+    """One upstream serving the feed schema, with its own validators and circuit breaker"""
+    def __init__(self, url):
+        self.url = url
+        self.name = httpx.URL(url).host or url
+        self.data = None
+        self.etag = None
+        self.last_modified = None
+        self.breaker = CircuitBreaker(self.name)
+
+    def _conditional_headers(self):
+        headers = {}
+        if self.data is not None:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def _parse(self, resp):
+        """Return the IPO list from a response, raising if it is not a valid feed"""
+        if resp.status_code == 304 and self.data is not None:
+            return self.data
+        resp.raise_for_status()
+        data = resp.json().get("response")
+        if not isinstance(data, list):
+            raise ValueError("feed response has no 'response' list")
+        self.data = data
+        self.etag = resp.headers.get("ETag")
+        self.last_modified = resp.headers.get("Last-Modified")
+        return data
+
+    def fetch(self, timeout):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            resp = transport.get(self.url, headers=self._conditional_headers(), timeout=timeout)
+            status = str(resp.status_code)
+            data = self._parse(resp)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        finally:
+            FETCH_SECONDS.observe(time.perf_counter() - start, source=self.name, status=status)
+        self.breaker.record_success()
+        return data
+
+    async def fetch_async(self, timeout):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            resp = await transport.aget(self.url, headers=self._conditional_headers(), timeout=timeout)
+            status = str(resp.status_code)
+            data = self._parse(resp)
+        except asyncio.CancelledError:
+            status = "cancelled"
+            self.breaker.release()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        finally:
+            FETCH_SECONDS.observe(time.perf_counter() - start, source=self.name, status=status)
+        self.breaker.record_success()
+        return data
+
+
+def merge_by_finid(responses):
+    """Union of several feed responses, in priority order; the first source to list a finid wins"""
+    merged, seen = [], set()
+    for data in responses:
+        for ipo in data:
+            finid = ipo.get("finid") if isinstance(ipo, dict) else None
+            if finid is None:
+                continue
+            if finid not in seen:
+                seen.add(finid)
+                merged.append(ipo)
+    return merged
+
+
+class CachedFeed:
+    """IPO feed served by one or more same-schema sources
+
+    Async fetches are hedged: the first source is asked, and each further source is
+    added after `hedge_delay` (or at once when a request fails). The first valid
+    response wins; others that arrive within `merge_grace` are merged in by finid.
+    Sources whose circuit breaker is open are skipped. Results are reused for the TTL
+    and the last good result is kept on disk as a fallback.
+    """
+    def __init__(self, urls, snapshot_file=None, ttl=IPO_CACHE_TTL_SECONDS, timeout=FEED_TIMEOUT_SECONDS,
+                 hedge_delay=FEED_HEDGE_DELAY_SECONDS, merge_grace=FEED_MERGE_GRACE_SECONDS, name=FEED_ONGOING):
+        self.name = name
+        self.sources = [FeedSource(url) for url in ([urls] if isinstance(urls, str) else urls) if url]
+        self.snapshot_file = snapshot_file
+        self.ttl = ttl
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.merge_grace = merge_grace
+        self.data = None
+        self.fetched_at = 0.0
+        self.last_fetch_ok = False
+        self.lock = threading.Lock()
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        """Load the last good snapshot from disk (treated as stale)"""
+        if not self.snapshot_file or not os.path.exists(self.snapshot_file):
+            return
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self.data = snapshot.get("response", [])
+            logger.info(f"Loaded {self.name} IPO snapshot from disk - {len(self.data)} IPOs")
+        except Exception as e:
+            logger.warning(f"Could not load IPO snapshot {self.snapshot_file}: {e}")
+
+    def _save_snapshot(self):
+        """Persist the current snapshot atomically"""
+        if not self.snapshot_file:
+            return
+        try:
+            tmp_file = f"{self.snapshot_file}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({"response": self.data, "saved_at": time.time()}, f)
+            os.replace(tmp_file, self.snapshot_file)
+        except Exception as e:
+            logger.warning(f"Could not save IPO snapshot {self.snapshot_file}: {e}")
+
+    def _fallback(self):
+        """Return the last good snapshot, if any, after every source failed"""
+        self.last_fetch_ok = False
+        if self.data is not None:
+            logger.warning(f"Serving last good {self.name} IPO snapshot ({len(self.data)} IPOs)")
+            return self.data
         return []
 
+    def _is_fresh(self, force):
+        return not force and self.data is not None and time.monotonic() - self.fetched_at < self.ttl
+
+    def _log_error(self, source, e):
+        if isinstance(e, httpx.TimeoutException):
+            logger.error(f"Timeout while fetching {self.name} IPO data from {source.name}")
+        elif isinstance(e, httpx.HTTPStatusError):
+            logger.error(f"HTTP error while fetching {self.name} IPO data from {source.name}: {e}")
+        else:
+            logger.error(f"Unexpected error while fetching {self.name} IPO data from {source.name}: {e}")
+
+    def _accept(self, responses):
+        """Store a successful (possibly merged) result and return it"""
+        data = responses[0] if len(responses) == 1 else merge_by_finid(responses)
+        changed = data != self.data
+        self.data = data
+        self.fetched_at = time.monotonic()
+        self.last_fetch_ok = True
+        if changed:
+            self._save_snapshot()
+            logger.info(f"Successfully fetched {self.name} IPO data - {len(data)} IPOs found")
+        else:
+            logger.info(f"{self.name.capitalize()} IPO data not modified - {len(data)} IPOs")
+        return data
+
+    def fetch(self, force=False):
+        """Return the feed, trying the sources in order; the network is only hit after the TTL"""
+        with self.lock:
+            if self._is_fresh(force):
+                logger.info(f"Using cached {self.name} IPO data - {len(self.data)} IPOs")
+                return self.data
+            for source in self.sources:
+                if not source.breaker.allow():
+                    continue
+                try:
+                    return self._accept([source.fetch(self.timeout)])
+                except Exception as e:
+                    self._log_error(source, e)
+            return self._fallback()
+
+    async def fetch_async(self, force=False):
+        """Hedged fetch across the sources for callers running on the event loop"""
+        if self._is_fresh(force):
+            logger.info(f"Using cached {self.name} IPO data - {len(self.data)} IPOs")
+            return self.data
+
+        candidates = iter(self.sources)
+        tasks = {}  # task -> source index, so merged results keep source priority
+        responses = {}
+        grace_until = None
+
+        def launch():
+            for source in candidates:
+                if source.breaker.allow():
+                    tasks[asyncio.create_task(source.fetch_async(self.timeout))] = self.sources.index(source)
+                    return True
+            return False
+
+        launch()
+        try:
+            while tasks:
+                if grace_until is None:
+                    wait = self.hedge_delay
+                else:
+                    wait = grace_until - time.monotonic()
+                    if wait <= 0:
+                        break
+                done, _ = await asyncio.wait(tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                failed = False
+                for task in done:
+                    index = tasks.pop(task)
+                    if task.exception() is None:
+                        responses[index] = task.result()
+                        if grace_until is None:
+                            grace_until = time.monotonic() + self.merge_grace
+                    else:
+                        failed = True
+                        self._log_error(self.sources[index], task.exception())
+                if grace_until is None and (failed or not done) and launch():
+                    # The request in flight is slow or one just failed: race the next source
+                    FEED_HEDGES.inc()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if not responses:
+            return self._fallback()
+        return self._accept([responses[index] for index in sorted(responses)])
+
+
+def _number(value):
+    """Feeds disagree on whether counts and prices are numbers or strings"""
+    if isinstance(value, str):
+        try:
+            number = float(value.replace(",", ""))
+        except ValueError:
+            return value
+        return int(number) if number.is_integer() else number
+    return value
+
+
+def normalize_ipo(record, feed):
+    """Map one feed record onto the bot's IPO model, keeping any extra fields
+
+    `feed` records which feed listed it (ongoing, upcoming or results).
+    """
+    ipo = dict(record)
+    for field, aliases in FIELD_ALIASES.items():
+        if ipo.get(field) is None:
+            for alias in aliases:
+                if record.get(alias) is not None:
+                    ipo[field] = record[alias]
+                    break
+    for field in NUMERIC_FIELDS:
+        if field in ipo:
+            ipo[field] = _number(ipo[field])
+    ipo["feed"] = feed
+    return ipo
+
+
+class IPOFeeds:
+    """The configured feeds (ongoing, upcoming, results) fetched concurrently into one IPO list
+
+    Each feed keeps its own TTL cache, so slow-changing feeds are only re-fetched when
+    their TTL runs out. A listing present in several feeds is merged by finid: fields
+    come from the feed listed first (ongoing, then upcoming, then results), and fields
+    only the others carry, such as allotment results, are kept.
+    """
+    def __init__(self, feeds):
+        self.feeds = feeds
+        self.normalized = {}
+
+    @property
+    def primary(self):
+        return self.feeds[0]
+
+    def _normalize(self, feed, data):
+        # Feeds served from cache return the same list object, so reuse its normalized form
+        cached = self.normalized.get(feed.name)
+        if cached is not None and cached[0] is data:
+            return cached[1]
+        normalized = [normalize_ipo(record, feed.name) for record in data if isinstance(record, dict)]
+        self.normalized[feed.name] = (data, normalized)
+        return normalized
+
+    def _combine(self, results):
+        merged = {}
+        for feed, data in zip(self.feeds, results):
+            for ipo in self._normalize(feed, data):
+                finid = ipo.get("finid")
+                if finid is None:
+                    continue
+                listed = merged.get(finid)
+                # Feeds earlier in the list win; later ones only fill in missing fields
+                merged[finid] = {**ipo, **listed} if listed else ipo
+        return list(merged.values())
+
+    def fetch(self, force=False):
+        return self._combine([feed.fetch(force) for feed in self.feeds])
+
+    async def fetch_async(self, force=False):
+        return self._combine(await asyncio.gather(*(feed.fetch_async(force) for feed in self.feeds)))
+
+
+ongoing_feed = CachedFeed([ONGOING_URL, *ONGOING_MIRROR_URLS], IPO_SNAPSHOT_FILE)
+ipo_feeds = IPOFeeds([ongoing_feed] + [
+    CachedFeed(urls, snapshot_file, ttl=ttl, name=name)
+    for name, urls, snapshot_file, ttl in (
+        (FEED_UPCOMING, UPCOMING_URLS, UPCOMING_SNAPSHOT_FILE, UPCOMING_CACHE_TTL_SECONDS),
+        (FEED_RESULTS, RESULTS_URLS, RESULTS_SNAPSHOT_FILE, RESULTS_CACHE_TTL_SECONDS),
+    )
+    if urls
+])
+
+
+def fetch_ipo_data(force=False):
+    """Fetch IPO data from every configured feed"""
+    return ipo_feeds.fetch(force)
+
+
+async def fetch_ipo_data_async(force=False):
+    """Fetch IPO data from every configured feed concurrently without blocking the event loop"""
+    return await ipo_feeds.fetch_async(force)
+
 
-def test_api_connection():
-    """Test API connectivity"""
+async def test_api_connection():
+    """Test API connectivity; the fetch also warms the feed caches and pools for the first poll"""
     try:
-        ipo_data = fetch_ipo_data()
-        if ipo_data:
+        ipo_data = await fetch_ipo_data_async(force=True)
+        if ipo_data and ongoing_feed.last_fetch_ok:
             logger.info(f"✓ API connection successful - {len(ipo_data)} IPOs found")
+            for feed in ipo_feeds.feeds[1:]:
+                if not feed.last_fetch_ok:
+                    logger.warning(f"✗ {feed.name.capitalize()} feed unavailable, continuing without it")
             return True
         else:
             logger.warning("✗ API connection failed or no data")
             return False
     except Exception as e:
         logger.error(f"✗ API test failed: {e}")
-        return False
\ No newline at end of file
+        return False
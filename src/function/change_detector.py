@@ -0,0 +1,127 @@
+import os
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta
+from config import IPO_INDEX_FILE, logger
+
+NEW_LISTING = "new_listing"
+OPENS_TODAY = "opens_today"
+CLOSING_TOMORROW = "closing_tomorrow"
+DATES_EXTENDED = "dates_extended"
+DATES_CHANGED = "dates_changed"
+PRICE_CHANGED = "price_changed"
+SHARES_CHANGED = "shares_changed"
+
+# previous is the indexed record before this fetch (None for new listings)
+IPOEvent = namedtuple("IPOEvent", ["type", "finid", "ipo", "previous"])
+
+
+def _date_part(value):
+    return value.split(" ")[0] if value else None
+
+
+def _index_record(ipo):
+    """Keep only the fields we diff on"""
+    return {
+        "company_name": ipo.get("company_name"),
+        "open_date": _date_part(ipo.get("open_date")),
+        "close_date": _date_part(ipo.get("close_date")),
+        "offer_price": ipo.get("offer_price"),
+        "shares_offered": ipo.get("shares_offered"),
+    }
+
+
+class ChangeDetector:
+    """Snapshot index keyed by finid that turns each fetch into a list of typed events"""
+    def __init__(self, snapshot_file=IPO_INDEX_FILE):
+        self.snapshot_file = snapshot_file
+        self.index = {}
+        self.emitted = set()
+        self.has_snapshot = False
+        self._pending = None
+        self._load()
+
+    def _load(self):
+        if not self.snapshot_file or not os.path.exists(self.snapshot_file):
+            return
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self.index = snapshot.get("index", {})
+            self.emitted = set(snapshot.get("emitted", []))
+            self.has_snapshot = True
+            logger.info(f"Loaded IPO index with {len(self.index)} listings")
+        except Exception as e:
+            logger.warning(f"Could not load IPO index {self.snapshot_file}: {e}")
+
+    def _save(self):
+        if not self.snapshot_file:
+            return
+        try:
+            tmp_file = f"{self.snapshot_file}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({"index": self.index, "emitted": sorted(self.emitted)}, f)
+            os.replace(tmp_file, self.snapshot_file)
+        except Exception as e:
+            logger.warning(f"Could not save IPO index {self.snapshot_file}: {e}")
+
+    def diff(self, ipo_data, today_str):
+        """Compare a fetch with the previous snapshot and return the events it produces
+
+        The new snapshot is only persisted by commit(), so events from a cycle that
+        crashes half way are produced again after a restart.
+        """
+        tomorrow_str = (datetime.strptime(today_str, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        events = []
+        index = {}
+        # Once-per-day events are only remembered for dates that can still matter
+        emitted = {key for key in self.emitted if key.rsplit(":", 1)[-1] >= today_str}
+
+        def once(event_type, finid, ipo, previous, date):
+            key = f"{event_type}:{finid}:{date}"
+            if key not in emitted:
+                emitted.add(key)
+                events.append(IPOEvent(event_type, finid, ipo, previous))
+
+        for ipo in ipo_data:
+            finid = ipo.get("finid")
+            if finid is None:
+                continue
+            finid = str(finid)
+            record = _index_record(ipo)
+            previous = self.index.get(finid)
+            index[finid] = record
+
+            if previous is None:
+                if self.has_snapshot:
+                    events.append(IPOEvent(NEW_LISTING, finid, ipo, None))
+            else:
+                if (record["open_date"], record["close_date"]) != (previous["open_date"], previous["close_date"]):
+                    extended = (record["close_date"] or "") > (previous["close_date"] or "")
+                    events.append(IPOEvent(DATES_EXTENDED if extended else DATES_CHANGED, finid, ipo, previous))
+                if record["offer_price"] != previous["offer_price"]:
+                    events.append(IPOEvent(PRICE_CHANGED, finid, ipo, previous))
+                if record["shares_offered"] != previous["shares_offered"]:
+                    events.append(IPOEvent(SHARES_CHANGED, finid, ipo, previous))
+
+            if record["open_date"] == today_str:
+                once(OPENS_TODAY, finid, ipo, previous, today_str)
+            if record["close_date"] == tomorrow_str and (record["open_date"] or "") <= today_str:
+                once(CLOSING_TOMORROW, finid, ipo, previous, tomorrow_str)
+
+        self._pending = (index, emitted)
+        return events
+
+    def forget(self, event, date):
+        """Drop a once-per-day event from the pending baseline so the next cycle emits it again"""
+        if self._pending is not None:
+            self._pending[1].discard(f"{event.type}:{event.finid}:{date}")
+
+    def commit(self):
+        """Make the last diff() the new baseline and persist it"""
+        if self._pending is None:
+            return
+        self.index, self.emitted = self._pending
+        self._pending = None
+        self.has_snapshot = True
+        self._save()
@@ -0,0 +1,85 @@
+import sqlite3
+import threading
+import time
+from config import LEDGER_DB_FILE, logger
+
+
+class DeliveryLedger:
+    """Persistent per-recipient delivery state stored in a WAL-mode SQLite file"""
+    def __init__(self, path=LEDGER_DB_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS deliveries (
+                finid TEXT NOT NULL,
+                open_date TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (finid, open_date, channel, recipient)
+            ) WITHOUT ROWID
+        """)
+        self.conn.commit()
+
+    def record_many(self, finid, open_date, channel, results):
+        """Record a batch of send results (dicts with email or recipient/success/attempts) in one transaction"""
+        now = time.time()
+        rows = [
+            (str(finid), open_date, r.get("recipient") or r["email"], channel, "sent" if r["success"] else "failed",
+             r.get("attempts", 0), now)
+            for r in results
+        ]
+        if not rows:
+            return
+        with self.lock:
+            # Never downgrade a recipient that was already delivered
+            self.conn.executemany("""
+                INSERT INTO deliveries (finid, open_date, recipient, channel, status, attempts, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (finid, open_date, channel, recipient) DO UPDATE SET
+                    status = CASE WHEN deliveries.status = 'sent' THEN 'sent' ELSE excluded.status END,
+                    attempts = deliveries.attempts + excluded.attempts,
+                    updated_at = excluded.updated_at
+            """, rows)
+            self.conn.commit()
+
+    def delivered_recipients(self, finid, open_date, channel):
+        """Return the set of recipients already delivered for this IPO and channel"""
+        with self.lock:
+            cursor = self.conn.execute(
+                "SELECT recipient FROM deliveries WHERE finid = ? AND open_date = ? AND channel = ? AND status = 'sent'",
+                (str(finid), open_date, channel)
+            )
+            return {row[0] for row in cursor}
+
+    def pending_recipients(self, finid, open_date, channel, recipients):
+        """Return recipients (in original order) that have not been delivered yet"""
+        delivered = self.delivered_recipients(finid, open_date, channel)
+        if not delivered:
+            return list(recipients)
+        return [r for r in recipients if r not in delivered]
+
+    def filter_pending(self, finid, open_date, channel, recipients):
+        """Lazily yield recipients that have not been delivered yet, for streamed recipient sets"""
+        delivered = self.delivered_recipients(finid, open_date, channel)
+        return (r for r in recipients if r not in delivered)
+
+    def prune(self, days=30):
+        """Delete entries older than the given number of days"""
+        cutoff = time.time() - days * 86400
+        with self.lock:
+            deleted = self.conn.execute("DELETE FROM deliveries WHERE updated_at < ?", (cutoff,)).rowcount
+            self.conn.commit()
+        if deleted:
+            logger.info(f"Pruned {deleted} old delivery ledger entries")
+
+    def close(self):
+        """Close the underlying database connection"""
+        with self.lock:
+            self.conn.close()
+
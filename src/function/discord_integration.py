@@ -1,25 +1,93 @@
+import json
+import time
 import asyncio
-import discord
-from discord.ext import commands
-from config import DISCORD_TOKEN, DISCORD_GUILD_ID, DISCORD_CHANNEL_ID, TOTAL_APPS, logger
+import hashlib
+import importlib
+import httpx
+from config import (
+    DISCORD_TOKEN, DISCORD_GUILD_ID, DISCORD_CHANNEL_ID, DISCORD_ALERT_CHANNEL_IDS, DISCORD_WEBHOOK_URLS,
+    DISCORD_CHANNEL_RATE, DISCORD_CHANNEL_BURST, DISCORD_MAX_RETRIES, DISCORD_READY_TIMEOUT_SECONDS,
+    logger
+)
 from utils import get_nepal_time
+from .render_cache import render_cache, ipo_cache_key
+from .email_service import TokenBucket
+from .http_transport import transport
+from .allotment_estimator import estimator
+from .change_detector import CLOSING_TOMORROW
+from .reminder_scheduler import PRE_OPEN, DAY_BEFORE_CLOSE, CLOSING_DAY
+from .metrics import metrics
+
+DISCORD_SEND_SECONDS = metrics.histogram("discord_send_seconds", "Discord message send latency", ["kind", "status"])
+
+# Discord accepts at most 10 embeds and 6000 embed characters per message
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
+MAX_FIELDS_PER_EMBED = 25
+
+# Status shown next to each IPO in a digest, by event or reminder type (default: now open)
+DIGEST_STATUS = {
+    CLOSING_TOMORROW: "⏳ closes tomorrow",
+    PRE_OPEN: "📆 opens tomorrow",
+    DAY_BEFORE_CLOSE: "⏳ closes tomorrow",
+    CLOSING_DAY: "🚨 closes today",
+}
+
+
+def _retry_after(error, default):
+    """Seconds Discord asked us to wait after a 429 (from an exception or a webhook response)"""
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is None:
+        headers = getattr(error, "headers", None) or getattr(getattr(error, "response", None), "headers", None) or {}
+        retry_after = headers.get("Retry-After")
+    try:
+        return max(0.0, float(retry_after))
+    except (TypeError, ValueError):
+        return default
+
+
+def _pack_embeds(indices, embeds):
+    """Group alert indices into messages that respect Discord's per-message embed limits"""
+    batch, size = [], 0
+    for i in indices:
+        if batch and (len(batch) >= MAX_EMBEDS_PER_MESSAGE or size + len(embeds[i]) > MAX_EMBED_CHARS_PER_MESSAGE):
+            yield tuple(batch)
+            batch, size = [], 0
+        batch.append(i)
+        size += len(embeds[i])
+    if batch:
+        yield tuple(batch)
+
+
+def webhook_target(url):
+    """Ledger-safe key for a webhook; the URL itself embeds a secret token"""
+    return "webhook:" + hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
 
 
 class DiscordBot:
+    """Discord bot and webhook delivery
+
+    discord.py is imported on first use (about a third of a second), so a deployment
+    without Discord never loads it and one with Discord does not pay for it before startup.
+    """
     def __init__(self):
-        intents = discord.Intents.default()
-        intents.message_content = True
-        self.bot = commands.Bot(command_prefix='!', intents=intents)
+        self.bot = None
         self.ready = False
+        self.connecting = False
+        self.ready_event = asyncio.Event()
         self.loop = None
-        
-        self._setup_events()
+        self.channels = {}
+        self.limiters = {}
+        self.webhooks = {webhook_target(url): url for url in DISCORD_WEBHOOK_URLS}
 
     def _setup_events(self):
         @self.bot.event
         async def on_ready():
             self.ready = True
+            self.connecting = False
             self.loop = asyncio.get_running_loop()
+            self.channels.clear()
+            self.ready_event.set()
             logger.info(f'Discord bot logged in as {self.bot.user}')
             
             # Check if bot is in the specified guild
@@ -27,17 +95,21 @@ class DiscordBot:
             if guild:
                 logger.info(f'Bot is in guild: {guild.name} (Members: {guild.member_count})')
                 
-                # Check if channel exists
-                channel = self.bot.get_channel(DISCORD_CHANNEL_ID)
+            else:
+                logger.warning(f'Bot is not in guild {DISCORD_GUILD_ID}')
+            
+            # Check that the alert channels exist (they may live in other servers)
+            for channel_id in DISCORD_ALERT_CHANNEL_IDS:
+                channel = self.bot.get_channel(channel_id)
                 if channel:
                     logger.info(f'Target channel found: #{channel.name}')
                 else:
-                    logger.warning(f'Target channel {DISCORD_CHANNEL_ID} not found')
-            else:
-                logger.warning(f'Bot is not in guild {DISCORD_GUILD_ID}')
+                    logger.warning(f'Target channel {channel_id} not found')
 
     async def create_ipo_embed(self, ipo, rem_days, prob, sug_qty, suggestion):
         """Create Discord embed for IPO alert"""
+        import discord
+        estimate = estimator.estimate(ipo)
         
         # Determine color based on probability
         if prob >= 50:
@@ -102,7 +174,7 @@ class DiscordBot:
         
         # Add footer
         embed.set_footer(
-            text=f"Based on estimated {TOTAL_APPS:,} total applications • Nepal Time",
+            text=f"Based on estimated {estimate.applicants:,} total applications ({estimate.basis}) • Nepal Time",
             icon_url="https://cdn.discordapp.com/attachments/123456789/chart_icon.png"
         )
         
@@ -111,40 +183,260 @@ class DiscordBot:
         
         return embed
 
-    async def send_ipo_alert(self, ipo, rem_days, prob, sug_qty, suggestion):
-        """Send Discord alert to the specified channel"""
-        try:
-            if not self.ready:
-                logger.warning("Discord bot not ready, skipping Discord alert")
-                return False
-            
-            channel = self.bot.get_channel(DISCORD_CHANNEL_ID)
-            if not channel:
-                logger.error(f"Discord channel {DISCORD_CHANNEL_ID} not found")
-                return False
-            
+    async def get_ipo_embed(self, ipo, rem_days, prob, sug_qty, suggestion):
+        """Return the IPO embed, building it once per distinct IPO and metrics"""
+        key = ipo_cache_key(ipo, rem_days, prob, sug_qty, suggestion)
+        cached = render_cache.get("embed", key)
+        if cached is not None:
+            import discord
+            embed = discord.Embed.from_dict(json.loads(cached))
+        else:
             embed = await self.create_ipo_embed(ipo, rem_days, prob, sug_qty, suggestion)
-            
-            # Add @everyone mention for important IPO alerts
-            content = "🔔 **IPO ALERT** @everyone" if rem_days <= 3 else "🔔 **IPO ALERT**"
-            
-            await channel.send(content=content, embed=embed)
-            logger.info(f"Discord alert sent for {ipo['company_name']} to #{channel.name}")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Error sending Discord alert for {ipo.get('company_name', 'Unknown')}: {e}")
+            render_cache.put("embed", key, json.dumps(embed.to_dict()))
+        # The cached copy may be days old, so the timestamp is always the send time
+        embed.timestamp = get_nepal_time()
+        return embed
+
+    async def get_target_channel(self, channel_id):
+        """Resolve a channel once and reuse it, fetching it over the API if it is not cached"""
+        channel = self.channels.get(channel_id)
+        if channel is not None:
+            return channel
+        import discord
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            try:
+                channel = await self.bot.fetch_channel(channel_id)
+            except discord.HTTPException as e:
+                logger.error(f"Discord channel {channel_id} not found: {e}")
+                return None
+        self.channels[channel_id] = channel
+        return channel
+
+    def _limiter(self, channel_id):
+        limiter = self.limiters.get(channel_id)
+        if limiter is None:
+            limiter = self.limiters[channel_id] = TokenBucket(DISCORD_CHANNEL_RATE, capacity=DISCORD_CHANNEL_BURST)
+        return limiter
+
+    async def _send_message(self, channel_id, content=None, embeds=(), max_retries=DISCORD_MAX_RETRIES):
+        """Send one message through the channel's rate limiter, backing off on 429. Returns True on success."""
+        import discord
+        if not self.ready and not await self.wait_until_ready():
+            return False
+        channel = await self.get_target_channel(channel_id)
+        if not channel:
+            return False
+
+        limiter = self._limiter(channel_id)
+        for attempt in range(max_retries + 1):
+            await limiter.acquire()
+            start = time.perf_counter()
+            try:
+                await channel.send(content=content, embeds=list(embeds))
+                DISCORD_SEND_SECONDS.observe(time.perf_counter() - start, kind="channel", status="ok")
+                return True
+            except discord.HTTPException as e:
+                DISCORD_SEND_SECONDS.observe(time.perf_counter() - start, kind="channel", status=e.status)
+                if e.status == 429:
+                    delay = _retry_after(e, default=min(2 ** attempt, 30))
+                    logger.warning(f"Discord rate limit hit on channel {channel_id}, pausing for {delay:.1f}s")
+                    limiter.pause(delay)
+                    continue
+                if e.status >= 500:
+                    await asyncio.sleep(min(2 ** attempt, 30))
+                    continue
+                if e.status == 404:
+                    self.channels.pop(channel_id, None)
+                logger.error(f"Discord rejected message for channel {channel_id}: {e}")
+                return False
+            except discord.RateLimited as e:
+                # Raised instead of waiting when discord.py's own rate limit wait would be too long
+                logger.warning(f"Discord rate limit hit on channel {channel_id}, pausing for {e.retry_after:.1f}s")
+                limiter.pause(e.retry_after)
+        logger.error(f"Giving up on Discord message for channel {channel_id} after {max_retries + 1} attempts")
+        return False
+
+    async def _send_webhook(self, target, body, max_retries=DISCORD_MAX_RETRIES):
+        """POST a pre-serialised message to a webhook through its rate limiter. Returns True on success."""
+        url = self.webhooks[target]
+        limiter = self._limiter(target)
+        for attempt in range(max_retries + 1):
+            await limiter.acquire()
+            start = time.perf_counter()
+            try:
+                res = await transport.apost(url, content=body, headers={"Content-Type": "application/json"}, timeout=10)
+            except httpx.HTTPError as e:
+                DISCORD_SEND_SECONDS.observe(time.perf_counter() - start, kind="webhook", status="error")
+                logger.warning(f"Discord webhook {target} error: {e}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+            DISCORD_SEND_SECONDS.observe(time.perf_counter() - start, kind="webhook", status=res.status_code)
+            if res.status_code < 300:
+                return True
+            if res.status_code == 429:
+                delay = _retry_after(res, default=min(2 ** attempt, 30))
+                logger.warning(f"Discord rate limit hit on {target}, pausing for {delay:.1f}s")
+                limiter.pause(delay)
+                continue
+            if res.status_code >= 500:
+                await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+            logger.error(f"Discord webhook {target} rejected message: {res.status_code} {res.text}")
             return False
+        logger.error(f"Giving up on Discord message for {target} after {max_retries + 1} attempts")
+        return False
+
+    def alert_targets(self):
+        """Targets that can receive alerts: bot channels once logged in or while logging in, webhooks always"""
+        targets = [str(channel_id) for channel_id in DISCORD_ALERT_CHANNEL_IDS] if self.ready or self.connecting else []
+        return targets + list(self.webhooks)
+
+    async def send_ipo_alerts(self, alerts):
+        """Send several IPO alerts to all their targets concurrently
+
+        `alerts` is a list of (ipo, (rem_days, prob, sug_qty, suggestion), targets), where
+        targets defaults to alert_targets(). Each embed is rendered once and each message
+        body once, however many targets share it; every target packs its alerts into as
+        few messages as Discord allows and is rate limited on its own.
+        Returns one {target: delivered} dict per alert.
+        """
+        if not alerts:
+            return []
+        default_targets = self.alert_targets()
+        alert_targets = [targets if targets is not None else default_targets for _, _, targets in alerts]
+        results = [{target: False for target in targets} for targets in alert_targets]
+
+        try:
+            embeds = [await self.get_ipo_embed(ipo, *metrics) for ipo, metrics, _ in alerts]
+        except Exception as e:
+            logger.error(f"Error building Discord alert embeds: {e}")
+            return results
+
+        bodies = {}
+
+        def message(batch):
+            # Add @everyone mention for important IPO alerts
+            urgent = any(alerts[i][1][0] <= 3 for i in batch)
+            return "🔔 **IPO ALERT** @everyone" if urgent else "🔔 **IPO ALERT**"
+
+        def webhook_body(batch):
+            # Webhooks with the same pending alerts share one serialised body
+            body = bodies.get(batch)
+            if body is None:
+                body = bodies[batch] = json.dumps(
+                    {"content": message(batch), "embeds": [embeds[i].to_dict() for i in batch]}
+                ).encode("utf-8")
+            return body
+
+        async def deliver(target, indices):
+            for batch in _pack_embeds(indices, embeds):
+                try:
+                    if target in self.webhooks:
+                        sent = await self._send_webhook(target, webhook_body(batch))
+                    else:
+                        sent = await self._send_message(int(target), message(batch), [embeds[i] for i in batch])
+                except Exception as e:
+                    logger.error(f"Error sending Discord alert to {target}: {e}")
+                    sent = False
+                for i in batch:
+                    results[i][target] = sent
+                if sent:
+                    names = ", ".join(alerts[i][0].get('company_name', 'Unknown') for i in batch)
+                    logger.info(f"Discord alert sent for {names} to {target}")
+
+        by_target = {}
+        for i, targets in enumerate(alert_targets):
+            for target in targets:
+                by_target.setdefault(target, []).append(i)
+        if not by_target:
+            logger.warning("No Discord targets available, skipping Discord alert")
+        await asyncio.gather(*(deliver(target, indices) for target, indices in by_target.items()))
+        return results
+
+    def create_ipo_digest_embeds(self, items, title="IPO Daily Digest"):
+        """Digest embeds with one field per IPO (a second embed only past Discord's 25 fields)
+
+        `items` is a list of (event_type, ipo, (rem_days, prob, sug_qty, suggestion)).
+        """
+        import discord
+        embeds = []
+        for start in range(0, len(items), MAX_FIELDS_PER_EMBED):
+            embed = discord.Embed(
+                title=f"📅 {title}: {len(items)} IPO{'s' if len(items) != 1 else ''}" if not start else None,
+                color=0x667EEA,
+                timestamp=get_nepal_time()
+            )
+            for event_type, ipo, (rem_days, prob, sug_qty, suggestion) in items[start:start + MAX_FIELDS_PER_EMBED]:
+                indicator = "🟢" if prob >= 50 else "🟡" if prob >= 20 else "🔴"
+                status = DIGEST_STATUS.get(event_type, "🚀 now open")
+                embed.add_field(
+                    name=f"{ipo['company_name']} ({ipo['finid']}) • {status}",
+                    value=f"**Sector:** {ipo.get('Sector', 'N/A')} • **Price:** NPR {ipo.get('offer_price', 'N/A')}\n"
+                          f"**Closing:** {ipo['close_date'].split(' ')[0]} ({rem_days} day{'s' if rem_days != 1 else ''} left)\n"
+                          f"**Probability:** {indicator} {prob:.1f}% • **Apply:** {sug_qty} units",
+                    inline=False
+                )
+            embeds.append(embed)
+        embeds[-1].set_footer(text="Probabilities use each issue's estimated total applications • Nepal Time")
+        return embeds
+
+    async def send_ipo_digest(self, items, title="IPO Daily Digest"):
+        """Send each target a single digest message of the IPOs still pending for it
+
+        `items` is a list of (event_type, ipo, metrics, targets). Targets sharing the same
+        pending IPOs share one rendered message. Returns one {target: delivered} dict per item.
+        """
+        results = [{target: False for target in targets} for *_, targets in items]
+        by_target = {}
+        for i, (*_, targets) in enumerate(items):
+            for target in targets:
+                by_target.setdefault(target, []).append(i)
+        if not by_target:
+            return results
+
+        messages = {}
+
+        def message(indices):
+            # Targets with the same pending IPOs share one set of embeds and one serialised body
+            cached = messages.get(indices)
+            if cached is None:
+                embeds = self.create_ipo_digest_embeds([items[i][:3] for i in indices], title)
+                urgent = any(items[i][2][0] <= 3 for i in indices)
+                content = f"📅 **{title.upper()}** @everyone" if urgent else f"📅 **{title.upper()}**"
+                body = json.dumps({"content": content, "embeds": [embed.to_dict() for embed in embeds]}).encode("utf-8")
+                cached = messages[indices] = (content, embeds, body)
+            return cached
+
+        async def deliver(target, indices):
+            try:
+                content, embeds, body = message(indices)
+                if target in self.webhooks:
+                    sent = await self._send_webhook(target, body)
+                else:
+                    sent = await self._send_message(int(target), content, embeds)
+            except Exception as e:
+                logger.error(f"Error sending Discord digest to {target}: {e}")
+                sent = False
+            for i in indices:
+                results[i][target] = sent
+            if sent:
+                logger.info(f"Discord {title} with {len(indices)} IPO(s) sent to {target}")
+
+        await asyncio.gather(*(deliver(target, tuple(indices)) for target, indices in by_target.items()))
+        return results
+
+    async def send_ipo_alert(self, ipo, rem_days, prob, sug_qty, suggestion):
+        """Send Discord alert to every configured target, returning True if all received it"""
+        delivered = (await self.send_ipo_alerts([(ipo, (rem_days, prob, sug_qty, suggestion), None)]))[0]
+        return bool(delivered) and all(delivered.values())
 
     async def send_system_notification(self, title, message, notification_type="info"):
         """Send system notifications to Discord"""
         try:
             if not self.ready:
                 return False
-            
-            channel = self.bot.get_channel(DISCORD_CHANNEL_ID)
-            if not channel:
-                return False
+            import discord
             
             color_map = {
                 "success": 0x4CAF50,  # Green
@@ -172,7 +464,8 @@ class DiscordBot:
             
             embed.set_footer(text="IPO Alert System • Nepal Time")
             
-            await channel.send(embed=embed)
+            if not await self._send_message(DISCORD_CHANNEL_ID, embeds=[embed]):
+                return False
             logger.info(f"Discord system notification sent: {title}")
             return True
             
@@ -180,9 +473,45 @@ class DiscordBot:
             logger.error(f"Error sending Discord system notification: {e}")
             return False
 
-    def start_bot(self):
-        """Start the Discord bot"""
-        asyncio.run(self.bot.start(DISCORD_TOKEN))
+    async def start(self):
+        """Run the Discord bot on the current event loop until it is closed"""
+        if not DISCORD_TOKEN:
+            logger.warning("DISCORD_TOKEN not set, Discord alerts disabled")
+            return
+        self.connecting = True
+        try:
+            # Import in a worker thread so startup checks keep running on the loop meanwhile
+            await asyncio.to_thread(importlib.import_module, "discord.ext.commands")
+            import discord
+            from discord.ext import commands
+            intents = discord.Intents.default()
+            intents.message_content = True
+            self.bot = commands.Bot(command_prefix='!', intents=intents)
+            self._setup_events()
+            await self.bot.start(DISCORD_TOKEN)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Discord bot error: {e}")
+        finally:
+            self.connecting = False
+            # Release anyone waiting for a login that is not going to happen
+            self.ready_event.set()
+
+    async def wait_until_ready(self, timeout=DISCORD_READY_TIMEOUT_SECONDS):
+        """Wait for the on_ready event, returning False on timeout or if login failed"""
+        if self.ready:
+            return True
+        if not self.connecting:
+            return False
+        try:
+            await asyncio.wait_for(self.ready_event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Discord bot failed to start within timeout")
+            return False
+        if self.ready:
+            logger.info("Discord bot is ready!")
+        return self.ready
 
     def is_ready(self):
         """Check if Discord bot is ready"""
@@ -194,7 +523,8 @@ class DiscordBot:
 
     async def close(self):
         """Close the Discord bot"""
-        if not self.bot.is_closed():
+        self.ready = False
+        if self.bot is not None and not self.bot.is_closed():
             await self.bot.close()
 
 
@@ -1,62 +1,293 @@
+import json
 import time
-import threading
+import asyncio
+from email.utils import parsedate_to_datetime
 import httpx
-from config import API_KEY, FROM_NAME, FROM_EMAIL, logger
+from config import (
+    API_KEY, FROM_NAME, FROM_EMAIL, EMAIL_MAX_RETRIES, BREVO_API_URL, BREVO_ACCOUNT_URL, LOG_SUCCESS_SAMPLE_EVERY, logger
+)
+from log_config import Sampler, recipient_hash
+from .http_transport import transport
+from .skeleton_template import slot, compile_json
+from .metrics import metrics
+
+EMAIL_REQUEST_SECONDS = metrics.histogram("email_request_seconds", "Brevo send request latency", ["mode", "status"])
+EMAILS_TOTAL = metrics.counter("emails_total", "Email send outcomes (a spooled retry counts once per round)", ["result"])
+
+BREVO_SMTP_URL = BREVO_API_URL
+BREVO_HEADERS = {"api-key": API_KEY, "Content-Type": "application/json"}
+
+# Per-recipient success lines are sampled; totals come from EMAILS_TOTAL and the summary logs
+_log_success = Sampler(LOG_SUCCESS_SAMPLE_EVERY)
+
+
+def _build_payload(email, subject, content):
+    """Build the Brevo transactional email payload for a single recipient"""
+    return {
+        "sender": {"name": FROM_NAME, "email": FROM_EMAIL},
+        "to": [{"email": email}],
+        "subject": subject,
+        "htmlContent": content
+    }
+
+
+def _build_batch_payload(emails, subject, content):
+    """Build a Brevo payload that sends the same content to many recipients via messageVersions"""
+    return {
+        "sender": {"name": FROM_NAME, "email": FROM_EMAIL},
+        "subject": subject,
+        "htmlContent": content,
+        "messageVersions": [{"to": [{"email": email}]} for email in emails]
+    }
+
+
+class PersonalizedContent:
+    """Per-recipient Brevo request bodies compiled once from an HTML skeleton with slot() markers
+
+    values_for(email) returns the slot values for a recipient; each body is then a byte join.
+    """
+    def __init__(self, subject, html_skeleton, values_for, default_values):
+        self.values_for = values_for
+        self.single = compile_json(_build_payload(slot("email"), subject, html_skeleton))
+        self.version = compile_json({"to": [{"email": slot("email")}], "htmlContent": html_skeleton})
+        # Brevo still wants top-level content in batch mode; versions override it per recipient
+        default_html = self.version.render(default_values)
+        head = json.dumps({
+            "sender": {"name": FROM_NAME, "email": FROM_EMAIL},
+            "subject": subject,
+            "htmlContent": json.loads(default_html)["htmlContent"]
+        }, ensure_ascii=False, separators=(",", ":"))
+        self.batch_head = (head[:-1] + ',"messageVersions":[').encode("utf-8")
+
+    def single_body(self, email):
+        return self.single.render(self.values_for(email))
+
+    def batch_body(self, emails):
+        versions = b",".join(self.version.render(self.values_for(email)) for email in emails)
+        return b"".join((self.batch_head, versions, b"]}"))
 
 
 def send_email(email, subject, content, is_system_notification=False):
     """Send email via Brevo API (thread safe)"""
     try:
-        res = httpx.post(
-            "https://api.brevo.com/v3/smtp/email",
-            headers={
-                "api-key": API_KEY,
-                "Content-Type": "application/json"
-            },
-            json={
-                "sender": {"name": FROM_NAME, "email": FROM_EMAIL},
-                "to": [{"email": email}],
-                "subject": subject,
-                "htmlContent": content
-            },
+        res = transport.post(
+            BREVO_SMTP_URL,
+            headers=BREVO_HEADERS,
+            json=_build_payload(email, subject, content),
             timeout=10
         )
         if res.status_code != 201:
-            logger.error(f"Failed to send email to {email}: {res.text}")
+            logger.error(f"Failed to send email to {recipient_hash(email)}: {res.text}")
             return False
         else:
             email_type = "system notification" if is_system_notification else "IPO alert"
-            logger.info(f"Email sent successfully to {email} ({email_type})")
+            logger.info(f"Email sent successfully to {recipient_hash(email)} ({email_type})")
             return True
     except Exception as e:
-        logger.error(f"Error sending email to {email}: {e}")
+        logger.error(f"Error sending email to {recipient_hash(email)}: {e}")
         return False
 
 
-def send_email_async(email, subject, content, is_system_notification=False):
-    """Send email asynchronously"""
-    threading.Thread(
-        target=send_email, 
-        args=(email, subject, content, is_system_notification)
-    ).start()
-
-
-def send_bulk_emails(emails, subject, content):
-    """Send emails to multiple recipients"""
-    if not emails:
-        logger.warning("No email addresses to send to")
-        return 0
-    
-    successful_sends = 0
-    for email in emails:
-        if send_email(email, subject, content):
-            successful_sends += 1
-        time.sleep(0.5)  # Small delay to avoid rate limiting
-    
-    logger.info(f"Bulk email sent: {successful_sends}/{len(emails)} successful")
-    return successful_sends
-
-
-def send_bulk_emails_async(emails, subject, content):
-    """Send bulk emails asynchronously"""
-    threading.Thread(target=send_bulk_emails, args=(emails, subject, content)).start()
\ No newline at end of file
+async def check_brevo_access():
+    """Check that Brevo is reachable and accepts the API key, without sending an email
+
+    Reads the account endpoint; any answer other than 401/403 counts as success. The
+    request also opens the pooled connection the first alert sends will reuse.
+    """
+    try:
+        res = await transport.aget(BREVO_ACCOUNT_URL, headers=BREVO_HEADERS, timeout=10)
+    except httpx.HTTPError as e:
+        logger.error(f"✗ Brevo is unreachable: {e}")
+        return False
+    if res.status_code in (401, 403):
+        logger.error(f"✗ Brevo rejected the API key ({res.status_code})")
+        return False
+    logger.info("✓ Brevo reachable, API key accepted")
+    return True
+
+
+class TokenBucket:
+    """Async token bucket that paces requests and can be paused on 429 responses"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Stop handing out tokens for the given number of seconds"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def _get_retry_after(res, default=1.0):
+    """Read the wait time from Retry-After (seconds or HTTP date) or Brevo's reset header"""
+    value = res.headers.get("Retry-After") or res.headers.get("x-sib-ratelimit-reset")
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+async def _send_email_pooled(limiter, email, subject, content, max_retries, finid=None):
+    """Send one email over the shared Brevo pool, retrying on 429 and transport errors"""
+    result = {"email": email, "success": False, "status_code": None, "error": None, "attempts": 0}
+    if isinstance(content, PersonalizedContent):
+        request = {"content": content.single_body(email)}
+    else:
+        request = {"json": _build_payload(email, subject, content)}
+
+    for attempt in range(max_retries + 1):
+        await limiter.acquire()
+        result["attempts"] = attempt + 1
+        start = time.perf_counter()
+        try:
+            res = await transport.apost(BREVO_SMTP_URL, headers=BREVO_HEADERS, timeout=10, **request)
+        except httpx.HTTPError as e:
+            EMAIL_REQUEST_SECONDS.observe(time.perf_counter() - start, mode="single", status="error")
+            result["error"] = str(e) or e.__class__.__name__
+            await asyncio.sleep(min(2 ** attempt, 30))
+            continue
+
+        elapsed = time.perf_counter() - start
+        EMAIL_REQUEST_SECONDS.observe(elapsed, mode="single", status=res.status_code)
+        result["status_code"] = res.status_code
+        if res.status_code == 201:
+            result["success"] = True
+            result["error"] = None
+            if _log_success():
+                rh = recipient_hash(email)
+                logger.info(f"Email sent successfully to {rh} (IPO alert, 1 in {_log_success.every} logged)",
+                            extra={"finid": finid, "recipient_hash": rh, "latency_ms": round(elapsed * 1000, 1)})
+            return result
+
+        result["error"] = res.text
+        if res.status_code == 429:
+            delay = _get_retry_after(res, default=min(2 ** attempt, 30))
+            logger.warning(f"Brevo rate limit hit, pausing sends for {delay:.1f}s")
+            limiter.pause(delay)
+            continue
+        if res.status_code >= 500:
+            await asyncio.sleep(min(2 ** attempt, 30))
+            continue
+        break
+
+    rh = recipient_hash(email)
+    logger.error(f"Failed to send email to {rh}: {result['error']}",
+                 extra={"finid": finid, "recipient_hash": rh, "status_code": result["status_code"]})
+    return result
+
+
+async def _send_batch_pooled(limiter, emails, subject, content, max_retries, finid=None):
+    """Send one messageVersions request for a chunk of recipients
+
+    A chunk that Brevo rejects with 400 (a validation error, usually one bad address)
+    is split in half and each half retried, so the bad address only costs its own
+    delivery. Any other failure (auth, account or request-size errors, 5xx, 429 or
+    transport errors) would fail every half the same way, so the whole chunk is
+    returned as failed and the spool decides whether to back off or pause.
+    """
+    if isinstance(content, PersonalizedContent):
+        request = {"content": content.batch_body(emails)}
+    else:
+        request = {"json": _build_batch_payload(emails, subject, content)}
+    status_code, error, attempts = None, None, 0
+
+    for attempt in range(max_retries + 1):
+        await limiter.acquire()
+        attempts = attempt + 1
+        start = time.perf_counter()
+        try:
+            res = await transport.apost(BREVO_SMTP_URL, headers=BREVO_HEADERS, timeout=10, **request)
+        except httpx.HTTPError as e:
+            EMAIL_REQUEST_SECONDS.observe(time.perf_counter() - start, mode="batch", status="error")
+            error = str(e) or e.__class__.__name__
+            await asyncio.sleep(min(2 ** attempt, 30))
+            continue
+
+        elapsed = time.perf_counter() - start
+        EMAIL_REQUEST_SECONDS.observe(elapsed, mode="batch", status=res.status_code)
+        status_code = res.status_code
+        if res.status_code == 201:
+            logger.info(f"Batch email sent successfully to {len(emails)} recipients (IPO alert)",
+                        extra={"finid": finid, "count": len(emails), "latency_ms": round(elapsed * 1000, 1)})
+            return [{"email": email, "success": True, "status_code": 201, "error": None,
+                     "attempts": attempts} for email in emails]
+
+        error = res.text
+        if res.status_code == 429:
+            delay = _get_retry_after(res, default=min(2 ** attempt, 30))
+            logger.warning(f"Brevo rate limit hit, pausing sends for {delay:.1f}s")
+            limiter.pause(delay)
+            continue
+        if res.status_code >= 500:
+            await asyncio.sleep(min(2 ** attempt, 30))
+            continue
+        break
+
+    if status_code != 400:
+        logger.error(f"Batch of {len(emails)} failed as a whole ({status_code or error})",
+                     extra={"finid": finid, "count": len(emails), "status_code": status_code})
+        return [{"email": email, "success": False, "status_code": status_code, "error": error,
+                 "attempts": attempts} for email in emails]
+
+    if len(emails) > 1:
+        middle = len(emails) // 2
+        logger.warning(f"Batch of {len(emails)} failed ({status_code}), splitting and retrying")
+        first = await _send_batch_pooled(limiter, emails[:middle], subject, content, max_retries, finid)
+        second = await _send_batch_pooled(limiter, emails[middle:], subject, content, max_retries, finid)
+        return first + second
+
+    rh = recipient_hash(emails[0])
+    logger.error(f"Failed to send email to {rh}: {error}",
+                 extra={"finid": finid, "recipient_hash": rh, "status_code": status_code})
+    return [{"email": emails[0], "success": False, "status_code": status_code, "error": error,
+             "attempts": attempts}]
+
+
+async def send_pooled(limiter, emails, subject, content, max_retries=EMAIL_MAX_RETRIES, batch_mode=False, finid=None):
+    """Send a list of recipients one by one, or as one messageVersions batch, never raising
+
+    `finid` only tags the log records. Returns one result dict per recipient.
+    """
+    try:
+        if batch_mode:
+            results = await _send_batch_pooled(limiter, emails, subject, content, max_retries, finid)
+        else:
+            results = [await _send_email_pooled(limiter, email, subject, content, max_retries, finid)
+                       for email in emails]
+    except Exception as e:
+        logger.error(f"Error sending email to {len(emails)} recipient(s) ({', '.join(map(recipient_hash, emails[:3]))}): {e}",
+                     extra={"finid": finid, "count": len(emails)})
+        results = [{"email": email, "success": False, "status_code": None, "error": str(e), "attempts": 0}
+                   for email in emails]
+    sent = sum(1 for r in results if r["success"])
+    EMAILS_TOTAL.inc(sent, result="success")
+    EMAILS_TOTAL.inc(len(results) - sent, result="failure")
+    return results
+
@@ -1,9 +1,52 @@
-from config import TOTAL_APPS
-from utils import get_nepal_time
+import hmac
+import hashlib
+from html import escape
+from urllib.parse import quote
+from functools import lru_cache
+from config import UNSUBSCRIBE_URL, TRACKING_URL
+from utils import get_nepal_time, load_personalization_secret
+from .render_cache import render_cache, ipo_cache_key, minify_html
+from .skeleton_template import slot
+from .allotment_estimator import estimator
+from .change_detector import CLOSING_TOMORROW
+from .reminder_scheduler import PRE_OPEN, DAY_BEFORE_CLOSE, CLOSING_DAY
 
+# Accent colour and status line of a digest card, by event or reminder type (default: now open)
+DIGEST_STATUS = {
+    CLOSING_TOMORROW: ("#ff9800", "Closes tomorrow"),
+    PRE_OPEN: ("#2196f3", "Opens tomorrow"),
+    DAY_BEFORE_CLOSE: ("#ff9800", "Closes tomorrow"),
+    CLOSING_DAY: ("#f44336", "Closes today"),
+}
 
-def create_ipo_alert_email(ipo, rem_days, prob, sug_qty, suggestion):
-    """Create professional HTML email body for IPO alerts"""
+
+def _personal_parts(personalized):
+    """Greeting and unsubscribe/tracking footer, as slot() markers when personalized"""
+    greeting = f"""
+            <p style="color: #333; margin: 0 0 20px 0; font-size: 15px;">
+                Hi {slot('name')},
+            </p>
+""" if personalized else ""
+    unsubscribe = f"""
+            <p style="margin: 10px 0 0 0; color: #999; font-size: 11px;">
+                <a href="{slot('unsubscribe_url')}" style="color: #999;">Unsubscribe</a>
+            </p>
+""" if personalized else ""
+    if personalized and TRACKING_URL:
+        unsubscribe += f"""
+            <img src="{slot('tracking_url')}" width="1" height="1" alt="" style="display: block; border: 0;">
+"""
+    return greeting, unsubscribe
+
+
+def create_ipo_alert_email(ipo, rem_days, prob, sug_qty, suggestion, personalized=False):
+    """Create professional HTML email body for IPO alerts
+
+    With personalized=True the greeting, unsubscribe link and tracking pixel are
+    left as slot() markers to be filled per recipient.
+    """
+    greeting, unsubscribe = _personal_parts(personalized)
+    estimate = estimator.estimate(ipo)
     return f"""
 <!DOCTYPE html>
 <html>
@@ -28,7 +71,7 @@ def create_ipo_alert_email(ipo, rem_days, prob, sug_qty, suggestion):
 
         <!-- Main Content -->
         <div style="padding: 40px;">
-            
+            {greeting}
             <!-- Company Alert -->
             <div style="background-color: #e3f2fd; border-left: 4px solid #2196f3; padding: 20px; margin-bottom: 30px; border-radius: 0 8px 8px 0;">
                 <h2 style="color: #1976d2; margin: 0 0 8px 0; font-size: 20px; font-weight: 600;">
@@ -165,22 +208,188 @@ def create_ipo_alert_email(ipo, rem_days, prob, sug_qty, suggestion):
         <!-- Footer -->
         <div style="background-color: #f5f5f5; padding: 25px 40px; text-align: center; border-top: 1px solid #e0e0e0;">
             <p style="margin: 0 0 10px 0; color: #666; font-size: 12px;">
-                This analysis is based on estimated total applications of {TOTAL_APPS:,}
+                This analysis is based on estimated total applications of {estimate.applicants:,} ({estimate.basis})
             </p>
             <p style="margin: 0 0 10px 0; color: #666; font-size: 12px;">
-                Automated IPO Alert System • Last checked: {get_nepal_time().strftime('%Y-%m-%d %H:%M:%S')} NPT
+                Automated IPO Alert System • Dates and times are Nepal Time (NPT)
             </p>
             <p style="margin: 0; color: #999; font-size: 11px;">
                 You received this because you're subscribed to IPO alerts
             </p>
+            {unsubscribe}        </div>
+
+    </div>
+</body>
+</html>
+"""
+
+
+def get_ipo_alert_email(ipo, rem_days, prob, sug_qty, suggestion):
+    """Return the minified IPO alert email, rendering it once per distinct IPO and metrics"""
+    key = ipo_cache_key(ipo, rem_days, prob, sug_qty, suggestion)
+    return render_cache.get_or_render(
+        "email", key,
+        lambda: minify_html(create_ipo_alert_email(ipo, rem_days, prob, sug_qty, suggestion))
+    )
+
+
+def get_personalized_alert_skeleton(ipo, rem_days, prob, sug_qty, suggestion):
+    """Return the minified alert HTML with per-recipient slots, rendered once per IPO and metrics"""
+    key = ipo_cache_key(ipo, rem_days, prob, sug_qty, suggestion)
+    return render_cache.get_or_render(
+        "email-personalized", key,
+        lambda: minify_html(create_ipo_alert_email(ipo, rem_days, prob, sug_qty, suggestion, personalized=True))
+    )
+
+
+def _digest_card(event_type, ipo, rem_days, prob, sug_qty, suggestion):
+    accent, status = DIGEST_STATUS.get(event_type, ("#2196f3", "Now open for subscription"))
+    return f"""
+            <div style="border-left: 4px solid {accent}; background-color: #f8f9fa; padding: 18px 20px; margin-bottom: 20px; border-radius: 0 8px 8px 0;">
+                <h2 style="color: #1976d2; margin: 0 0 4px 0; font-size: 18px; font-weight: 600;">
+                    {ipo['company_name']}
+                </h2>
+                <p style="color: {accent}; margin: 0 0 12px 0; font-size: 13px; font-weight: 600;">
+                    {status}
+                </p>
+                <table style="width: 100%; border-collapse: collapse; font-size: 14px;">
+                    <tr>
+                        <td style="padding: 6px 0; color: #666; width: 40%;">Sector</td>
+                        <td style="padding: 6px 0; color: #333; font-weight: 600;">{ipo.get('Sector', 'N/A')}</td>
+                    </tr>
+                    <tr>
+                        <td style="padding: 6px 0; color: #666;">Offer Price</td>
+                        <td style="padding: 6px 0; color: #333; font-weight: 600;">NPR {ipo.get('offer_price', 'N/A')}</td>
+                    </tr>
+                    <tr>
+                        <td style="padding: 6px 0; color: #666;">Open / Close</td>
+                        <td style="padding: 6px 0; color: #333; font-weight: 600;">{ipo['open_date'].split(' ')[0]} → {ipo['close_date'].split(' ')[0]}</td>
+                    </tr>
+                    <tr>
+                        <td style="padding: 6px 0; color: #666;">Days Remaining</td>
+                        <td style="padding: 6px 0; color: #e65100; font-weight: 700;">{rem_days} day{'s' if rem_days != 1 else ''}</td>
+                    </tr>
+                    <tr>
+                        <td style="padding: 6px 0; color: #666;">Allotment Probability</td>
+                        <td style="padding: 6px 0; font-weight: 700; color: {'#4caf50' if prob >= 50 else '#ff9800' if prob >= 20 else '#f44336'};">{prob:.1f}%</td>
+                    </tr>
+                    <tr>
+                        <td style="padding: 6px 0; color: #666;">Recommended Quantity</td>
+                        <td style="padding: 6px 0; color: #333; font-weight: 600;">{sug_qty} units</td>
+                    </tr>
+                </table>
+                <p style="margin: 12px 0 0 0; color: #555; font-size: 13px; line-height: 1.5;">
+                    <strong>Recommendation:</strong> {suggestion}
+                </p>
+            </div>
+"""
+
+
+def create_ipo_digest_email(items, personalized=False, title="IPO Daily Digest"):
+    """Create one HTML email covering several IPOs
+
+    `items` is a list of (event_type, ipo, (rem_days, prob, sug_qty, suggestion)), where
+    event_type is OPENS_TODAY, CLOSING_TOMORROW or a reminder type.
+    """
+    greeting, unsubscribe = _personal_parts(personalized)
+    cards = "".join(_digest_card(event_type, ipo, *metrics) for event_type, ipo, metrics in items)
+    return f"""
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{title}</title>
+</head>
+<body style="margin: 0; padding: 0; font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Helvetica, Arial, sans-serif; background-color: #f8f9fa;">
+    
+    <div style="max-width: 600px; margin: 0 auto; background-color: #ffffff; box-shadow: 0 2px 8px rgba(0,0,0,0.1);">
+        
+        <!-- Header -->
+        <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px 40px; text-align: center;">
+            <h1 style="color: #ffffff; margin: 0; font-size: 24px; font-weight: 600; letter-spacing: -0.5px;">
+                {title}
+            </h1>
+            <p style="color: rgba(255,255,255,0.9); margin: 8px 0 0 0; font-size: 14px;">
+                {len(items)} IPO{'s' if len(items) != 1 else ''} need{'s' if len(items) == 1 else ''} your attention today
+            </p>
+        </div>
+
+        <!-- Main Content -->
+        <div style="padding: 40px;">
+            {greeting}
+            {cards}
+            <!-- Action Note -->
+            <div style="background-color: #fff3e0; padding: 20px; border-radius: 8px; border-left: 3px solid #ff9800;">
+                <p style="margin: 0; color: #e65100; font-size: 14px; font-weight: 500;">
+                    <strong>Action Required:</strong> Review these issues and submit your applications through your broker before they close.
+                </p>
+            </div>
+
         </div>
 
+        <!-- Footer -->
+        <div style="background-color: #f5f5f5; padding: 25px 40px; text-align: center; border-top: 1px solid #e0e0e0;">
+            <p style="margin: 0 0 10px 0; color: #666; font-size: 12px;">
+                Probabilities are based on estimated total applications for each issue
+            </p>
+            <p style="margin: 0 0 10px 0; color: #666; font-size: 12px;">
+                Automated IPO Alert System • Dates and times are Nepal Time (NPT)
+            </p>
+            <p style="margin: 0; color: #999; font-size: 11px;">
+                You received this because you're subscribed to IPO alerts
+            </p>
+            {unsubscribe}        </div>
+        
     </div>
+    
 </body>
 </html>
 """
 
 
+def digest_cache_key(items):
+    """Content hash of every IPO, event type and metrics in a digest"""
+    return hashlib.sha256("|".join(
+        f"{event_type}:{ipo_cache_key(ipo, *metrics)}" for event_type, ipo, metrics in items
+    ).encode("utf-8")).hexdigest()
+
+
+def get_ipo_digest_email(items, personalized=False, title="IPO Daily Digest"):
+    """Return the minified digest email (or its personalization skeleton), rendered once per distinct digest"""
+    return render_cache.get_or_render(
+        f"digest-personalized:{title}" if personalized else f"digest:{title}", digest_cache_key(items),
+        lambda: minify_html(create_ipo_digest_email(items, personalized, title))
+    )
+
+
+@lru_cache(maxsize=1)
+def _token_hmac():
+    # Loaded on first use so the secret file is only created when links are personalized
+    return hmac.new(load_personalization_secret().encode("utf-8"), digestmod=hashlib.sha256)
+
+
+def recipient_token(email, finid):
+    """Stable per-recipient token used for unsubscribe and open tracking links"""
+    token = _token_hmac().copy()
+    token.update(f"{email}:{finid}".encode("utf-8"))
+    return token.hexdigest()[:32]
+
+
+def personalization_values(email, finid, name=None):
+    """HTML-safe slot values for one recipient of a personalized alert"""
+    token = recipient_token(email, finid)
+    quoted_email = quote(email, safe="@")
+    values = {
+        "email": email,
+        "name": escape(name or email.split("@")[0]),
+        "unsubscribe_url": escape(UNSUBSCRIBE_URL.format(email=quoted_email, token=token)),
+    }
+    if TRACKING_URL:
+        values["tracking_url"] = escape(TRACKING_URL.format(email=quoted_email, token=token, finid=finid))
+    return values
+
+
 def create_system_notification_email(title, message, status_type="info"):
     """Create HTML body for system notifications (startup, test, error)"""
     color_map = {
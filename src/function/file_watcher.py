@@ -1,34 +1,102 @@
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-from config import EMAIL_LIST_FILE, logger
-from utils import load_email_list
+import os
+import hashlib
+import threading
+from config import EMAIL_LIST_FILE, EMAIL_WATCH_DEBOUNCE_SECONDS, logger
+from utils import load_subscribers
 
 
-class EmailFileHandler(FileSystemEventHandler):
-    """Watch email_update.txt for changes"""
-    def __init__(self, callback=None):
+def _file_hash(path):
+    """SHA-256 of a file's contents, or None if it cannot be read"""
+    try:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    except OSError:
+        return None
+
+
+class EmailFileHandler:
+    """Watch email_update.txt for changes and report added/changed subscribers and removed addresses
+
+    Implements the watchdog handler protocol (dispatch) without subclassing, so
+    watchdog is only imported when watching actually starts.
+    """
+    def __init__(self, callback=None, path=EMAIL_LIST_FILE, debounce=EMAIL_WATCH_DEBOUNCE_SECONDS):
         self.callback = callback
-        super().__init__()
+        self.path = os.path.abspath(path)
+        self.debounce = debounce
+        self.timer = None
+        self.lock = threading.Lock()
+        self.content_hash = _file_hash(self.path)
+        self.subscribers = (load_subscribers() or {}) if self.content_hash else {}
+
+    def dispatch(self, event):
+        self.on_any_event(event)
+
+    def _is_target(self, event):
+        if event.is_directory:
+            return False
+        paths = [event.src_path, getattr(event, "dest_path", None)]
+        return any(p and os.path.abspath(p) == self.path for p in paths)
+
+    def on_any_event(self, event):
+        # Editors save by modify, create or rename, so react to all of them for our file only
+        if event.event_type in ("modified", "created", "moved") and self._is_target(event):
+            self._schedule_reload()
+
+    def _schedule_reload(self):
+        """Restart the debounce timer so a burst of events causes one reload"""
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.debounce, self._reload)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _reload(self):
+        content_hash = _file_hash(self.path)
+        if content_hash is None or content_hash == self.content_hash:
+            return
+
+        logger.info(f"{EMAIL_LIST_FILE} changed, reloading email list...")
+        subscribers = load_subscribers()
+        if subscribers is None:
+            # Keep the old hash so the next change event retries the read
+            return
+        self.content_hash = content_hash
+        # Preference edits count as additions so the store picks them up
+        added = {email: prefs for email, prefs in subscribers.items() if self.subscribers.get(email) != prefs}
+        removed = set(self.subscribers) - set(subscribers)
+        self.subscribers = subscribers
+        if not added and not removed:
+            return
+
+        logger.info(f"Email list delta: +{len(added)} / -{len(removed)}")
+        if self.callback:
+            self.callback(added, removed)
 
-    def on_modified(self, event):
-        if event.src_path.endswith(EMAIL_LIST_FILE):
-            logger.info(f"{EMAIL_LIST_FILE} changed, reloading email list...")
-            # Reload email list dynamically
-            new_email_list = load_email_list()
-            if self.callback:
-                self.callback(new_email_list)
+    def cancel(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
 
 
 class FileWatcher:
     def __init__(self, callback=None):
-        self.observer = Observer()
+        self.observer = None
         self.handler = EmailFileHandler(callback)
         self.is_running = False
 
     def start_watching(self):
         """Start watching the email list file"""
         if not self.is_running:
-            self.observer.schedule(self.handler, path='.', recursive=False)
+            from watchdog.observers import Observer
+            self.observer = Observer()
+            # Watch only the list's own directory, not the working directory where logs are written
+            self.observer.schedule(self.handler, path=os.path.dirname(self.handler.path), recursive=False)
             self.observer.start()
             self.is_running = True
             logger.info(f"Started watching {EMAIL_LIST_FILE} for changes...")
@@ -36,6 +104,7 @@ class FileWatcher:
     def stop_watching(self):
         """Stop watching the email list file"""
         if self.is_running:
+            self.handler.cancel()
             self.observer.stop()
             self.observer.join()
             self.is_running = False
@@ -46,4 +115,4 @@ class FileWatcher:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.stop_watching()
\ No newline at end of file
+        self.stop_watching()
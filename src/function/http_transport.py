@@ -0,0 +1,163 @@
+import asyncio
+import threading
+import importlib.util
+import httpx
+from config import (
+    HTTP_TIMEOUT, HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, HTTP_KEEPALIVE_EXPIRY,
+    HTTP2_ENABLED, logger
+)
+
+
+def _origin(url):
+    """Return scheme://host[:port] for a URL, used as the pool key"""
+    parsed = httpx.URL(url)
+    port = f":{parsed.port}" if parsed.port else ""
+    return f"{parsed.scheme}://{parsed.host}{port}"
+
+
+class HTTPTransport:
+    """Shared keep-alive connection pools per upstream host, for sync and async callers"""
+    def __init__(self, timeout=HTTP_TIMEOUT, max_connections=HTTP_MAX_CONNECTIONS,
+                 max_keepalive=HTTP_MAX_KEEPALIVE, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                 http2=HTTP2_ENABLED):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        if http2 and not self.http2:
+            logger.warning("HTTP2_ENABLED is set but the 'h2' package is not installed, using HTTP/1.1")
+
+        self.clients = {}
+        self.async_clients = {}  # origin -> (client, loop, max_connections)
+        self.retired = []  # (client, loop) replaced by a larger pool, closed by aclose()
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _limits(self, max_connections=None):
+        max_connections = max(max_connections or 0, self.max_connections)
+        return httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max(self.max_keepalive, min(max_connections, self.max_keepalive * 2)),
+            keepalive_expiry=self.keepalive_expiry
+        )
+
+    def _bump(self, origin, counter):
+        """Increment a per-host counter; called from sync client threads and the event loop alike"""
+        with self.lock:
+            values = self.stats.setdefault(origin, {"requests": 0, "connections": 0, "tls_handshakes": 0})
+            values[counter] += 1
+
+    def _count(self, origin, name):
+        """Count new connections/handshakes from httpcore trace events"""
+        if name.endswith("connect_tcp.complete") or name.endswith("connect_unix_socket.complete"):
+            self._bump(origin, "connections")
+        elif name.endswith("start_tls.complete"):
+            self._bump(origin, "tls_handshakes")
+
+    def client(self, url):
+        """Return the sync client pooled for the URL's host"""
+        origin = _origin(url)
+        with self.lock:
+            client = self.clients.get(origin)
+            if client is None or client.is_closed:
+                client = httpx.Client(timeout=self.timeout, limits=self._limits(), http2=self.http2)
+                self.clients[origin] = client
+            return client
+
+    def async_client(self, url, max_connections=None):
+        """Return the async client pooled for the URL's host on the running event loop
+
+        Asking for more connections than the current pool allows replaces it with a
+        larger one; requests already in flight finish on the old pool.
+        """
+        origin = _origin(url)
+        loop = asyncio.get_running_loop()
+        size = max(max_connections or 0, self.max_connections)
+        with self.lock:
+            entry = self.async_clients.get(origin)
+            if entry is None or entry[1] is not loop or entry[0].is_closed or entry[2] < size:
+                if entry is not None and entry[1] is loop and not entry[0].is_closed:
+                    self.retired.append((entry[0], loop))
+                    size = max(size, entry[2])
+                client = httpx.AsyncClient(timeout=self.timeout, limits=self._limits(size), http2=self.http2)
+                entry = (client, loop, size)
+                self.async_clients[origin] = entry
+            return entry[0]
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the host's sync pool"""
+        origin = _origin(url)
+        self._bump(origin, "requests")
+        extensions = kwargs.pop("extensions", {})
+        extensions["trace"] = lambda name, info: self._count(origin, name)
+        return self.client(url).request(method, url, extensions=extensions, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    async def arequest(self, method, url, max_connections=None, **kwargs):
+        """Send a request through the host's async pool"""
+        origin = _origin(url)
+        self._bump(origin, "requests")
+
+        async def trace(name, info):
+            self._count(origin, name)
+
+        extensions = kwargs.pop("extensions", {})
+        extensions["trace"] = trace
+        client = self.async_client(url, max_connections)
+        return await client.request(method, url, extensions=extensions, **kwargs)
+
+    async def aget(self, url, **kwargs):
+        return await self.arequest("GET", url, **kwargs)
+
+    async def apost(self, url, **kwargs):
+        return await self.arequest("POST", url, **kwargs)
+
+    def get_stats(self):
+        """Return per-host request and connection counts, with the reuse ratio"""
+        with self.lock:
+            snapshot = {origin: dict(values) for origin, values in self.stats.items()}
+        for values in snapshot.values():
+            requests = values["requests"]
+            values["reuse_ratio"] = round(1 - values["connections"] / requests, 3) if requests else 0.0
+        return snapshot
+
+    def log_stats(self):
+        for origin, values in self.get_stats().items():
+            logger.info(
+                f"HTTP pool {origin}: {values['requests']} requests, {values['connections']} connections, "
+                f"{values['tls_handshakes']} TLS handshakes (reuse {values['reuse_ratio']:.1%})"
+            )
+
+    async def aclose(self):
+        """Close async clients that belong to the running event loop"""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            clients = [client for client, client_loop in self.retired if client_loop is loop]
+            self.retired = [(client, client_loop) for client, client_loop in self.retired if client_loop is not loop]
+            for origin, (client, client_loop, _) in list(self.async_clients.items()):
+                if client_loop is loop:
+                    clients.append(client)
+                    del self.async_clients[origin]
+        for client in clients:
+            await client.aclose()
+
+    def close(self):
+        """Close all sync clients and drop async clients"""
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+            self.async_clients.clear()
+            self.retired.clear()
+        for client in clients:
+            client.close()
+        self.log_stats()
+
+
+# Create a global transport instance shared by every outbound HTTP call
+transport = HTTPTransport()
@@ -1,110 +1,393 @@
+import time
 import asyncio
-from datetime import timedelta
-from config import logger
-from utils import get_nepal_time, load_email_list, calculate_ipo_metrics
-from .api_service import fetch_ipo_data
-from .email_service import send_bulk_emails
-from .email_templates import create_ipo_alert_email
+import itertools
+from datetime import datetime, timedelta
+from config import PERSONALIZATION_ENABLED, PREPARE_AHEAD_DAYS, DIGEST_INCLUDE_CLOSING, DISCORD_DIGEST, logger
+from utils import get_nepal_time, get_nepal_date_str
+from .api_service import fetch_ipo_data_async
+from .email_templates import get_ipo_alert_email, get_personalized_alert_skeleton, get_ipo_digest_email
 from .discord_integration import discord_integration
+from .test_service import send_error_notification
+from .delivery_ledger import DeliveryLedger
+from .subscriber_store import SubscriberStore, INSTANT, DIGEST
+from .outbound_spool import OutboundSpool, DELIVERY_LAG_SECONDS
+from .scheduler import AlertScheduler
+from .change_detector import ChangeDetector, IPOEvent, OPENS_TODAY, CLOSING_TOMORROW
+from .reminder_scheduler import ReminderScheduler, DAY_BEFORE_CLOSE
+from .allotment_estimator import estimator, calculate_metrics_many
+from .metrics import metrics
+from .tracing import tracer
+
+CHECK_SECONDS = metrics.histogram("ipo_check_seconds", "Duration of one fetch-diff-dispatch cycle")
+RENDER_SECONDS = metrics.histogram("alert_render_seconds", "Time to render an alert email", ["personalized"])
 
 
 class IPOProcessor:
     def __init__(self):
-        self.sent_today = set()
         self.last_check_date = None
-        self.email_list = []
+        self.subscribers = SubscriberStore()
+        self.subscribers_synced = False
+        self.ledger = DeliveryLedger()
+        self.spool = OutboundSpool(self.ledger, names_for=self.subscribers.names_for, on_pause=self._email_paused)
+        self.scheduler = AlertScheduler()
+        self.detector = ChangeDetector()
+        self.prepared = set()  # (finid, open_date) of upcoming alerts already rendered
+        self.reminders = ReminderScheduler()
+        # The day-before-close reminder already tells every subscriber an IPO closes tomorrow
+        self.digest_closing = DIGEST_INCLUDE_CLOSING and DAY_BEFORE_CLOSE not in self.reminders.kinds
+        if DIGEST_INCLUDE_CLOSING and not self.digest_closing:
+            logger.info("DIGEST_INCLUDE_CLOSING is ignored while day_before_close reminders are enabled")
+        self.latest = {}  # finid -> the IPO record from the last fetch, for reminders
+
+    def update_email_list(self, added, removed):
+        """Callback for when email list file changes, applying only the delta to the subscriber store
+
+        Runs on the file watcher's thread; the store serializes access with its own lock.
+        """
+        if not self.subscribers_synced:
+            # Not imported yet; the next cycle reads the whole file
+            return
+        self.subscribers.apply_delta(added, removed)
+        logger.info(f"Email list updated: {self.subscribers.count()} active subscribers")
+
+    async def _email_paused(self, status_code, seconds):
+        """Tell the admin that Brevo refused the API key or account and email delivery is on hold"""
+        message = (f"Brevo refused the API key or account ({status_code}). Email delivery is paused and "
+                   f"retried every {seconds / 60:.0f} minutes; queued emails are kept. "
+                   f"Check BREVO_API_KEY and the Brevo account.")
+        await discord_integration.send_system_notification("Email delivery paused", message, "error")
+        # Goes through Brevo too, so it only arrives if the refusal was partial (e.g. out of credits)
+        await asyncio.to_thread(send_error_notification, message)
+
+    def _queue_email_alert(self, finid, open_date, company_name, recipients, subject, html=None, skeleton=None):
+        """Hand the alert to the outbound spool; its workers deliver and record it in the ledger"""
+        if recipients is None:
+            return 0
+        queued = self.spool.enqueue(finid, open_date, subject, recipients, html=html, skeleton=skeleton)
+        logger.info(f"Queued {queued} email(s) for {company_name}")
+        return queued
+
+    async def _send_discord_alerts(self, alerts, detected_at, digest=DISCORD_DIGEST, title="IPO Daily Digest"):
+        """Send this cycle's Discord alerts together, record each target's outcome and return the failed alerts
+
+        `alerts` is a list of (event, date, metrics, pending_targets). With `digest` each
+        target gets them all in one message headed `title`.
+        """
+        if not alerts:
+            return []
+        try:
+            if digest:
+                results = await discord_integration.send_ipo_digest(
+                    [(event.type, event.ipo, metrics, targets) for event, _, metrics, targets in alerts], title
+                )
+            else:
+                results = await discord_integration.send_ipo_alerts(
+                    [(event.ipo, metrics, targets) for event, _, metrics, targets in alerts]
+                )
+        except Exception as e:
+            logger.error(f"Error sending Discord alerts: {e}")
+            results = [{target: False for target in targets} for *_, targets in alerts]
+        delivered_at = time.time()
+        for delivered in results:
+            for _ in filter(None, delivered.values()):
+                DELIVERY_LAG_SECONDS.observe(delivered_at - detected_at, channel="discord")
+        await asyncio.to_thread(self._record_discord, alerts, results)
+        return [alert for alert, delivered in zip(alerts, results) if not all(delivered.values())]
+
+    def _record_discord(self, alerts, results):
+        for (event, open_date, _, _), delivered in zip(alerts, results):
+            self.ledger.record_many(event.finid, open_date, "discord", [
+                {"recipient": target, "success": sent, "attempts": 1} for target, sent in delivered.items()
+            ])
+
+    def _pending_discord(self, finid, date):
+        """Discord targets the ledger has not recorded a delivery to yet"""
+        return self.ledger.pending_recipients(finid, date, "discord", discord_integration.alert_targets())
+
+    def _select_recipients(self, finid, open_date, sector, prob):
+        """(pending emails or None, pending Discord targets) for an opening alert
+
+        The emails are streamed: only the first page is read here, the rest as the spool
+        consumes them. Run it in a worker thread; it reads SQLite.
+        """
+        # Stream only interested instant-delivery subscribers, skipping those the ledger says already got it
+        recipients = self.ledger.filter_pending(
+            finid, open_date, "email", self.subscribers.iter_recipients(sector, prob, "email", INSTANT)
+        )
+        first = next(recipients, None)
+        pending = None if first is None else itertools.chain([first], recipients)
+        return pending, self._pending_discord(finid, open_date)
+
+    async def _send_opening_alert(self, ipo, metrics):
+        """Queue the 'now open' emails for one IPO, given its metrics from this cycle's batch
+
+        Returns (handled, discord_pending); discord_pending is (metrics, targets) when some
+        Discord targets still need the alert, so the caller can batch it with the cycle's others.
+        """
+        open_date = ipo["open_date"].split(" ")[0]
+        company_name = ipo.get('company_name', 'Unknown Company')
+        finid = ipo.get('finid', 'N/A')
+        rem_days, prob, sug_qty, suggestion = metrics
+        
+        with tracer.span("select_recipients"):
+            pending, discord_pending = await asyncio.to_thread(
+                self._select_recipients, finid, open_date, ipo.get('Sector'), prob
+            )
+        if pending is None and not discord_pending:
+            logger.info(f"No pending subscribers for {company_name} ({finid})")
+            return False, None
+        
+        # Create email content
+        subject = f"IPO Alert: {company_name} Now Open for Subscription"
+        with RENDER_SECONDS.time(personalized=str(PERSONALIZATION_ENABLED).lower()), tracer.span("render"):
+            if PERSONALIZATION_ENABLED:
+                content = {"skeleton": get_personalized_alert_skeleton(ipo, rem_days, prob, sug_qty, suggestion)}
+            else:
+                content = {"html": get_ipo_alert_email(ipo, rem_days, prob, sug_qty, suggestion)}
+        
+        # Emails go to the spool and are delivered in the background
+        with tracer.span("queue_emails"):
+            queued = await asyncio.to_thread(
+                self._queue_email_alert, finid, open_date, company_name, pending, subject, **content
+            )
+        
+        logger.info(f"IPO Alert queued for {company_name} ({finid}) to {queued} subscribers - Probability: {prob:.1f}%")
+        return True, (metrics, discord_pending) if discord_pending else None
+
+    def _queue_digests(self, items, today_str, delivery=DIGEST, label="Digest"):
+        """Queue one digest email per subscriber covering every pending IPO they are interested in
+
+        `items` is a list of (event, date, metrics), the date being the one the ledger keys
+        the IPO's delivery on. Recipients whose digests cover the same IPOs share one
+        rendered payload. `delivery` limits recipients to digest (or instant) subscribers;
+        None includes everyone, as reminders do. Returns the number of emails queued.
+        """
+        covered = {}
+        for i, (event, date, (_, prob, *_)) in enumerate(items):
+            recipients = self.ledger.filter_pending(
+                event.finid, date, "email",
+                self.subscribers.iter_recipients(event.ipo.get('Sector'), prob, "email", delivery)
+            )
+            for recipient in recipients:
+                covered.setdefault(recipient, []).append(i)
+
+        groups = {}
+        for recipient, indices in covered.items():
+            groups.setdefault(tuple(indices), []).append(recipient)
+
+        queued = 0
+        for indices, recipients in groups.items():
+            digest = [(items[i][0].type, items[i][0].ipo, items[i][2]) for i in indices]
+            names = [ipo.get('company_name', 'Unknown Company') for _, ipo, _ in digest]
+            subject = f"IPO {label} {today_str}: {', '.join(names[:3])}" + (f" and {len(names) - 3} more" if len(names) > 3 else "")
+            title = "IPO Daily Digest" if label == "Digest" else f"IPO {label}"
+            with RENDER_SECONDS.time(personalized=str(PERSONALIZATION_ENABLED).lower()):
+                if PERSONALIZATION_ENABLED:
+                    content = {"skeleton": get_ipo_digest_email(digest, personalized=True, title=title)}
+                else:
+                    content = {"html": get_ipo_digest_email(digest, title=title)}
+            queued += self.spool.enqueue(
+                f"{label.lower()}:" + "+".join(dict.fromkeys(items[i][0].finid for i in indices)), today_str, subject, recipients,
+                items=[(items[i][0].finid, items[i][1]) for i in indices], **content
+            )
+        if queued:
+            logger.info(f"Queued {queued} {label.lower()} email(s) covering {len(items)} IPO(s) in {len(groups)} variant(s)")
+        return queued
 
-    def update_email_list(self, new_email_list):
-        """Callback for when email list file changes"""
-        self.email_list = new_email_list
-        logger.info(f"Email list updated: {len(self.email_list)} addresses")
+    async def send_reminders(self, reminders):
+        """Deliver reminders that fell due: one email per subscriber and one Discord message per target
 
-    def process_ipo_alerts(self):
-        """Check for IPOs opening today and send alerts"""
+        Called by the reminder scheduler at the reminders' NPT times, without fetching the
+        feed; each IPO is taken from the last fetch, or from the copy stored with the reminder.
+        """
+        today_str = get_nepal_date_str()
+        if not self.subscribers_synced:
+            await asyncio.to_thread(self.subscribers.sync_from_file)
+            self.subscribers_synced = True
+        ipos = [self.latest.get(reminder.finid, reminder.ipo) for reminder in reminders]
+        items = [
+            (IPOEvent(reminder.kind, reminder.finid, ipo, None), reminder.key, metrics)
+            for reminder, ipo, metrics in zip(reminders, ipos, calculate_metrics_many(ipos, today_str))
+        ]
+        detected_at = time.time()
+        with tracer.span("reminders"):
+            await asyncio.to_thread(self._queue_digests, items, today_str, None, "Reminder")
+            discord_alerts = [
+                (event, key, metrics, pending) for event, key, metrics in items
+                if (pending := await asyncio.to_thread(self._pending_discord, event.finid, key))
+            ]
+            failed = await self._send_discord_alerts(discord_alerts, detected_at, digest=True, title="IPO Reminder")
+        if failed:
+            raise RuntimeError(f"Discord reminder not delivered for {len(failed)} IPO(s)")
+        logger.info(f"Sent {len(reminders)} reminder(s): " + ", ".join(f"{r.kind} {r.finid}" for r in reminders))
+
+    async def _prepare_upcoming(self, ipo_data, today_str):
+        """Render the alerts of IPOs opening within PREPARE_AHEAD_DAYS ahead of time
+
+        Metrics are computed as of the opening date, so on that day the email (and
+        the Discord embed) come straight from the render cache.
+        """
+        horizon = (datetime.strptime(today_str, "%Y-%m-%d") + timedelta(days=PREPARE_AHEAD_DAYS)).strftime("%Y-%m-%d")
+        self.prepared = {key for key in self.prepared if key[1] >= today_str}
+        discord_enabled = bool(discord_integration.alert_targets())
+        upcoming = []
+        for ipo in ipo_data:
+            open_date = (ipo.get("open_date") or "").split(" ")[0]
+            key = (ipo.get("finid"), open_date)
+            if ipo.get("close_date") and today_str < open_date <= horizon and key not in self.prepared:
+                upcoming.append((ipo, open_date, key))
+        if not upcoming:
+            return
+        batch = calculate_metrics_many([ipo for ipo, *_ in upcoming], [open_date for _, open_date, _ in upcoming])
+        for (ipo, open_date, key), metrics in zip(upcoming, batch):
+            try:
+                if PERSONALIZATION_ENABLED:
+                    get_personalized_alert_skeleton(ipo, *metrics)
+                else:
+                    get_ipo_alert_email(ipo, *metrics)
+                if discord_enabled:
+                    await discord_integration.get_ipo_embed(ipo, *metrics)
+            except Exception as e:
+                logger.warning(f"Could not prepare alert for {ipo.get('company_name', 'Unknown')}: {e}")
+                continue
+            self.prepared.add(key)
+            logger.info(f"Prepared alert for {ipo.get('company_name', 'Unknown')} ({key[0]}) opening {open_date}")
+
+    def _prune(self, today_str):
+        """Daily cleanup of the ledger, spool and reminder stores"""
+        self.ledger.prune()
+        self.spool.prune()
+        self.reminders.prune(today_str)
+
+    async def process_ipo_alerts(self):
+        """Fetch the feed, diff it against the last snapshot and act on the resulting events"""
+        with CHECK_SECONDS.time(), tracer.span("process_ipo_alerts"):
+            await self._process_ipo_alerts()
+
+    async def _process_ipo_alerts(self):
         nepal_time = get_nepal_time()
         today_str = nepal_time.strftime("%Y-%m-%d")
         
         logger.info(f"Checking IPO alerts for {today_str} (Nepal Time: {nepal_time.strftime('%Y-%m-%d %H:%M:%S')})")
         
-        # Reset sent_today if it's a new day
+        # Housekeeping once per day
         if self.last_check_date != today_str:
-            self.sent_today.clear()
-            logger.info("New day detected - cleared sent emails tracker")
+            logger.info("New day detected - pruning delivery ledger")
             self.last_check_date = today_str
+            await asyncio.to_thread(self._prune, today_str)
         
-        # Load email list for IPO alerts
-        if not self.email_list:
-            self.email_list = load_email_list()
+        # Import email_update.txt into the subscriber store once; the watcher applies later edits
+        if not self.subscribers_synced:
+            with tracer.span("sync_subscribers"):
+                await asyncio.to_thread(self.subscribers.sync_from_file)
+            self.subscribers_synced = True
         
-        if not self.email_list:
+        if not await asyncio.to_thread(self.subscribers.count):
             logger.warning("No email addresses loaded from email_update.txt - no IPO alerts will be sent")
             return
         
-        ipo_data = fetch_ipo_data()
+        with tracer.span("fetch_ipo_data"):
+            ipo_data = await fetch_ipo_data_async()
         
         if not ipo_data:
             logger.warning("No IPO data received or API error")
             return
         
-        alerts_sent = 0
+        # Let the scheduler wake up for IPOs that have not opened yet
+        self.scheduler.set_known_open_dates(
+            ipo["open_date"].split(" ")[0] for ipo in ipo_data
+            if ipo.get("open_date") and ipo["open_date"].split(" ")[0] >= today_str
+        )
         
         for ipo in ipo_data:
+            if not ipo.get("open_date") or not ipo.get("close_date"):
+                logger.warning(f"Missing date info for IPO: {ipo.get('company_name', 'Unknown')}")
+        
+        # Listings whose applicant counts are published (results feed) refine the allotment model
+        if any(ipo.get("applicants") for ipo in ipo_data):
+            await asyncio.to_thread(estimator.learn, ipo_data)
+        
+        # IPOs announced through the upcoming feed get their alerts rendered before they open
+        with tracer.span("prepare_upcoming"):
+            await self._prepare_upcoming(ipo_data, today_str)
+        
+        with tracer.span("detect_changes"):
+            events = self.detector.diff(ipo_data, today_str)
+        
+        # Reminders are timed from each IPO's dates; dates that moved reschedule them
+        with tracer.span("schedule_reminders"):
+            self.reminders.sync(ipo_data, events)
+        self.latest = {str(ipo["finid"]): ipo for ipo in ipo_data if ipo.get("finid") is not None}
+        detected_at = time.time()
+        alerts_sent = 0
+        discord_alerts = []
+        digest_items = []
+        
+        # Metrics for every IPO opening (and, for digests, closing) this cycle in one pass
+        alert_types = (OPENS_TODAY, CLOSING_TOMORROW) if self.digest_closing else (OPENS_TODAY,)
+        with tracer.span("calculate_ipo_metrics"):
+            alerting = [event for event in events if event.type in alert_types and event.ipo.get("close_date")]
+            cycle_metrics = dict(zip(
+                ((event.type, event.finid) for event in alerting),
+                calculate_metrics_many([event.ipo for event in alerting], today_str)
+            ))
+        
+        for event in events:
+            company_name = event.ipo.get('company_name', 'Unknown')
+            metrics = cycle_metrics.get((event.type, event.finid))
+            date = today_str
             try:
-                # Extract date from open_date (format: "2025-09-01 00:00:00")
-                open_date = ipo.get("open_date", "").split(" ")[0] if ipo.get("open_date") else None
-                close_date = ipo.get("close_date", "").split(" ")[0] if ipo.get("close_date") else None
-                
-                if not open_date or not close_date:
-                    logger.warning(f"Missing date info for IPO: {ipo.get('company_name', 'Unknown')}")
-                    continue
-                
-                # Check if IPO opens today
-                if open_date == today_str:
-                    company_name = ipo.get('company_name', 'Unknown Company')
-                    finid = ipo.get('finid', 'N/A')
-                    
-                    # Create unique identifier for this IPO
-                    ipo_id = f"{finid}_{open_date}"
-                    
-                    # Skip if already sent today
-                    if ipo_id in self.sent_today:
-                        logger.info(f"Email already sent today for {company_name} ({finid})")
+                if event.type == OPENS_TODAY:
+                    if metrics is None:
                         continue
-                    
-                    # Calculate metrics
-                    rem_days, prob, sug_qty, suggestion = calculate_ipo_metrics(ipo, today_str)
-                    
-                    # Create email content
-                    email_body = create_ipo_alert_email(ipo, rem_days, prob, sug_qty, suggestion)
-                    subject = f"IPO Alert: {company_name} Now Open for Subscription"
-                    
-                    # Send email to all subscribers
-                    successful_sends = send_bulk_emails(self.email_list, subject, email_body)
-                    
-                    # Send Discord alert if bot is ready
-                    if discord_integration.is_ready() and discord_integration.get_loop():
-                        try:
-                            asyncio.run_coroutine_threadsafe(
-                                discord_integration.send_ipo_alert(ipo, rem_days, prob, sug_qty, suggestion),
-                                discord_integration.get_loop()
-                            )
-                        except Exception as e:
-                            logger.error(f"Error sending Discord alert: {e}")
-                    
-                    # Mark as sent
-                    self.sent_today.add(ipo_id)
-                    alerts_sent += 1
-                    
-                    logger.info(f"IPO Alert sent for {company_name} ({finid}) to {successful_sends} subscribers - Probability: {prob:.1f}%")
+                    with tracer.span("opening_alert"):
+                        handled, discord_pending = await self._send_opening_alert(event.ipo, metrics)
+                    if handled:
+                        alerts_sent += 1
+                    if discord_pending:
+                        discord_alerts.append((event, date, *discord_pending))
+                    digest_items.append((event, date, metrics))
+                elif metrics is not None:
+                    # Closing tomorrow: only digests carry these, keyed on the closing date
+                    date = event.ipo["close_date"].split(" ")[0]
+                    digest_items.append((event, date, metrics))
+                    if DISCORD_DIGEST:
+                        targets = await asyncio.to_thread(self._pending_discord, event.finid, date)
+                        if targets:
+                            discord_alerts.append((event, date, metrics, targets))
+                else:
+                    logger.info(f"IPO event {event.type} for {company_name} ({event.finid})")
             
             except Exception as e:
-                logger.error(f"Error processing IPO {ipo.get('company_name', 'Unknown')}: {e}")
+                logger.error(f"Error processing IPO {company_name}: {e}")
+                # Emit the event again next cycle; the ledger skips whoever already got it
+                self.detector.forget(event, date)
+        
+        # Digest subscribers get a single email for all of this cycle's IPOs
+        if digest_items and await asyncio.to_thread(self.subscribers.has_digest_subscribers):
+            try:
+                with tracer.span("queue_digests"):
+                    await asyncio.to_thread(self._queue_digests, digest_items, today_str)
+            except Exception as e:
+                logger.error(f"Error queueing IPO digests: {e}")
+                for event, date, _ in digest_items:
+                    self.detector.forget(event, date)
+        
+        # One Discord message carries up to 10 of this cycle's alerts, or all of them as a digest
+        with tracer.span("discord_alerts"):
+            failed = await self._send_discord_alerts(discord_alerts, detected_at)
+        for event, date, *_ in failed:
+            logger.warning(f"Discord alert was not delivered for {event.ipo.get('company_name', 'Unknown')}")
+            self.detector.forget(event, date)
+        
+        with tracer.span("commit_snapshot"):
+            self.detector.commit()
         
         if alerts_sent == 0:
             logger.info("No new IPO openings found for today")
         else:
-            logger.info(f"Sent {alerts_sent} IPO alert(s) to {len(self.email_list)} subscribers")
+            logger.info(f"Sent {alerts_sent} IPO alert(s) to {await asyncio.to_thread(self.subscribers.count)} subscribers")
 
-    def get_next_check_time(self, hours=5):
+    def get_next_check_time(self):
         """Get the next check time"""
-        return get_nepal_time() + timedelta(hours=hours)
\ No newline at end of file
+        return self.scheduler.next_check_time()
\ No newline at end of file
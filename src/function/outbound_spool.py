@@ -0,0 +1,454 @@
+import copy
+import json
+import time
+import random
+import asyncio
+import sqlite3
+import threading
+from config import (
+    SPOOL_DB_FILE, SPOOL_WORKERS, SPOOL_CLAIM_SIZE, SPOOL_MAX_ATTEMPTS, SPOOL_BACKOFF_BASE_SECONDS,
+    SPOOL_BACKOFF_MAX_SECONDS, SPOOL_ACCOUNT_PAUSE_SECONDS, EMAIL_RATE_PER_SECOND, EMAIL_MAX_RETRIES, EMAIL_TRANSPORT_MODE,
+    EMAIL_BATCH_SIZE, logger
+)
+from .email_service import BREVO_SMTP_URL, TokenBucket, PersonalizedContent, send_pooled
+from .email_templates import personalization_values
+from .http_transport import transport
+from .metrics import metrics
+from .tracing import tracer
+
+QUEUED = "queued"
+INFLIGHT = "inflight"
+DEAD = "dead"
+
+# Brevo refuses the key or the account itself: every send fails alike until someone fixes it
+ACCOUNT_ERRORS = (401, 402, 403)
+
+SPOOL_JOBS = metrics.gauge("spool_jobs", "Outbound email jobs by status", ["status"])
+DELIVERY_LAG_SECONDS = metrics.histogram(
+    "alert_delivery_lag_seconds", "Time from detecting an alert to delivering it", ["channel"]
+)
+FANOUT_SECONDS = metrics.histogram("alert_fanout_seconds", "Time from queueing an alert to settling all its emails")
+
+
+def _is_account_error(result):
+    return result.get("status_code") in ACCOUNT_ERRORS
+
+
+def _is_permanent(result):
+    """4xx responses other than 429 and account errors will fail the same way next time"""
+    status = result.get("status_code")
+    return status is not None and 400 <= status < 500 and status != 429 and status not in ACCOUNT_ERRORS
+
+
+def _retry_at(attempts, now):
+    """Next attempt time after `attempts` failed rounds: exponential backoff with jitter"""
+    delay = min(SPOOL_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), SPOOL_BACKOFF_MAX_SECONDS)
+    return now + delay * random.uniform(0.5, 1.0)
+
+
+class OutboundSpool:
+    """Disk-backed email queue drained by a pool of async workers
+
+    process_ipo_alerts enqueues and returns at once; workers send with the shared rate
+    limit, retry failed jobs with exponential backoff and dead-letter them after
+    SPOOL_MAX_ATTEMPTS rounds. A job is only removed once its result is in the ledger,
+    and jobs left in flight by a crash are requeued on startup. When Brevo refuses the
+    API key or account, all sending is held for SPOOL_ACCOUNT_PAUSE_SECONDS and
+    `await on_pause(status_code, seconds)` alerts the admin; the jobs keep their attempts. Workers do their SQLite
+    work in worker threads so the event loop only waits on the network.
+    `names_for(emails)` returns recipients' stored names for personalized alerts.
+    """
+    def __init__(self, ledger, path=SPOOL_DB_FILE, workers=SPOOL_WORKERS, mode=EMAIL_TRANSPORT_MODE, names_for=None,
+                 on_pause=None):
+        self.ledger = ledger
+        self.names_for = names_for
+        self.on_pause = on_pause
+        self.paused_until = 0.0
+        self.path = path
+        self.workers = max(1, workers)
+        self.batch_mode = mode == "batch"
+        self.claim_size = EMAIL_BATCH_SIZE if self.batch_mode else SPOOL_CLAIM_SIZE
+        self.lock = threading.Lock()
+        self.contents = {}
+        self.tasks = []
+        self.loop = None
+        self.wakeup = None
+        self.limiter = None
+        self.stopped = False
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS payloads (
+                id INTEGER PRIMARY KEY,
+                finid TEXT NOT NULL,
+                open_date TEXT NOT NULL,
+                spec TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                payload_id INTEGER NOT NULL REFERENCES payloads (id),
+                recipient TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                UNIQUE (payload_id, recipient)
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (status, next_attempt_at);
+            CREATE INDEX IF NOT EXISTS idx_jobs_payload ON jobs (payload_id, status);
+        """)
+        self.conn.commit()
+        self.recover()
+        metrics.add_collector(self.collect_metrics)
+
+    def recover(self):
+        """Requeue jobs a previous run left in flight, dropping those the ledger shows as sent"""
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT j.id, j.recipient, p.finid, p.open_date FROM jobs j
+                JOIN payloads p ON p.id = j.payload_id WHERE j.status = ?
+            """, (INFLIGHT,)).fetchall()
+        if not rows:
+            return
+        delivered = {}
+        done, requeue = [], []
+        for job_id, recipient, finid, open_date in rows:
+            key = (finid, open_date)
+            if key not in delivered:
+                delivered[key] = self.ledger.delivered_recipients(finid, open_date, "email")
+            (done if recipient in delivered[key] else requeue).append((job_id,))
+        with self.lock:
+            self.conn.executemany("DELETE FROM jobs WHERE id = ?", done)
+            self.conn.executemany(f"UPDATE jobs SET status = '{QUEUED}' WHERE id = ?", requeue)
+            self.conn.commit()
+        logger.info(f"Outbound spool recovered {len(requeue)} in-flight job(s), {len(done)} already delivered")
+
+    def enqueue(self, finid, open_date, subject, recipients, html=None, skeleton=None, items=None):
+        """Queue an alert for recipients and return how many jobs were added
+
+        Pass the rendered `html`, or a personalization `skeleton` that is filled per recipient
+        at send time. Enqueueing the same alert twice does not duplicate recipients.
+        A digest passes the (finid, date) of every IPO it covers as `items`; deliveries are
+        then recorded in the ledger for each of them as well.
+        """
+        spec = {"subject": subject, "html": html, "skeleton": skeleton}
+        if items:
+            spec["items"] = [[str(item_finid), date] for item_finid, date in items]
+        spec = json.dumps(spec, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id FROM payloads WHERE finid = ? AND open_date = ? AND spec = ?",
+                (str(finid), open_date, spec)
+            ).fetchone()
+            if row:
+                payload_id = row[0]
+            else:
+                payload_id = self.conn.execute(
+                    "INSERT INTO payloads (finid, open_date, spec, created_at) VALUES (?, ?, ?, ?)",
+                    (str(finid), open_date, spec, now)
+                ).lastrowid
+            # A re-rendered alert must not reach recipients still queued under an older payload
+            other_ids = [r[0] for r in self.conn.execute(
+                "SELECT id FROM payloads WHERE finid = ? AND open_date = ? AND id != ?",
+                (str(finid), open_date, payload_id)
+            )]
+            insert = f"INSERT OR IGNORE INTO jobs (payload_id, recipient, status, next_attempt_at) SELECT ?, ?, '{QUEUED}', ?"
+            if other_ids:
+                placeholders = ",".join("?" * len(other_ids))
+                insert += f" WHERE NOT EXISTS (SELECT 1 FROM jobs WHERE payload_id IN ({placeholders}) AND recipient = ?)"
+            before = self.conn.total_changes
+            self.conn.executemany(
+                insert, ((payload_id, recipient, now, *other_ids, recipient) if other_ids else (payload_id, recipient, now)
+                         for recipient in recipients)
+            )
+            added = self.conn.total_changes - before
+            self.conn.commit()
+        if added:
+            self._wake()
+        return added
+
+    def _wake(self):
+        """Wake idle workers; safe to call from any thread"""
+        if self.loop and self.wakeup:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def _content_for(self, payload_id):
+        """Rebuild (and cache) the send content for a payload"""
+        content = self.contents.get(payload_id)
+        if content is not None:
+            return content
+        with self.lock:
+            finid, open_date, spec, created_at = self.conn.execute(
+                "SELECT finid, open_date, spec, created_at FROM payloads WHERE id = ?", (payload_id,)
+            ).fetchone()
+        spec = json.loads(spec)
+        if spec["skeleton"]:
+            body = PersonalizedContent(
+                spec["subject"], spec["skeleton"],
+                lambda email: personalization_values(email, finid),
+                personalization_values("investor@localhost", finid, name="Investor")
+            )
+        else:
+            body = spec["html"]
+        items = [tuple(item) for item in spec.get("items", ())]
+        content = self.contents[payload_id] = (finid, open_date, spec["subject"], body, created_at, items)
+        return content
+
+    def _personalize(self, content, finid, recipients):
+        """Fill the claimed recipients' stored names into a personalized payload, one lookup per claim"""
+        if not isinstance(content, PersonalizedContent) or self.names_for is None:
+            return content
+        names = self.names_for(recipients)
+        if not names:
+            return content
+        content = copy.copy(content)
+        content.values_for = lambda email: personalization_values(email, finid, name=names.get(email))
+        return content
+
+    def _prepare(self, payload_id, recipients):
+        """(finid, subject, content) to send a claimed set of recipients"""
+        finid, _, subject, content, *_ = self._content_for(payload_id)
+        return finid, subject, self._personalize(content, finid, recipients)
+
+    def _claim(self):
+        """Mark up to claim_size due jobs of one payload as in flight and return them"""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT payload_id FROM jobs WHERE status = ? AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 1",
+                (QUEUED, now)
+            ).fetchone()
+            if not row:
+                return None, []
+            jobs = self.conn.execute(
+                "SELECT id, recipient, attempts FROM jobs WHERE payload_id = ? AND status = ? AND next_attempt_at <= ? LIMIT ?",
+                (row[0], QUEUED, now, self.claim_size)
+            ).fetchall()
+            self.conn.executemany(f"UPDATE jobs SET status = '{INFLIGHT}' WHERE id = ?", [(job[0],) for job in jobs])
+            self.conn.commit()
+        return row[0], jobs
+
+    def _next_due_in(self):
+        """Seconds until the next queued job is due, or None if the queue is empty"""
+        with self.lock:
+            row = self.conn.execute("SELECT MIN(next_attempt_at) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def _settle(self, payload_id, jobs, results):
+        """Acknowledge sent jobs and reschedule or dead-letter failed ones
+
+        Returns the status code if Brevo refused the key or account, else None.
+        """
+        finid, open_date, _, _, created_at, items = self._content_for(payload_id)
+        by_recipient = {r["email"]: r for r in results}
+        now = time.time()
+        acked, retry, held, dead, ledger_rows = [], [], [], [], []
+        refused = None
+        for job_id, recipient, attempts in jobs:
+            result = by_recipient.get(recipient) or {"success": False, "error": "no result", "attempts": 0}
+            attempts += 1
+            if result["success"]:
+                acked.append((job_id,))
+                ledger_rows.append({"recipient": recipient, "success": True, "attempts": result["attempts"]})
+            elif _is_account_error(result):
+                # Not the recipient's fault, so the round does not count against the job
+                held.append((now + SPOOL_ACCOUNT_PAUSE_SECONDS, result["error"], job_id))
+                refused = result["status_code"]
+            elif attempts >= SPOOL_MAX_ATTEMPTS or _is_permanent(result):
+                dead.append((attempts, result["error"], job_id))
+                ledger_rows.append({"recipient": recipient, "success": False, "attempts": result["attempts"]})
+            else:
+                retry.append((attempts, _retry_at(attempts, now), result["error"], job_id))
+
+        # Ledger first: if we crash before the ack, recover() sees the delivery and drops the job
+        self.ledger.record_many(finid, open_date, "email", ledger_rows)
+        for item_finid, date in items:
+            self.ledger.record_many(item_finid, date, "email", ledger_rows)
+        with self.lock:
+            self.conn.executemany("DELETE FROM jobs WHERE id = ?", acked)
+            self.conn.executemany(
+                f"UPDATE jobs SET status = '{QUEUED}', attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                retry
+            )
+            self.conn.executemany(
+                f"UPDATE jobs SET status = '{QUEUED}', next_attempt_at = ?, last_error = ? WHERE id = ?", held
+            )
+            self.conn.executemany(f"UPDATE jobs SET status = '{DEAD}', attempts = ?, last_error = ? WHERE id = ?", dead)
+            self.conn.commit()
+            remaining = self.conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE payload_id = ? AND status IN (?, ?)", (payload_id, QUEUED, INFLIGHT)
+            ).fetchone()[0]
+        for _ in acked:
+            DELIVERY_LAG_SECONDS.observe(now - created_at, channel="email")
+        if not remaining:
+            FANOUT_SECONDS.observe(now - created_at)
+            logger.info(f"All queued emails for {finid} settled {now - created_at:.1f}s after queueing",
+                        extra={"finid": finid, "channel": "email", "latency_ms": round((now - created_at) * 1000)})
+        if retry:
+            logger.warning(f"{len(retry)} email(s) for {finid} will be retried with backoff")
+        if held:
+            logger.error(f"{len(held)} email(s) for {finid} held: Brevo refused the API key or account ({refused})")
+        if dead:
+            logger.error(f"{len(dead)} email(s) for {finid} moved to the dead-letter queue")
+        return refused
+
+    def _release(self, jobs, error):
+        """Put claimed jobs back in the queue with backoff after an unexpected error
+
+        Counts as a failed round, so a job that keeps failing this way is dead-lettered too.
+        """
+        now = time.time()
+        retry, dead = [], []
+        for job_id, _, attempts in jobs:
+            attempts += 1
+            if attempts >= SPOOL_MAX_ATTEMPTS:
+                dead.append((attempts, error, job_id))
+            else:
+                retry.append((attempts, _retry_at(attempts, now), error, job_id))
+        with self.lock:
+            self.conn.executemany(
+                f"UPDATE jobs SET status = '{QUEUED}', attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                retry
+            )
+            self.conn.executemany(f"UPDATE jobs SET status = '{DEAD}', attempts = ?, last_error = ? WHERE id = ?", dead)
+            self.conn.commit()
+        if dead:
+            logger.error(f"{len(dead)} email(s) moved to the dead-letter queue after repeated worker errors")
+
+    async def _pause(self, status_code):
+        """Hold all sending after Brevo refused the key or account, alerting once per pause"""
+        if self.paused_until > time.time():
+            return  # Other workers' sends were refused too
+        self.paused_until = time.time() + SPOOL_ACCOUNT_PAUSE_SECONDS
+        logger.error(f"Brevo refused the API key or account ({status_code}), "
+                     f"pausing email delivery for {SPOOL_ACCOUNT_PAUSE_SECONDS:.0f}s")
+        if self.on_pause:
+            try:
+                await self.on_pause(status_code, SPOOL_ACCOUNT_PAUSE_SECONDS)
+            except Exception as e:
+                logger.error(f"Could not alert the admin about the email pause: {e}")
+
+    async def _worker(self):
+        while not self.stopped:
+            # Clear before claiming so an enqueue that races the claim still wakes us
+            self.wakeup.clear()
+            paused_for = self.paused_until - time.time()
+            if paused_for > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=min(paused_for, 60))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            payload_id, jobs = await asyncio.to_thread(self._claim)
+            if not jobs:
+                due_in = await asyncio.to_thread(self._next_due_in)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=60 if due_in is None else min(due_in, 60))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                recipients = [job[1] for job in jobs]
+                finid, subject, content = await asyncio.to_thread(self._prepare, payload_id, recipients)
+                with tracer.span("send_emails"):
+                    results = await send_pooled(self.limiter, recipients, subject, content,
+                                                EMAIL_MAX_RETRIES, self.batch_mode, finid)
+                with tracer.span("settle_jobs"):
+                    refused = await asyncio.to_thread(self._settle, payload_id, jobs, results)
+                if refused:
+                    await self._pause(refused)
+            except Exception as e:
+                logger.error(f"Outbound spool worker error, requeueing {len(jobs)} job(s): {e}")
+                try:
+                    await asyncio.to_thread(self._release, jobs, str(e))
+                except Exception as e:
+                    # Still in flight; recover() requeues them on the next start
+                    logger.error(f"Could not requeue jobs after worker error: {e}")
+
+    def start(self):
+        """Start the worker pool on the running event loop"""
+        if self.tasks:
+            return
+        self.stopped = False
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.limiter = TokenBucket(EMAIL_RATE_PER_SECOND)
+        # Make sure the Brevo pool is large enough for every worker to hold a connection
+        transport.async_client(BREVO_SMTP_URL, max_connections=self.workers)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Outbound spool started with {self.workers} worker(s), {self.stats()}")
+
+    async def stop(self, timeout=30):
+        """Let workers finish the jobs they hold, then stop; unsent jobs stay queued on disk"""
+        if not self.tasks:
+            return
+        self.stopped = True
+        self.wakeup.set()
+        done, pending = await asyncio.wait(self.tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self.tasks = []
+        logger.info(f"Outbound spool stopped, {self.stats()}")
+
+    async def drain(self, poll=0.5):
+        """Wait until no job is queued or in flight (dead letters are left alone)"""
+        while True:
+            stats = self.stats()
+            if not stats.get(QUEUED) and not stats.get(INFLIGHT):
+                return
+            await asyncio.sleep(poll)
+
+    def collect_metrics(self):
+        """Refresh the queue depth gauge"""
+        stats = self.stats()
+        for status in (QUEUED, INFLIGHT, DEAD):
+            SPOOL_JOBS.set(stats.get(status, 0), status=status)
+
+    def stats(self):
+        """Job counts by status"""
+        with self.lock:
+            return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def dead_letters(self, limit=100):
+        """Return (finid, recipient, attempts, last_error) for dead-lettered jobs"""
+        with self.lock:
+            return self.conn.execute("""
+                SELECT p.finid, j.recipient, j.attempts, j.last_error FROM jobs j
+                JOIN payloads p ON p.id = j.payload_id WHERE j.status = ? LIMIT ?
+            """, (DEAD, limit)).fetchall()
+
+    def requeue_dead(self):
+        """Give every dead-lettered job a fresh set of attempts"""
+        with self.lock:
+            count = self.conn.execute(
+                f"UPDATE jobs SET status = '{QUEUED}', attempts = 0, next_attempt_at = ? WHERE status = '{DEAD}'",
+                (time.time(),)
+            ).rowcount
+            self.conn.commit()
+        if count:
+            self._wake()
+        return count
+
+    def prune(self, days=30):
+        """Delete payloads older than the given number of days that have no live jobs left"""
+        cutoff = time.time() - days * 86400
+        with self.lock:
+            self.conn.execute("""
+                DELETE FROM jobs WHERE status = ? AND payload_id IN (SELECT id FROM payloads WHERE created_at < ?)
+            """, (DEAD, cutoff))
+            self.conn.execute("""
+                DELETE FROM payloads WHERE created_at < ? AND id NOT IN (SELECT DISTINCT payload_id FROM jobs)
+            """, (cutoff,))
+            self.conn.commit()
+        self.contents.clear()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,276 @@
+import json
+import time
+import heapq
+import asyncio
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+from config import (
+    NEPAL_TZ, REMINDER_DB_FILE, REMINDER_KINDS, REMINDER_PRE_OPEN_TIME, REMINDER_MORNING_TIME,
+    REMINDER_GRACE_HOURS, REMINDER_RETRY_SECONDS, logger
+)
+from .change_detector import DATES_EXTENDED, DATES_CHANGED
+from .metrics import metrics
+
+PRE_OPEN = "pre_open"  # Evening before the IPO opens
+DAY_BEFORE_CLOSE = "day_before_close"  # Morning of the day before it closes
+CLOSING_DAY = "closing_day"  # Morning of the day it closes
+REMINDER_TYPES = (PRE_OPEN, DAY_BEFORE_CLOSE, CLOSING_DAY)
+
+REMINDERS_PENDING = metrics.gauge("reminders_pending", "Reminders waiting to fire")
+REMINDERS_FIRED = metrics.counter("reminders_fired_total", "Reminders handed to delivery", ["kind"])
+
+# key is the ledger date for the reminder ("<kind>:<date>"), distinct from the opening alert's
+Reminder = namedtuple("Reminder", ["fire_at", "finid", "kind", "key", "ipo"])
+
+
+def _parse_time(value):
+    return datetime.strptime(value, "%H:%M").time()
+
+
+def _dates(ipo):
+    return (ipo.get("open_date") or "").split(" ")[0], (ipo.get("close_date") or "").split(" ")[0]
+
+
+class ReminderScheduler:
+    """Timed per-IPO reminders held in a min-heap and persisted in SQLite
+
+    Each IPO gets up to three reminders (pre-open, day before close, closing day) at fixed
+    NPT times derived from its dates. The heap gives O(log n) insert and pop; a moved
+    reminder is pushed again and its old heap entry is skipped when it surfaces. run()
+    sleeps until the earliest reminder is due, so reminders fire on time without polling
+    the feed. Reminders missed while the bot was down still fire within
+    REMINDER_GRACE_HOURS of their time.
+    """
+    def __init__(self, path=REMINDER_DB_FILE, kinds=REMINDER_KINDS):
+        self.path = path
+        self.kinds = set(kinds)
+        self.pre_open_time = _parse_time(REMINDER_PRE_OPEN_TIME)
+        self.morning_time = _parse_time(REMINDER_MORNING_TIME)
+        self.heap = []
+        self.pending = {}  # (finid, kind) -> Reminder
+        self.dates = {}  # finid -> (open_date, close_date) the reminders were computed from
+        self.stopped = False
+        self.wakeup = None
+        self.loop = None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS reminders (
+                finid TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                fire_at REAL NOT NULL,
+                key TEXT NOT NULL,
+                ipo TEXT NOT NULL,
+                PRIMARY KEY (finid, kind)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS reminder_dates (
+                finid TEXT PRIMARY KEY,
+                open_date TEXT,
+                close_date TEXT
+            ) WITHOUT ROWID;
+        """)
+        self.conn.commit()
+        self._load()
+        metrics.add_collector(self.collect_metrics)
+
+    def _load(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT fire_at, finid, kind, key, ipo FROM reminders").fetchall()
+            self.dates = {row[0]: (row[1], row[2]) for row in self.conn.execute("SELECT * FROM reminder_dates")}
+        cutoff = time.time() - REMINDER_GRACE_HOURS * 3600
+        stale = []
+        for fire_at, finid, kind, key, ipo in rows:
+            if fire_at < cutoff:
+                stale.append((finid, kind))
+                continue
+            self.pending[(finid, kind)] = Reminder(fire_at, finid, kind, key, json.loads(ipo))
+        self.heap = [(r.fire_at, r.finid, r.kind) for r in self.pending.values()]
+        heapq.heapify(self.heap)
+        if stale:
+            with self.lock:
+                self.conn.executemany("DELETE FROM reminders WHERE finid = ? AND kind = ?", stale)
+                self.conn.commit()
+        if rows:
+            logger.info(f"Loaded {len(self.pending)} pending reminder(s), dropped {len(stale)} too old to send")
+
+    def _at(self, day, at_time):
+        return NEPAL_TZ.localize(datetime.combine(day, at_time)).timestamp()
+
+    def _plan(self, ipo):
+        """(kind, fire_at, key) for every reminder this IPO's dates call for"""
+        open_str, close_str = _dates(ipo)
+        try:
+            open_day = datetime.strptime(open_str, "%Y-%m-%d").date()
+            close_day = datetime.strptime(close_str, "%Y-%m-%d").date()
+        except ValueError:
+            return []
+        plan = []
+        if PRE_OPEN in self.kinds:
+            plan.append((PRE_OPEN, open_day - timedelta(days=1), self.pre_open_time))
+        # The opening alert already covers the first day, so closing reminders start after it
+        if DAY_BEFORE_CLOSE in self.kinds and close_day - timedelta(days=1) > open_day:
+            plan.append((DAY_BEFORE_CLOSE, close_day - timedelta(days=1), self.morning_time))
+        if CLOSING_DAY in self.kinds and close_day > open_day:
+            plan.append((CLOSING_DAY, close_day, self.morning_time))
+        return [(kind, self._at(day, at_time), f"{kind}:{day.isoformat()}") for kind, day, at_time in plan]
+
+    def schedule(self, ipo, now=None):
+        """(Re)compute one IPO's reminders from its current dates; past reminders are not added"""
+        finid = str(ipo.get("finid"))
+        now = now or time.time()
+        record = json.dumps(ipo, default=str)
+        wanted = {kind: (fire_at, key) for kind, fire_at, key in self._plan(ipo) if fire_at > now}
+        removed = [(finid, kind) for kind in REMINDER_TYPES if (finid, kind) in self.pending and kind not in wanted]
+        rows = []
+        for kind, (fire_at, key) in wanted.items():
+            reminder = Reminder(fire_at, finid, kind, key, ipo)
+            previous = self.pending.get((finid, kind))
+            self.pending[(finid, kind)] = reminder
+            if previous is None or previous.fire_at != fire_at:
+                heapq.heappush(self.heap, (fire_at, finid, kind))
+            rows.append((finid, kind, fire_at, key, record))
+        for key in removed:
+            del self.pending[key]
+        self.dates[finid] = _dates(ipo)
+        with self.lock:
+            self.conn.executemany("DELETE FROM reminders WHERE finid = ? AND kind = ?", removed)
+            self.conn.executemany("""
+                INSERT INTO reminders (finid, kind, fire_at, key, ipo) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (finid, kind) DO UPDATE SET fire_at = excluded.fire_at, key = excluded.key, ipo = excluded.ipo
+            """, rows)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO reminder_dates (finid, open_date, close_date) VALUES (?, ?, ?)",
+                (finid, *self.dates[finid])
+            )
+            self.conn.commit()
+        self._wake()
+        return len(wanted)
+
+    def sync(self, ipo_data, events=()):
+        """Schedule IPOs seen for the first time and reschedule those whose dates the detector saw move"""
+        moved = {event.finid for event in events if event.type in (DATES_EXTENDED, DATES_CHANGED)}
+        scheduled = 0
+        for ipo in ipo_data:
+            finid = ipo.get("finid")
+            if finid is None:
+                continue
+            finid = str(finid)
+            # A restart can miss the detector's event, so stored dates are compared too
+            if finid in moved or self.dates.get(finid) != _dates(ipo):
+                self.schedule(ipo)
+                scheduled += 1
+        if scheduled:
+            logger.info(f"Scheduled reminders for {scheduled} IPO(s), {len(self.pending)} pending")
+
+    def _wake(self):
+        """Wake run() so it picks up an earlier reminder; safe to call from any thread"""
+        if self.loop and self.wakeup:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def _peek(self):
+        """Earliest live heap entry, discarding entries superseded by a reschedule"""
+        while self.heap:
+            fire_at, finid, kind = self.heap[0]
+            reminder = self.pending.get((finid, kind))
+            if reminder is not None and reminder.fire_at == fire_at:
+                return reminder
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, now=None):
+        """Remove and return every reminder due by `now`, earliest first"""
+        now = now or time.time()
+        due = []
+        while True:
+            reminder = self._peek()
+            if reminder is None or reminder.fire_at > now:
+                return due
+            heapq.heappop(self.heap)
+            del self.pending[(reminder.finid, reminder.kind)]
+            due.append(reminder)
+
+    def complete(self, reminders):
+        """Forget delivered reminders for good (a reminder rescheduled meanwhile is kept)"""
+        with self.lock:
+            self.conn.executemany(
+                "DELETE FROM reminders WHERE finid = ? AND kind = ? AND fire_at = ?",
+                [(r.finid, r.kind, r.fire_at) for r in reminders]
+            )
+            self.conn.commit()
+        for reminder in reminders:
+            REMINDERS_FIRED.inc(kind=reminder.kind)
+
+    def retry(self, reminders, delay=REMINDER_RETRY_SECONDS):
+        """Put reminders whose delivery failed back on the heap a little later
+
+        The stored row gets the new time too, so complete() can find it and a restart
+        does not fire it again at the old time.
+        """
+        moved = []
+        for reminder in reminders:
+            if (reminder.finid, reminder.kind) in self.pending:
+                continue  # Rescheduled meanwhile
+            retried = reminder._replace(fire_at=time.time() + delay)
+            self.pending[(retried.finid, retried.kind)] = retried
+            heapq.heappush(self.heap, (retried.fire_at, retried.finid, retried.kind))
+            moved.append((retried.fire_at, reminder.finid, reminder.kind, reminder.fire_at))
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE reminders SET fire_at = ? WHERE finid = ? AND kind = ? AND fire_at = ?", moved
+            )
+            self.conn.commit()
+
+    async def run(self, handler):
+        """Call `await handler(reminders)` whenever reminders fall due, until stop()"""
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.stopped = False
+        logger.info(f"Reminder scheduler started with {len(self.pending)} pending reminder(s)")
+        while not self.stopped:
+            # Clear before popping so a schedule() that races the pop still wakes us
+            self.wakeup.clear()
+            due = self.pop_due()
+            if due:
+                try:
+                    await handler(due)
+                    self.complete(due)
+                except Exception as e:
+                    logger.error(f"Error sending {len(due)} reminder(s), retrying in {REMINDER_RETRY_SECONDS}s: {e}")
+                    self.retry(due)
+                continue
+            upcoming = self._peek()
+            # Re-check at least hourly in case the wall clock jumps (suspend, NTP step)
+            timeout = 3600 if upcoming is None else min(max(0.0, upcoming.fire_at - time.time()), 3600)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        self.stopped = True
+        if self.wakeup:
+            self.wakeup.set()
+
+    def next_reminder(self):
+        """The earliest pending reminder, or None"""
+        return self._peek()
+
+    def prune(self, today_str):
+        """Forget the dates of IPOs that have closed"""
+        closed = [finid for finid, (_, close_date) in self.dates.items() if close_date and close_date < today_str]
+        for finid in closed:
+            del self.dates[finid]
+        with self.lock:
+            self.conn.executemany("DELETE FROM reminder_dates WHERE finid = ?", [(finid,) for finid in closed])
+            self.conn.commit()
+
+    def collect_metrics(self):
+        REMINDERS_PENDING.set(len(self.pending))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,118 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from config import RENDER_CACHE_SIZE, RENDER_CACHE_DIR, logger
+from .allotment_estimator import estimator
+
+# Fields the alert templates read from an IPO record
+IPO_TEMPLATE_FIELDS = (
+    "company_name", "finid", "Sector", "offer_price", "open_date", "close_date",
+    "shares_offered", "issue_manager"
+)
+
+_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+_BETWEEN_TAGS_RE = re.compile(r">\s+<")
+_WHITESPACE_RE = re.compile(r"\s{2,}")
+
+
+def minify_html(html):
+    """Strip comments and collapse whitespace; the templates have no <pre> blocks"""
+    html = _COMMENT_RE.sub("", html)
+    html = _BETWEEN_TAGS_RE.sub("><", html)
+    return _WHITESPACE_RE.sub(" ", html).strip()
+
+
+def ipo_cache_key(ipo, *extra):
+    """Content hash of the IPO fields and metrics that affect a rendered alert"""
+    parts = [[field, ipo.get(field)] for field in IPO_TEMPLATE_FIELDS]
+    payload = json.dumps([parts, list(extra), estimator.estimate(ipo)], default=str, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """LRU cache of rendered payloads keyed by content hash, with an optional on-disk tier"""
+    def __init__(self, max_entries=RENDER_CACHE_SIZE, cache_dir=RENDER_CACHE_DIR):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, kind, key):
+        return os.path.join(self.cache_dir, f"{kind}-{key}.cache")
+
+    def _read_disk(self, kind, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(kind, key), 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Could not read render cache entry: {e}")
+            return None
+
+    def _write_disk(self, kind, key, value):
+        if not self.cache_dir:
+            return
+        try:
+            path = self._disk_path(kind, key)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Could not write render cache entry: {e}")
+
+    def _remember(self, cache_key, value):
+        with self.lock:
+            self.entries[cache_key] = value
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, kind, key):
+        """Return the cached payload for (kind, key) or None, promoting disk hits to memory"""
+        cache_key = (kind, key)
+        with self.lock:
+            value = self.entries.get(cache_key)
+            if value is not None:
+                self.entries.move_to_end(cache_key)
+                self.hits += 1
+                return value
+
+        value = self._read_disk(kind, key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._remember(cache_key, value)
+        return value
+
+    def put(self, kind, key, value):
+        """Store a rendered payload in memory and on disk"""
+        self._remember((kind, key), value)
+        self._write_disk(kind, key, value)
+
+    def get_or_render(self, kind, key, render):
+        """Return the cached payload for (kind, key), calling render() only on a miss"""
+        value = self.get(kind, key)
+        if value is None:
+            value = render()
+            self.put(kind, key, value)
+        return value
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+# Create a global render cache shared by email and Discord rendering
+render_cache = RenderCache()
@@ -0,0 +1,129 @@
+import os
+import asyncio
+from datetime import datetime, timedelta
+from config import (
+    NEPAL_TZ, CHECK_INTERVAL_HOURS, MARKET_OPEN_TIME, MARKET_CLOSE_TIME, TRADING_DAYS,
+    DENSE_POLL_MINUTES, DENSE_WINDOW_BEFORE_MINUTES, DENSE_WINDOW_AFTER_MINUTES,
+    TRADING_POLL_MINUTES, HOLIDAY_CALENDAR_FILE, logger
+)
+from utils import get_nepal_time
+
+
+def _parse_time(value):
+    return datetime.strptime(value, "%H:%M").time()
+
+
+def load_holidays(path=HOLIDAY_CALENDAR_FILE):
+    """Load market holidays (one YYYY-MM-DD per line, # comments) from the calendar file"""
+    holidays = set()
+    if not path or not os.path.exists(path):
+        return holidays
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_num, line in enumerate(f, 1):
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                try:
+                    holidays.add(datetime.strptime(line, "%Y-%m-%d").date())
+                except ValueError:
+                    logger.warning(f"Invalid holiday date on line {line_num}: {line}")
+    except Exception as e:
+        logger.error(f"Error loading holiday calendar: {e}")
+    return holidays
+
+
+class AlertScheduler:
+    """Decides when to poll next based on NEPSE hours, holidays and known IPO open dates"""
+    def __init__(self):
+        self.open_time = _parse_time(MARKET_OPEN_TIME)
+        self.close_time = _parse_time(MARKET_CLOSE_TIME)
+        self.dense_interval = timedelta(minutes=DENSE_POLL_MINUTES)
+        self.trading_interval = timedelta(minutes=TRADING_POLL_MINUTES)
+        self.off_hours_interval = timedelta(hours=CHECK_INTERVAL_HOURS)
+        self.window_before = timedelta(minutes=DENSE_WINDOW_BEFORE_MINUTES)
+        self.window_after = timedelta(minutes=DENSE_WINDOW_AFTER_MINUTES)
+        self.holidays = load_holidays()
+        self.holidays_loaded_on = get_nepal_time().date()
+        self.known_open_dates = set()
+        self.stopped = False
+        self._wake = asyncio.Event()
+
+    def set_known_open_dates(self, dates):
+        """Remember upcoming IPO open dates (YYYY-MM-DD strings) so we wake up for them"""
+        known = set()
+        for value in dates:
+            try:
+                known.add(datetime.strptime(value, "%Y-%m-%d").date())
+            except (TypeError, ValueError):
+                continue
+        self.known_open_dates = known
+
+    def _at(self, day, at_time):
+        return NEPAL_TZ.localize(datetime.combine(day, at_time))
+
+    def is_trading_day(self, day):
+        return day.weekday() in TRADING_DAYS and day not in self.holidays
+
+    def _is_alert_day(self, day):
+        return day in self.known_open_dates or self.is_trading_day(day)
+
+    def _interval_for(self, now):
+        day = now.date()
+        if not self._is_alert_day(day):
+            return self.off_hours_interval
+
+        market_open = self._at(day, self.open_time)
+        if market_open - self.window_before <= now < market_open + self.window_after:
+            return self.dense_interval
+        if market_open - self.window_before <= now < self._at(day, self.close_time):
+            return self.trading_interval
+        return self.off_hours_interval
+
+    def _next_window_start(self, now, days_ahead=14):
+        """Return the start of the next dense polling window after `now`"""
+        for offset in range(days_ahead + 1):
+            day = now.date() + timedelta(days=offset)
+            if not self._is_alert_day(day):
+                continue
+            window_start = self._at(day, self.open_time) - self.window_before
+            if window_start > now:
+                return window_start
+        return None
+
+    def next_check_time(self, now=None):
+        """Return the actual next wake-up time in NPT"""
+        now = now or get_nepal_time()
+        if now.date() != self.holidays_loaded_on:
+            self.holidays = load_holidays()
+            self.holidays_loaded_on = now.date()
+
+        candidate = now + self._interval_for(now)
+        window_start = self._next_window_start(now)
+        if window_start and window_start < candidate:
+            candidate = window_start
+        return candidate
+
+    async def sleep_until(self, when):
+        """Sleep until `when`, returning early if stopped or triggered. Returns False once stopped."""
+        timeout = max(0.0, (when - get_nepal_time()).total_seconds())
+        return await self.wait(timeout)
+
+    async def wait(self, seconds):
+        """Interruptible sleep. Returns False once the scheduler has been stopped."""
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=seconds)
+            self._wake.clear()
+        except asyncio.TimeoutError:
+            pass
+        return not self.stopped
+
+    def trigger(self):
+        """Wake the main loop now for a manual check"""
+        logger.info("Manual check triggered")
+        self._wake.set()
+
+    def stop(self):
+        """Stop the scheduler and wake any sleeper immediately"""
+        self.stopped = True
+        self._wake.set()
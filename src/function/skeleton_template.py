@@ -0,0 +1,64 @@
+import re
+import json
+
+# Slot markers survive rendering of the surrounding template and are split out at compile time
+_SLOT_MARK = "\x00"
+_JSON_SLOT_MARK = "\\u0000"  # how json.dumps writes the marker
+
+
+def slot(name):
+    """Placeholder for a per-recipient value inside a template or payload"""
+    return f"{_SLOT_MARK}{name}{_SLOT_MARK}"
+
+
+class CompiledTemplate:
+    """Static byte segments with named slots between them; rendering is a single join"""
+    __slots__ = ("segments", "slots", "escape")
+
+    def __init__(self, text, marker=_SLOT_MARK, escape=None):
+        parts = text.split(marker)
+        if len(parts) % 2 == 0:
+            raise ValueError("Unbalanced slot marker in template")
+        self.segments = [part.encode("utf-8") for part in parts[0::2]]
+        self.slots = parts[1::2]
+        self.escape = escape
+
+    def render(self, values):
+        """Fill the slots from `values` (str) and return the result as bytes"""
+        segments = self.segments
+        escape = self.escape
+        out = [segments[0]]
+        for i, name in enumerate(self.slots, 1):
+            value = values[name]
+            if escape:
+                value = escape(value)
+            out.append(value.encode("utf-8"))
+            out.append(segments[i])
+        return b"".join(out)
+
+
+_JSON_ESCAPE_RE = re.compile(r'["\\\x00-\x1f\u2028\u2029]')
+
+
+def _json_escape(value):
+    # Most values (emails, tokens, URLs) need no escaping, so skip json.dumps for them
+    if _JSON_ESCAPE_RE.search(value) is None:
+        return value
+    return json.dumps(value, ensure_ascii=False)[1:-1]
+
+
+def compile_text(text):
+    """Compile text containing slot() markers; values are inserted as-is"""
+    return CompiledTemplate(text)
+
+
+def compile_json(payload):
+    """Compile a JSON-serialisable payload whose strings contain slot() markers
+
+    Static parts are JSON-encoded once; slot values are JSON-string escaped on render.
+    """
+    return CompiledTemplate(
+        json.dumps(payload, ensure_ascii=False, separators=(",", ":")),
+        marker=_JSON_SLOT_MARK,
+        escape=_json_escape
+    )
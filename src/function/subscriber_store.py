@@ -0,0 +1,190 @@
+import sqlite3
+import threading
+from config import SUBSCRIBER_DB_FILE, DIGEST_DEFAULT_DELIVERY, logger
+from utils import load_subscribers
+
+INSTANT = "instant"
+DIGEST = "digest"
+
+
+def _split(value):
+    return [item.strip().lower() for item in (value or "").split(",") if item.strip()]
+
+
+def _normalize_prefs(prefs):
+    """Turn raw preferences from email_update.txt into store columns"""
+    try:
+        min_probability = float(prefs.get("min_prob", 0) or 0)
+    except ValueError:
+        min_probability = 0.0
+    delivery = (prefs.get("delivery") or DIGEST_DEFAULT_DELIVERY).strip().lower()
+    return {
+        "name": prefs.get("name"),
+        "sectors": _split(prefs.get("sectors")),
+        "channels": _split(prefs.get("channels")) or ["email"],
+        "min_probability": min_probability,
+        "delivery": delivery if delivery in (INSTANT, DIGEST) else INSTANT,
+    }
+
+
+class SubscriberStore:
+    """SQLite subscriber store indexed by sector and channel for targeted fan-out"""
+    def __init__(self, path=SUBSCRIBER_DB_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS subscribers (
+                email TEXT PRIMARY KEY,
+                name TEXT,
+                min_probability REAL NOT NULL DEFAULT 0,
+                all_sectors INTEGER NOT NULL DEFAULT 1,
+                active INTEGER NOT NULL DEFAULT 1,
+                delivery TEXT NOT NULL DEFAULT 'instant'
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_subscribers_all_sectors
+                ON subscribers (all_sectors, active, min_probability);
+            CREATE TABLE IF NOT EXISTS subscriber_sectors (
+                sector TEXT NOT NULL,
+                email TEXT NOT NULL,
+                PRIMARY KEY (sector, email)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS subscriber_channels (
+                channel TEXT NOT NULL,
+                email TEXT NOT NULL,
+                PRIMARY KEY (channel, email)
+            ) WITHOUT ROWID;
+        """)
+        # Stores created before digest delivery existed lack the column
+        if "delivery" not in {row[1] for row in self.conn.execute("PRAGMA table_info(subscribers)")}:
+            self.conn.execute(f"ALTER TABLE subscribers ADD COLUMN delivery TEXT NOT NULL DEFAULT '{INSTANT}'")
+        self.conn.commit()
+
+    def upsert_many(self, subscribers):
+        """Insert or update subscribers from a dict of email -> raw preferences"""
+        rows, sectors, channels = [], [], []
+        for email, prefs in subscribers.items():
+            prefs = _normalize_prefs(prefs or {})
+            rows.append((email, prefs["name"], prefs["min_probability"], 0 if prefs["sectors"] else 1, prefs["delivery"]))
+            sectors.extend((sector, email) for sector in prefs["sectors"])
+            channels.extend((channel, email) for channel in prefs["channels"])
+        if not rows:
+            return
+        emails = [(row[0],) for row in rows]
+        with self.lock:
+            self.conn.executemany("""
+                INSERT INTO subscribers (email, name, min_probability, all_sectors, active, delivery)
+                VALUES (?, ?, ?, ?, 1, ?)
+                ON CONFLICT (email) DO UPDATE SET
+                    name = excluded.name,
+                    min_probability = excluded.min_probability,
+                    all_sectors = excluded.all_sectors,
+                    active = 1,
+                    delivery = excluded.delivery
+            """, rows)
+            self.conn.executemany("DELETE FROM subscriber_sectors WHERE email = ?", emails)
+            self.conn.executemany("DELETE FROM subscriber_channels WHERE email = ?", emails)
+            self.conn.executemany("INSERT OR IGNORE INTO subscriber_sectors (sector, email) VALUES (?, ?)", sectors)
+            self.conn.executemany("INSERT OR IGNORE INTO subscriber_channels (channel, email) VALUES (?, ?)", channels)
+            self.conn.commit()
+
+    def deactivate_many(self, emails):
+        """Stop sending to these subscribers without losing their preferences"""
+        with self.lock:
+            self.conn.executemany("UPDATE subscribers SET active = 0 WHERE email = ?", [(e,) for e in emails])
+            self.conn.commit()
+
+    def active_emails(self):
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT email FROM subscribers WHERE active = 1")}
+
+    def sync_from_file(self):
+        """Import email_update.txt, deactivating addresses that are no longer listed
+
+        Leaves the store untouched if the file cannot be read and returns None.
+        """
+        subscribers = load_subscribers()
+        if subscribers is None:
+            logger.warning("Email list could not be read, keeping the current subscribers")
+            return None
+        removed = self.active_emails() - set(subscribers)
+        self.upsert_many(subscribers)
+        if removed:
+            self.deactivate_many(removed)
+        logger.info(f"Subscriber store synced: {len(subscribers)} active, {len(removed)} deactivated")
+        return len(subscribers)
+
+    def apply_delta(self, added, removed):
+        """Apply an email list delta (added: email -> preferences, removed: emails)"""
+        if added:
+            self.upsert_many(added if isinstance(added, dict) else {email: {} for email in added})
+        if removed:
+            self.deactivate_many(removed)
+
+    def names_for(self, emails):
+        """Stored display names for these subscribers (email -> name, only those that set one)"""
+        emails = list(emails)
+        names = {}
+        with self.lock:
+            # Chunked to stay under SQLite's bound-parameter limit
+            for start in range(0, len(emails), 500):
+                chunk = emails[start:start + 500]
+                names.update(self.conn.execute(
+                    f"SELECT email, name FROM subscribers WHERE name IS NOT NULL AND email IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ))
+        return names
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM subscribers WHERE active = 1").fetchone()[0]
+
+    def _paged(self, query, params, page_size):
+        """Run a keyset-paginated query (ordered by email) and yield emails page by page"""
+        last = ""
+        while True:
+            with self.lock:
+                rows = self.conn.execute(query, (*params, last, page_size)).fetchall()
+            for row in rows:
+                yield row[0]
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+    def iter_recipients(self, sector=None, probability=0.0, channel="email", delivery=None, page_size=1000):
+        """Stream active subscribers interested in an IPO of this sector and probability
+
+        Uses the (sector, email) and (all_sectors, active, min_probability) indexes, so
+        only matching subscribers are read. `delivery` limits the stream to instant or
+        digest subscribers.
+        """
+        sector = (sector or "").strip().lower()
+        by_delivery = "AND s.delivery = ?" if delivery else ""
+        extra = (delivery,) if delivery else ()
+        if sector:
+            yield from self._paged(f"""
+                SELECT s.email FROM subscriber_sectors ss
+                JOIN subscribers s ON s.email = ss.email
+                JOIN subscriber_channels c ON c.channel = ? AND c.email = ss.email
+                WHERE ss.sector = ? AND s.active = 1 AND s.min_probability <= ? {by_delivery} AND ss.email > ?
+                ORDER BY ss.email LIMIT ?
+            """, (channel, sector, probability, *extra), page_size)
+
+        yield from self._paged(f"""
+            SELECT s.email FROM subscribers s
+            JOIN subscriber_channels c ON c.channel = ? AND c.email = s.email
+            WHERE s.all_sectors = 1 AND s.active = 1 AND s.min_probability <= ? {by_delivery} AND s.email > ?
+            ORDER BY s.email LIMIT ?
+        """, (channel, probability, *extra), page_size)
+
+    def has_digest_subscribers(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM subscribers WHERE active = 1 AND delivery = ? LIMIT 1", (DIGEST,)
+            ).fetchone() is not None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
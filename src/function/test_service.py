@@ -1,26 +1,58 @@
-from config import ADMIN_EMAIL, EMAIL_LIST_FILE, CHECK_INTERVAL_HOURS, logger
+import asyncio
+from config import (
+    ADMIN_EMAIL, EMAIL_LIST_FILE, CHECK_INTERVAL_HOURS, STARTUP_CHECK_MODE, STARTUP_CHECK_TIMEOUT_SECONDS, logger
+)
 from utils import load_email_list
 from .api_service import test_api_connection
-from .email_service import send_email
+from .email_service import send_email, check_brevo_access
 from .email_templates import create_system_notification_email
 
 
-def test_all_connections():
-    """Test API and email connectivity"""
-    logger.info("Testing connections.")
-    
-    # Load and display email list
-    email_list = load_email_list()
-    logger.info(f"Email list contains {len(email_list)} addresses")
-    
-    # Test API
-    api_success = test_api_connection()
-    if not api_success:
-        return False
-    
-    # Test email (send test notification to admin only)
-    email_success = test_email_connection(len(email_list))
-    return email_success
+async def test_all_connections(mode=STARTUP_CHECK_MODE, timeout=STARTUP_CHECK_TIMEOUT_SECONDS):
+    """Test API and email connectivity concurrently, all within one deadline
+
+    "full" sends a test email to the admin and waits for Brevo to accept it;
+    "light" only checks that Brevo accepts the API key. A check still running
+    at the deadline counts as failed.
+    """
+    logger.info(f"Testing connections ({mode} mode).")
+
+    async def check_email_list():
+        # Load and display email list
+        email_list = await asyncio.to_thread(load_email_list)
+        logger.info(f"Email list contains {len(email_list)} addresses")
+        return len(email_list)
+
+    async def check_email():
+        if mode == "light":
+            return await check_brevo_access()
+        # Test email (send test notification to admin only)
+        return await asyncio.to_thread(test_email_connection, await email_list)
+
+    email_list = asyncio.create_task(check_email_list())
+    checks = {
+        "IPO API": asyncio.create_task(test_api_connection()),
+        "Email": asyncio.create_task(check_email()),
+    }
+    done, pending = await asyncio.wait([email_list, *checks.values()], timeout=timeout)
+
+    success = True
+    for name, task in checks.items():
+        if task in pending:
+            logger.error(f"✗ {name} check did not finish within {timeout:.0f}s")
+            success = False
+        elif task.exception() is not None:
+            logger.error(f"✗ {name} check failed: {task.exception()}")
+            success = False
+        elif not task.result():
+            success = False
+    if email_list in done and email_list.exception() is not None:
+        logger.error(f"✗ Could not load the email list: {email_list.exception()}")
+        success = False
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    return success
 
 
 def test_email_connection(subscriber_count):
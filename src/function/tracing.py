@@ -0,0 +1,75 @@
+import time
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+# Handed out while tracing is off, so a disabled span costs one attribute check
+_NOOP = nullcontext()
+
+
+class Span:
+    __slots__ = ("name", "duration", "children")
+
+    def __init__(self, name):
+        self.name = name
+        self.duration = 0.0
+        self.children = []
+
+
+class Tracer:
+    """Nested timing spans for a single run, e.g. one alert cycle under --profile
+
+    The current span lives in a context variable, so spans opened in awaited
+    coroutines and asyncio.to_thread calls nest under the span that started them.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.roots = []
+        self.current = contextvars.ContextVar("current_span", default=None)
+
+    def enable(self):
+        self.roots = []
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def span(self, name):
+        """Context manager timing the with-block as a child of the current span"""
+        if not self.enabled:
+            return _NOOP
+        return self._span(name)
+
+    @contextmanager
+    def _span(self, name):
+        parent = self.current.get()
+        span = Span(name)
+        (parent.children if parent else self.roots).append(span)
+        token = self.current.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - start
+            self.current.reset(token)
+
+    def render(self):
+        """Timing tree; same-named siblings (such as one stage per IPO) are merged with a count"""
+        lines = []
+
+        def walk(spans, depth, parent_total):
+            grouped = {}
+            for span in spans:
+                grouped.setdefault(span.name, []).append(span)
+            for name, group in grouped.items():
+                total = sum(span.duration for span in group)
+                count = f" x{len(group)}" if len(group) > 1 else ""
+                share = f" {total / parent_total:6.1%}" if parent_total else ""
+                lines.append(f"{'  ' * depth}{name}{count}".ljust(48) + f"{total * 1000:10.1f} ms{share}")
+                walk([child for span in group for child in span.children], depth + 1, total)
+
+        walk(self.roots, 0, None)
+        return "\n".join(lines)
+
+
+# Create a global tracer shared by every module
+tracer = Tracer()
@@ -0,0 +1,102 @@
+import os
+import gzip
+import json
+import queue
+import atexit
+import shutil
+import hashlib
+import logging
+import itertools
+import logging.handlers
+from datetime import datetime, timezone
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Structured fields callers may pass via `extra=`; the JSON formatter emits them when present
+STRUCTURED_FIELDS = ("finid", "recipient_hash", "latency_ms", "channel", "count", "status_code")
+
+
+def recipient_hash(email):
+    """Short stable hash so logs can correlate a recipient without storing the address"""
+    return hashlib.sha256(email.encode("utf-8")).hexdigest()[:12]
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the structured fields the record carries"""
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class Sampler:
+    """Lets through the first and then every `every`-th event, for high-volume success lines"""
+    def __init__(self, every):
+        self.every = max(1, every)
+        self.counter = itertools.count()
+
+    def __call__(self):
+        return next(self.counter) % self.every == 0
+
+
+def _gzip_namer(name):
+    return name + ".gz"
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def setup_logging(log_file, level="INFO", fmt="text", max_bytes=10 * 1024 * 1024, backup_count=5,
+                  rotate_when=None, compress=True):
+    """Route all logging through a queue to a background thread that writes the file and console
+
+    The file rotates by size, or by time when `rotate_when` is set (e.g. "midnight"), and
+    rotated files are gzip-compressed. Returns the running QueueListener.
+    """
+    if rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            log_file, when=rotate_when, backupCount=backup_count, encoding="utf-8"
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+    if compress:
+        file_handler.namer = _gzip_namer
+        file_handler.rotator = _gzip_rotator
+
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, console_handler, respect_handler_level=True
+    )
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    # httpx logs every request at INFO, which would be one line per email at high fan-out
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener.start()
+    # Flush whatever is still queued when the process exits
+    atexit.register(listener.stop)
+    return listener
@@ -5,164 +5,262 @@ Monitors IPO openings and sends email/Discord alerts
 """
 
 import sys
-import time
-import threading
+import signal
 import asyncio
-from datetime import timedelta
+import argparse
+from datetime import datetime
 
 # Import all modules
-from config import validate_environment, CHECK_INTERVAL_HOURS, logger
+from config import validate_environment, CHECK_INTERVAL_HOURS, STARTUP_CHECK_MODE, NEPAL_TZ, logger
 from utils import get_nepal_time
+from log_config import recipient_hash
 from function.file_watcher import FileWatcher
 from function.ipo_processor import IPOProcessor
+from function.outbound_spool import OutboundSpool
+from function.delivery_ledger import DeliveryLedger
 from function.discord_integration import discord_integration
+from function.http_transport import transport
+from function.metrics import metrics
+from function.tracing import tracer
 from function.test_service import test_all_connections, send_startup_notification, send_error_notification
 
 
-def start_discord_bot():
-    """Start Discord bot in a separate thread"""
+def install_signal_handlers(scheduler):
+    """Stop the scheduler on SIGTERM and run an immediate check on SIGUSR1"""
+    loop = asyncio.get_running_loop()
+    handlers = {signal.SIGTERM: scheduler.stop}
+    if hasattr(signal, "SIGUSR1"):
+        handlers[signal.SIGUSR1] = scheduler.trigger
+
+    for signum, handler in handlers.items():
+        try:
+            loop.add_signal_handler(signum, handler)
+        except NotImplementedError:
+            # Windows event loops do not support add_signal_handler
+            signal.signal(signum, lambda s, f, handler=handler: loop.call_soon_threadsafe(handler))
+
+
+async def notify_discord_error(title, message):
+    """Send a Discord system notification, never raising"""
+    if not discord_integration.is_ready():
+        return
     try:
-        discord_integration.start_bot()
+        await asyncio.wait_for(discord_integration.send_system_notification(title, message, "error"), timeout=5)
     except Exception as e:
-        logger.error(f"Discord bot error: {e}")
+        logger.error(f"Failed to send Discord error notification: {e}")
 
 
-def wait_for_discord_ready(timeout=30):
-    """Wait for Discord bot to be ready"""
-    start_time = time.time()
-    while not discord_integration.is_ready() and (time.time() - start_time) < timeout:
-        logger.info("Waiting for Discord bot to be ready...")
-        time.sleep(2)
-    
-    if discord_integration.is_ready():
-        logger.info("Discord bot is ready!")
-        return True
-    else:
-        logger.warning("Discord bot failed to start within timeout")
-        return False
+async def run(check_mode=STARTUP_CHECK_MODE):
+    """Run processing, scheduling, file watching and the Discord bot on one event loop"""
+    # Start Discord right away so login overlaps with the connection tests
+    discord_task = asyncio.create_task(discord_integration.start())
+    ipo_processor = None
+    reminder_task = None
+    await metrics.start_server()
 
-
-def main():
-    """Main application entry point"""
-    
-    # Validate environment variables
-    if not validate_environment():
-        logger.error("Environment validation failed. Exiting.")
-        sys.exit(1)
-    
-    # Test connections before starting
-    if not test_all_connections():
-        logger.error("Connection tests failed. Please check your configuration.")
-        send_error_notification("Connection tests failed during startup", is_fatal=True)
-        sys.exit(1)
-    
-    # Initialize IPO processor
-    ipo_processor = IPOProcessor()
-    
-    logger.info("=== IPO Alert Bot Started ===")
-    logger.info(f"Check interval: {CHECK_INTERVAL_HOURS} hours")
-    logger.info("=====================================")
-    
     try:
-        # Start Discord bot in background thread
-        discord_thread = threading.Thread(target=start_discord_bot, daemon=True)
-        discord_thread.start()
-        
-        # Wait for Discord bot to be ready
-        discord_ready = wait_for_discord_ready()
-        
-        # Send Discord startup notification if ready
-        # if discord_ready:
-        #     try:
-        #         asyncio.run_coroutine_threadsafe(
-        #             discord_integration.send_system_notification(
-        #                 "Bot Startup",
-        #                 "✅ The IPO Alert Bot is online and ready to send notifications.",
-        #                 "success"
-        #             ),
-        #             discord_integration.get_loop()
-        #         ).result(timeout=5)
-        #     except Exception as e:
-        #         logger.warning(f"Failed to send Discord startup notification: {e}")
-        
+        # Test connections before starting; the checks run concurrently under one deadline
+        if not await test_all_connections(check_mode):
+            logger.error("Connection tests failed. Please check your configuration.")
+            await asyncio.to_thread(send_error_notification, "Connection tests failed during startup", True)
+            sys.exit(1)
+
+        # Initialize IPO processor
+        ipo_processor = IPOProcessor()
+        scheduler = ipo_processor.scheduler
+        install_signal_handlers(scheduler)
+
+        # Deliver queued emails (including any left from a previous run) in the background
+        ipo_processor.spool.start()
+
+        # Reminders fire at their own NPT times, independently of the polling schedule
+        reminder_task = asyncio.create_task(ipo_processor.reminders.run(ipo_processor.send_reminders))
+
+        logger.info("=== IPO Alert Bot Started ===")
+        logger.info(f"Off-hours check interval: {CHECK_INTERVAL_HOURS} hours")
+        upcoming = ipo_processor.reminders.next_reminder()
+        if upcoming:
+            logger.info(f"Next reminder: {upcoming.kind} for {upcoming.finid} at "
+                        f"{datetime.fromtimestamp(upcoming.fire_at, NEPAL_TZ).strftime('%Y-%m-%d %H:%M')} NPT")
+        logger.info("=====================================")
+
+        # Discord keeps logging in in the background; channel alerts wait for it, the first poll does not
+
         # Send email startup notification
         # send_startup_notification()
-        
-        # Start file watcher for email list updates
+
+        # Start file watcher for email list updates; deltas are applied on the watcher's thread
         with FileWatcher(callback=ipo_processor.update_email_list):
-            
+
             # Main processing loop
-            while True:
+            while not scheduler.stopped:
                 try:
                     # Process IPO alerts
-                    ipo_processor.process_ipo_alerts()
-                    
+                    await ipo_processor.process_ipo_alerts()
+
                     # Calculate next check time
-                    next_check = ipo_processor.get_next_check_time(CHECK_INTERVAL_HOURS)
+                    next_check = ipo_processor.get_next_check_time()
+                    sleep_minutes = (next_check - get_nepal_time()).total_seconds() / 60
                     logger.info(f"Next check scheduled at: {next_check.strftime('%Y-%m-%d %H:%M:%S')} NPT")
-                    logger.info(f"Sleeping for {CHECK_INTERVAL_HOURS} hours...")
-                    
-                    # Sleep until next check
-                    time.sleep(CHECK_INTERVAL_HOURS * 3600)
-                    
+                    logger.info(f"Sleeping for {sleep_minutes:.0f} minutes...")
+
+                    # Sleep until next check (returns early on shutdown or manual trigger)
+                    await scheduler.sleep_until(next_check)
+
                 except Exception as e:
                     logger.error(f"Unexpected error in main loop: {e}")
-                    send_error_notification(str(e), is_fatal=False)
-                    
-                    # Send Discord error notification if available
-                    if discord_integration.is_ready():
-                        try:
-                            asyncio.run_coroutine_threadsafe(
-                                discord_integration.send_system_notification(
-                                    "Bot Error",
-                                    f"⚠️ An error occurred: `{str(e)}`\nContinuing after 5 minutes...",
-                                    "error"
-                                ),
-                                discord_integration.get_loop()
-                            )
-                        except Exception as discord_error:
-                            logger.error(f"Failed to send Discord error notification: {discord_error}")
-                    
+                    await asyncio.to_thread(send_error_notification, str(e), False)
+                    await notify_discord_error(
+                        "Bot Error", f"⚠️ An error occurred: `{str(e)}`\nContinuing after 5 minutes..."
+                    )
+
                     logger.info("Continuing after error...")
-                    time.sleep(300)  # Retry after 5 minutes
-    
-    except KeyboardInterrupt:
-        logger.info("Bot stopped by user (Ctrl+C)")
-    
+                    await scheduler.wait(300)  # Retry after 5 minutes
+
     except Exception as e:
         logger.error(f"Fatal error: {e}")
-        send_error_notification(str(e), is_fatal=True)
-        
-        # Send Discord fatal error notification if available
-        if discord_integration.is_ready():
-            try:
-                asyncio.run_coroutine_threadsafe(
-                    discord_integration.send_system_notification(
-                        "Fatal Error",
-                        f"❌ Bot encountered a fatal error and is shutting down: `{str(e)}`",
-                        "error"
-                    ),
-                    discord_integration.get_loop()
-                ).result(timeout=5)
-            except Exception:
-                pass  # Don't let Discord errors prevent shutdown
-        
+        await asyncio.to_thread(send_error_notification, str(e), True)
+        await notify_discord_error(
+            "Fatal Error", f"❌ Bot encountered a fatal error and is shutting down: `{str(e)}`"
+        )
         sys.exit(1)
-    
+
     finally:
         # Cleanup
         logger.info("Shutting down...")
-        if discord_integration.is_ready():
-            try:
-                asyncio.run_coroutine_threadsafe(
-                    discord_integration.close(),
-                    discord_integration.get_loop()
-                ).result(timeout=5)
-            except Exception as e:
-                logger.warning(f"Error closing Discord bot: {e}")
-        
+        try:
+            await asyncio.wait_for(discord_integration.close(), timeout=5)
+        except Exception as e:
+            logger.warning(f"Error closing Discord bot: {e}")
+        discord_task.cancel()
+        await asyncio.gather(discord_task, return_exceptions=True)
+
+        if reminder_task:
+            ipo_processor.reminders.stop()
+            await asyncio.gather(reminder_task, return_exceptions=True)
+
+        if ipo_processor:
+            await ipo_processor.spool.stop()
+
+        await transport.aclose()
+        transport.close()
+        await metrics.stop_server()
+        metrics.dump()
         logger.info("Bot shutdown complete")
 
 
+async def profile_cycle(drain_timeout=300):
+    """Run one alert cycle with tracing on, wait for its emails to go out and print the timing tree
+
+    Uses the configured feed, Brevo endpoint and state files; point ONGOING_URL and
+    BREVO_API_URL at benchmarks/fake_upstream.py to profile against stand-ins.
+    The Discord bot is not started, so only webhook targets are exercised.
+    """
+    ipo_processor = IPOProcessor()
+    tracer.enable()
+    try:
+        with tracer.span("cycle"):
+            # Workers started inside the span report their sends under it
+            ipo_processor.spool.start()
+            await ipo_processor.process_ipo_alerts()
+            with tracer.span("drain_spool"):
+                try:
+                    await asyncio.wait_for(ipo_processor.spool.drain(), timeout=drain_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Spool still had queued emails after {drain_timeout}s")
+    finally:
+        tracer.disable()
+        await ipo_processor.spool.stop()
+        await transport.aclose()
+        transport.close()
+    print("\nTiming tree (concurrent spans such as send_emails add up their durations):")
+    print(tracer.render())
+
+
+def run_profile(args):
+    """--profile: one traced cycle, optionally under cProfile and/or tracemalloc"""
+    profiler = None
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start(25)
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        asyncio.run(profile_cycle())
+    finally:
+        if profiler:
+            import pstats
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+            print(f"\ncProfile stats written to {args.cprofile}, top functions by cumulative time:")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+        if args.tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"\nPython heap: {current / 1024 / 1024:.1f} MiB now, {peak / 1024 / 1024:.1f} MiB peak; top allocations:")
+            for stat in snapshot.statistics("lineno")[:15]:
+                print(f"  {stat}")
+
+
+def requeue_dead_letters():
+    """--requeue-dead: list dead-lettered emails and give them a fresh set of attempts"""
+    ledger = DeliveryLedger()
+    spool = OutboundSpool(ledger)
+    try:
+        for finid, recipient, attempts, last_error in spool.dead_letters():
+            print(f"{finid}  {recipient_hash(recipient)}  {attempts} attempt(s)  {(last_error or '')[:80]}")
+        count = spool.requeue_dead()
+        print(f"Requeued {count} dead-lettered email(s); the running bot picks them up within a minute")
+    finally:
+        spool.close()
+        ledger.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="IPO Alert Bot")
+    parser.add_argument("--profile", action="store_true",
+                        help="run a single alert cycle, print a per-stage timing tree and exit")
+    parser.add_argument("--cprofile", metavar="FILE", help="with --profile, also write cProfile stats to FILE")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="with --profile, also report the largest Python allocations")
+    parser.add_argument("--requeue-dead", action="store_true",
+                        help="list dead-lettered emails, queue them again and exit")
+    parser.add_argument("--check-mode", choices=("full", "light"), default=STARTUP_CHECK_MODE,
+                        help="startup checks: 'full' emails the admin, 'light' only verifies access")
+    return parser.parse_args(argv)
+
+
+def main():
+    """Main application entry point"""
+    args = parse_args()
+
+    # Validate environment variables
+    if not validate_environment():
+        logger.error("Environment validation failed. Exiting.")
+        sys.exit(1)
+
+    if args.profile:
+        run_profile(args)
+        return
+
+    if args.requeue_dead:
+        requeue_dead_letters()
+        return
+
+    try:
+        import uvloop
+        runner = uvloop.run
+    except ImportError:
+        runner = asyncio.run
+
+    try:
+        runner(run(args.check_mode))
+    except KeyboardInterrupt:
+        logger.info("Bot stopped by user (Ctrl+C)")
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
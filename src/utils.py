@@ -1,6 +1,7 @@
 import os
+import secrets
 from datetime import datetime
-from config import NEPAL_TZ, EMAIL_LIST_FILE, logger
+from config import NEPAL_TZ, EMAIL_LIST_FILE, PERSONALIZATION_SECRET, PERSONALIZATION_SECRET_FILE, logger
 
 
 def get_nepal_time():
@@ -13,17 +14,34 @@ def get_nepal_date_str():
     return get_nepal_time().strftime("%Y-%m-%d")
 
 
-def load_email_list():
-    """Load email addresses from email_update.txt file"""
+def parse_subscriber_line(line):
+    """Split 'email | key=value | ...' into the lowercase email and its preferences"""
+    parts = [part.strip() for part in line.split('|')]
+    prefs = {}
+    for part in parts[1:]:
+        if '=' in part:
+            key, value = part.split('=', 1)
+            prefs[key.strip().lower()] = value.strip()
+    return parts[0].lower(), prefs
+
+
+def load_subscribers():
+    """Load subscribers and their optional preferences from email_update.txt
+
+    Each line is an email address, optionally followed by preferences:
+    investor@example.com | sectors=Hydro Power,Banking | min_prob=20 | channels=email
+    Returns a dict of email -> preferences in file order, or None if the file could
+    not be read (so callers do not mistake a read error for an empty list).
+    """
     try:
         if not os.path.exists(EMAIL_LIST_FILE):
             logger.warning(f"{EMAIL_LIST_FILE} not found. Creating empty file.")
             with open(EMAIL_LIST_FILE, 'w') as f:
                 f.write("# Add email addresses (one per line)\n")
                 f.write("# Lines starting with # are comments\n")
-            return []
+            return {}
         
-        emails = []
+        subscribers = {}
         with open(EMAIL_LIST_FILE, 'r', encoding='utf-8') as f:
             for line_num, line in enumerate(f, 1):
                 line = line.strip()
@@ -32,49 +50,48 @@ def load_email_list():
                 if not line or line.startswith('#'):
                     continue
                 
+                email, prefs = parse_subscriber_line(line)
+                
                 # Basic email validation
-                if '@' in line and '.' in line.split('@')[-1]:
-                    emails.append(line.lower())
+                if '@' in email and '.' in email.split('@')[-1]:
+                    subscribers[email] = prefs
                 else:
-                    logger.warning(f"Invalid email format on line {line_num}: {line}")
+                    logger.warning(f"Invalid email format on line {line_num} of {EMAIL_LIST_FILE}")
         
-        logger.info(f"Loaded {len(emails)} email addresses from {EMAIL_LIST_FILE}")
-        return emails
+        logger.info(f"Loaded {len(subscribers)} email addresses from {EMAIL_LIST_FILE}")
+        return subscribers
     
     except Exception as e:
         logger.error(f"Error loading email list: {e}")
-        return []
+        return None
+
 
+def load_personalization_secret():
+    """Return PERSONALIZATION_SECRET, or the one kept in PERSONALIZATION_SECRET_FILE (created on first use)
 
-def calculate_ipo_metrics(ipo, current_date_str):
-    """Calculate IPO metrics like probability and suggestions"""
+    Tokens in unsubscribe and tracking links are derived from it, so it must stay the
+    same across restarts and must not be shared with anything else.
+    """
+    if PERSONALIZATION_SECRET:
+        return PERSONALIZATION_SECRET
     try:
-        close_date = ipo.get("close_date", "").split(" ")[0] if ipo.get("close_date") else None
-        if not close_date:
-            return 0, "10", "Unable to calculate metrics - missing close date"
-        
-        # Calculate remaining days
-        close_datetime = datetime.strptime(close_date, "%Y-%m-%d")
-        current_datetime = datetime.strptime(current_date_str, "%Y-%m-%d")
-        rem_days = (close_datetime - current_datetime).days
-        
-        # Calculate probability and suggestions
-        from config import TOTAL_APPS
-        shares_offered = ipo.get('shares_offered', 0)
-        prob = (shares_offered / TOTAL_APPS) * 100 if shares_offered > 0 else 0
-        
-        sug_qty = "10" if prob < 90 else "more than 10"
-        suggestion = (
-            "Conservative approach recommended due to high demand."
-            if prob < 90
-            else "Higher allocation possible due to favorable probability."
-        )
-        
-        return rem_days, prob, sug_qty, suggestion
-        
-    except ValueError as e:
-        logger.error(f"Date parsing error for {ipo.get('company_name', 'Unknown')}: {e}")
-        return 0, 0, "10", "Unable to calculate metrics - date error"
-    except Exception as e:
-        logger.error(f"Error calculating metrics for {ipo.get('company_name', 'Unknown')}: {e}")
-        return 0, 0, "10", "Unable to calculate metrics"
\ No newline at end of file
+        with open(PERSONALIZATION_SECRET_FILE, 'r', encoding='utf-8') as f:
+            secret = f.read().strip()
+        if secret:
+            return secret
+    except FileNotFoundError:
+        pass
+
+    secret = secrets.token_hex(32)
+    # Readable by the bot's user only
+    fd = os.open(PERSONALIZATION_SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(secret + "\n")
+    logger.info(f"Generated a personalization secret in {PERSONALIZATION_SECRET_FILE}")
+    return secret
+
+
+def load_email_list():
+    """Load email addresses from email_update.txt file"""
+    return list(load_subscribers() or ())
+